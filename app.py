@@ -5,12 +5,14 @@ import os
 import json
 from logging import getLogger, config
 from speedtester import SpeedTester
+from records_store import get_records_store, load_records_config, start_compaction
+from records_rollup import summarize
+from records_export import export_latency, export_records
 from pathlib import Path
 import shutil
-from datetime import datetime
+from datetime import datetime, timedelta
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-from dateutil import tz
 
 app_name = "Simple-InternetSpeed-Logger"
 with open('./log_config.json', 'r') as f:
@@ -27,6 +29,11 @@ class SpeedtestLoggerStatusBarApp(rumps.App):
         self.frequency = frequency
         self.iterations = iterations
         self.speedtester = SpeedTester(self.frequency, self.iterations)
+        self.records_config = load_records_config()
+        self.records_store = get_records_store(self.records_config)
+        self.compaction_thread = None
+        self.compaction_timer = rumps.Timer(callback=self.compact_records, interval=60 * 60)
+        self.compaction_timer.start()
         self.status = rumps.MenuItem(self.speedtester.get_status_string())
         self.menu = ["[InternetSpeed Logger]", self.status]
         self.rumps_timer = rumps.Timer(callback=self.measure, interval=self.frequency)
@@ -115,24 +122,40 @@ class SpeedtestLoggerStatusBarApp(rumps.App):
         self.rumps_timer = rumps.Timer(callback=self.measure, interval=self.frequency)
         self.rumps_timer.callback(self.measure)
 
+    def compact_records(self, _):
+        retention_days = self.records_config.get("retention_days")
+        if not retention_days:
+            return
+        if self.compaction_thread is not None and self.compaction_thread.is_alive():
+            return
+        self.compaction_thread = start_compaction(self.records_store, retention_days)
+
+    def export_start(self):
+        export_days = self.records_config.get("export_days")
+        if export_days:
+            return datetime.utcnow() - timedelta(days=export_days)
+        return None
+
     @rumps.clicked("Export Plot")
     def export_plot(self, _):
-        try:
-            records_df = pd.read_csv("records.csv")
-        except:
-            records_df = pd.read_csv("records_init.csv")
-        if len(records_df) > 0:
-            self.plot(records_df)
+        records_df = self.records_store.read(start=self.export_start())
+        rollup_df = self.records_store.read_rollup(start=self.export_start())
+        if len(rollup_df) > 0:
+            self.plot(records_df, rollup_df)
         else:
             rumps.alert(f"Records has 0 data.")
             logger.warning(f"Records has 0 data.")
 
 
-    def plot(self, records_df):
+    def plot(self, records_df, rollup_df):
+        """
+        The boxplot uses raw records. Record counts and the heatmap use rollup cells per (network, date, hour).
+        """
         df = records_df[["timestamp", "wifi_physical_name", "connected_vpn", "download", "upload"]].copy()
         df["Network"] = df["wifi_physical_name"] + "(" + df["connected_vpn"] + ")"
         df.loc[pd.isnull(df["connected_vpn"]), "Network"] = df.loc[pd.isnull(df["connected_vpn"]), "wifi_physical_name"]
-        main_network = df.groupby("Network").size().sort_values(ascending=False).index.tolist()[0]
+        network_summary_df = summarize(rollup_df, ["network"]).sort_values("records", ascending=False)
+        main_network = network_summary_df["network"].tolist()[0]
 
         fig = make_subplots(
             rows=2, 
@@ -157,11 +180,11 @@ class SpeedtestLoggerStatusBarApp(rumps.App):
                 row=1, col=1,
             )
 
-        netowrk_size_df = df.groupby("Network").size().reset_index(name="Counts")
+        netowrk_size_df = network_summary_df.sort_values("network")
         fig.add_trace(
             go.Bar(
-                x=netowrk_size_df["Network"], 
-                y=netowrk_size_df["Counts"],
+                x=netowrk_size_df["network"], 
+                y=netowrk_size_df["records"],
                 legendgroup="2",
                 showlegend=False
             ),
@@ -169,10 +192,6 @@ class SpeedtestLoggerStatusBarApp(rumps.App):
         )
 
         # Dayofweek/Hour Heatmap 
-        from_zone = tz.tzutc()
-        to_zone = tz.tzlocal()
-        df["timestamp"] = pd.to_datetime(df["timestamp"]).map(lambda x: x.replace(tzinfo=from_zone).astimezone(to_zone))
-        df["dayofweek"] = df["timestamp"].dt.dayofweek
         dayofweek_dict = {
             0: "1.Monday",
             1: "2.Tuesday",
@@ -182,10 +201,11 @@ class SpeedtestLoggerStatusBarApp(rumps.App):
             5: "6.Saturday",
             6: "7.Sunday",
         }
-        df["dayofweek"] = df["dayofweek"].map(lambda x: dayofweek_dict.get(x))
-        df["hour"] = df["timestamp"].dt.hour
-        main_network_df = df.groupby("Network").get_group(main_network)
-        pivot_df = pd.pivot_table(data=main_network_df, index="dayofweek", columns="hour", values="download", aggfunc="mean")
+        main_network_rollup_df = rollup_df[rollup_df["network"] == main_network].copy()
+        main_network_rollup_df["dayofweek"] = pd.to_datetime(main_network_rollup_df["date"]).dt.dayofweek
+        main_network_rollup_df["dayofweek"] = main_network_rollup_df["dayofweek"].map(lambda x: dayofweek_dict.get(x))
+        heatmap_df = summarize(main_network_rollup_df, ["dayofweek", "hour"])
+        pivot_df = heatmap_df.pivot(index="dayofweek", columns="hour", values="download_mean")
         fig.add_trace(
             go.Heatmap(
                 z=pivot_df.values,
@@ -213,13 +233,22 @@ class SpeedtestLoggerStatusBarApp(rumps.App):
 
     @rumps.clicked("Export CSV")
     def export_csv(self, _):
-        try:
-            records_df = pd.read_csv("records.csv")
-        except:
-            records_df = pd.read_csv("records_init.csv")
         now = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filepath = f"{self.downloads_dir}/{app_name}_csv_{now}.csv"
-        records_df.to_csv(filepath, index=False)
+        filepath = export_records(
+            self.records_store,
+            f"{self.downloads_dir}/{app_name}_csv_{now}.csv",
+            compression=self.records_config.get("export_compression"),
+            start=self.export_start(),
+        )
+        # Summaries of the latency monitor, if it is enabled
+        latency_filepath = export_latency(
+            self.records_store,
+            f"{self.downloads_dir}/{app_name}_latency_{now}.csv",
+            compression=self.records_config.get("export_compression"),
+            start=self.export_start(),
+        )
+        if latency_filepath is not None:
+            filepath = f"{filepath}, {latency_filepath}"
         time.sleep(0.5)
         rumps.alert(f"Exported as csv successfully: {filepath}")
         logger.info(f"Exported as csv successfully: {filepath}")
@@ -299,8 +328,7 @@ class SpeedtestLoggerStatusBarApp(rumps.App):
             cancel="Cancel",
         )
         if response == 1:
-            if os.path.exists("records.csv"):
-                os.remove("records.csv")
+            self.records_store.erase()
             if os.path.exists("logs.log"):
                 os.remove("logs.log")
             rumps.alert("Erased csv and log files successfully.")
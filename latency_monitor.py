@@ -0,0 +1,197 @@
+import os
+import timeit
+import threading
+from array import array
+from datetime import datetime
+from http.client import HTTPException
+from logging import getLogger
+from speedtest_cli import HTTP_ERRORS, build_http_connection, build_request_path, build_user_agent, percentile
+
+logger = getLogger("speedtester")
+
+
+class RingBuffer:
+    """
+    Fixed-size buffer of the last `size` values. Once full, the oldest value is overwritten.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self.values = array("d", [0.0]) * size
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, value: float):
+        self.values[self.count % self.size] = value
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def sorted(self):
+        return sorted(self.values[:len(self)])
+
+
+class LatencyProbe:
+    """
+    Times GET requests of the latency.txt of a speedtest.net server, as in speedtest_cli.Speedtest.get_best_server,
+    but on one persistent connection. The connection is opened before the timer starts and reopened after a failure,
+    so each probe costs one small request and measures its round trip.
+    """
+    def __init__(self, server: dict, source_address: str = None, timeout: float = 2.0):
+        self.server = server
+        self.url = f"{os.path.dirname(server['url'])}/latency.txt"
+        self.source_address = (source_address, 0) if source_address else None
+        self.timeout = timeout
+        self.headers = {"User-Agent": build_user_agent()}
+        self.connection = None
+        self.probes = 0
+
+    def probe(self):
+        """
+        Round trip time in seconds, or None when the request failed.
+        """
+        self.probes += 1
+        try:
+            if self.connection is None:
+                self.connection = build_http_connection(self.url, self.source_address, self.timeout)
+                self.connection.connect()
+            start = timeit.default_timer()
+            self.connection.request("GET", build_request_path(self.url, bump=self.probes), headers=self.headers)
+            response = self.connection.getresponse()
+            rtt = timeit.default_timer() - start
+            text = response.read()
+        except HTTP_ERRORS + (HTTPException,) as e:
+            logger.debug(f"Latency probe of {self.url} failed: {e!r}")
+            self.close()
+            return None
+        if response.will_close:
+            self.close()
+        if response.status != 200 or text[:9] != b"test=test":
+            return None
+        return rtt
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class LatencyMonitor(threading.Thread):
+    """
+    Probes the latency of a server every `interval` seconds between full tests, and writes a summary of the last
+    `window` round trip times (min/p50/p95/p99/max and jitter, in ms) to the records store every `summary_interval`
+    seconds, with the number of probes and lost probes since the previous summary.
+    records_store only needs append_latency, e.g. a RecordsWriter that commits the summaries with the records.
+
+    get_target() returns (server, wifi_physical_name, connected_vpn) and is called at start and after each summary.
+    The ring buffers are cleared when the server or network changes. No probes are sent while paused() is true,
+    e.g. while a full test is running.
+    """
+    def __init__(self, get_target, records_store, interval: float = 1.0, window: int = 60,
+                 summary_interval: float = 60.0, timeout: float = 2.0, paused=None):
+        super(LatencyMonitor, self).__init__(daemon=True)
+        self.get_target = get_target
+        self.records_store = records_store
+        self.interval = interval
+        self.summary_interval = summary_interval
+        self.timeout = timeout
+        self.paused = paused or (lambda: False)
+        self.rtts = RingBuffer(window)
+        self.deltas = RingBuffer(window)
+        self.last_rtt = None
+        self.probes = 0
+        self.lost = 0
+        self.target = (None, None, None)
+        self.latency_probe = None
+        self.stopped = threading.Event()
+
+    def retarget(self):
+        try:
+            target = self.get_target()
+        except Exception as e:
+            logger.error(f"Caused error in latency monitor: {e}")
+            target = (None, None, None)
+        server = target[0]
+        if server is not None and self.latency_probe is not None and target == self.target:
+            return
+        if self.latency_probe is not None:
+            self.latency_probe.close()
+            self.latency_probe = None
+        self.target = target
+        self.rtts.clear()
+        self.deltas.clear()
+        self.last_rtt = None
+        if server is not None:
+            logger.info(f"Monitoring latency of server {server['id']} ({server.get('host')})")
+            self.latency_probe = LatencyProbe(server, timeout=self.timeout)
+
+    def record(self, rtt):
+        self.probes += 1
+        if rtt is None:
+            self.lost += 1
+            self.last_rtt = None
+            return
+        rtt *= 1000.0
+        self.rtts.append(rtt)
+        if self.last_rtt is not None:
+            self.deltas.append(abs(rtt - self.last_rtt))
+        self.last_rtt = rtt
+
+    def summary(self):
+        server, wifi_physical_name, connected_vpn = self.target
+        rtts = self.rtts.sorted()
+        deltas = self.deltas.sorted()
+        return {
+            "timestamp": f"{datetime.utcnow().isoformat()}Z",
+            "wifi_physical_name": wifi_physical_name,
+            "connected_vpn": connected_vpn,
+            "server_id": server["id"] if server else None,
+            "server_host": server.get("host") if server else None,
+            "probes": self.probes,
+            "lost": self.lost,
+            "rtt_min": rtts[0] if rtts else None,
+            "rtt_p50": percentile(rtts, 50),
+            "rtt_p95": percentile(rtts, 95),
+            "rtt_p99": percentile(rtts, 99),
+            "rtt_max": rtts[-1] if rtts else None,
+            "jitter": sum(deltas) / len(deltas) if deltas else None,
+        }
+
+    def write_summary(self):
+        if self.probes == 0:
+            return
+        summary = self.summary()
+        self.probes = 0
+        self.lost = 0
+        try:
+            self.records_store.append_latency([summary])
+        except Exception as e:
+            logger.error(f"Caused error in latency monitor: {e}")
+
+    def run(self):
+        self.retarget()
+        next_time = timeit.default_timer()
+        summary_time = next_time + self.summary_interval
+        while not self.stopped.is_set():
+            if self.latency_probe is not None and not self.paused():
+                self.record(self.latency_probe.probe())
+            now = timeit.default_timer()
+            if now >= summary_time:
+                self.write_summary()
+                self.retarget()
+                summary_time = now + self.summary_interval
+            next_time = max(next_time + self.interval, now)
+            self.stopped.wait(next_time - now)
+        self.write_summary()
+        if self.latency_probe is not None:
+            self.latency_probe.close()
+
+    def stop(self):
+        """
+        Write the summary of the last probes and stop.
+        """
+        if self.is_alive():
+            self.stopped.set()
+            self.join()
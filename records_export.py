@@ -0,0 +1,69 @@
+import csv
+import bz2
+import gzip
+import lzma
+import shutil
+from records_store import CsvRecordsStore, file_lock
+
+COMPRESSIONS = {
+    "gzip": (gzip.open, ".gz"),
+    "bz2": (bz2.open, ".bz2"),
+    "xz": (lzma.open, ".xz"),
+}
+
+
+def open_export_file(filepath: str, compression: str = None, binary: bool = False):
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}")
+    open_func = open if compression is None else COMPRESSIONS[compression][0]
+    if binary:
+        return open_func(filepath, "wb")
+    return open_func(filepath, "wt", newline="")
+
+
+def export_filepath(filepath: str, compression: str = None):
+    if compression is None or compression not in COMPRESSIONS:
+        return filepath
+    return f"{filepath}{COMPRESSIONS[compression][1]}"
+
+
+def export_records(records_store, filepath: str, compression: str = None, start=None, end=None,
+                   wifi_physical_name=None, connected_vpn=None, chunk_rows: int = 1000):
+    """
+    Export records as csv in chunks of chunk_rows rows, so memory does not grow with the history.
+    Without filters, a csv store is copied as it is (compressed on the fly if compression is given).
+    Returns the path of the exported file.
+    """
+    filepath = export_filepath(filepath, compression)
+    filtered = any(v is not None for v in [start, end, wifi_physical_name, connected_vpn])
+
+    if isinstance(records_store, CsvRecordsStore) and records_store.exists() and not filtered \
+            and records_store.export_columns() == records_store.read_header():
+        with file_lock(records_store.path):
+            if compression is None:
+                shutil.copyfile(records_store.path, filepath)
+            else:
+                with open(records_store.path, "rb") as src, open_export_file(filepath, compression, binary=True) as dst:
+                    shutil.copyfileobj(src, dst)
+        return filepath
+
+    with open_export_file(filepath, compression) as f:
+        writer = csv.writer(f)
+        writer.writerow(records_store.export_columns())
+        for chunk in records_store.iter_chunks(start, end, wifi_physical_name, connected_vpn, chunk_rows=chunk_rows):
+            writer.writerows(chunk)
+    return filepath
+
+
+def export_latency(records_store, filepath: str, compression: str = None, start=None):
+    """
+    Export latency monitor summaries as csv.
+    Returns the path of the exported file, or None when there are no summaries.
+    """
+    latency_df = records_store.read_latency(start)
+    if len(latency_df) == 0:
+        return None
+    filepath = export_filepath(filepath, compression)
+    with open_export_file(filepath, compression) as f:
+        latency_df.to_csv(f, index=False)
+    return filepath
@@ -0,0 +1,124 @@
+import os
+import io
+import csv
+import json
+from logging import getLogger
+
+logger = getLogger("records")
+
+
+def bucket_of(timestamp: str):
+    # Hour buckets are prefixes of the utc isoformat timestamp, e.g. 2023-07-01T12
+    return timestamp[:13]
+
+
+class TimeIndex:
+    """
+    Sidecar index of a records csv file: for each hour bucket, the byte offset of the first line
+    and the byte offset after the last line with a timestamp in that bucket.
+    Records are appended when a measurement finishes and can be slightly out of order,
+    so a range read covers every bucket overlapping the range instead of assuming sorted lines.
+
+    The index remembers the inode and size of the file it covers. Appended bytes are indexed incrementally,
+    and the index is rebuilt when it is missing or the file was rewritten (migration, compaction).
+    """
+    def __init__(self, csv_path: str, path: str = None):
+        self.csv_path = csv_path
+        self.path = path or f"{csv_path}.idx"
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def save(self, index):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.path)
+
+    def is_stale(self, index, stat):
+        return (
+            index is None
+            or index.get("inode") != stat.st_ino
+            or index.get("size", 0) > stat.st_size
+        )
+
+    def update(self):
+        """
+        Index lines appended since the last update, or rebuild the index when it is missing or stale.
+        Returns the index.
+        """
+        if not os.path.exists(self.csv_path):
+            return None
+        stat = os.stat(self.csv_path)
+        index = self.load()
+        if self.is_stale(index, stat):
+            if index is not None:
+                logger.info(f"Rebuilding stale index of {self.csv_path}")
+            index = {"inode": stat.st_ino, "size": 0, "header_size": 0, "timestamp_index": None, "buckets": {}}
+        elif index["size"] == stat.st_size:
+            return index
+
+        with open(self.csv_path, "rb") as f:
+            offset = index["size"]
+            f.seek(offset)
+            if offset == 0:
+                header_line = f.readline()
+                offset = index["header_size"] = len(header_line)
+                header = next(csv.reader(io.StringIO(header_line.decode())))
+                index["timestamp_index"] = header.index("timestamp")
+            buckets = index["buckets"]
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # A line being written. It is indexed by the next update.
+                    break
+                next_offset = offset + len(line)
+                row = next(csv.reader(io.StringIO(line.decode())), [])
+                if len(row) > index["timestamp_index"] and row[index["timestamp_index"]]:
+                    bucket = bucket_of(row[index["timestamp_index"]])
+                    if bucket in buckets:
+                        buckets[bucket][1] = next_offset
+                    else:
+                        buckets[bucket] = [offset, next_offset]
+                offset = next_offset
+            index["size"] = offset
+        self.save(index)
+        return index
+
+    def byte_range(self, start: str = None, end: str = None):
+        """
+        (header_size, first offset, end offset) of the lines which can match [start, end], or None if no line can.
+        Lines inside the range must still be filtered by timestamp.
+        """
+        index = self.update()
+        if index is None:
+            return None
+        ranges = [
+            offsets for bucket, offsets in index["buckets"].items()
+            if (start is None or bucket >= bucket_of(start)) and (end is None or bucket <= bucket_of(end))
+        ]
+        if not ranges:
+            return None
+        return index["header_size"], min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+    def read_bytes(self, start: str = None, end: str = None):
+        """
+        Header line and the lines which can match [start, end], as bytes.
+        """
+        byte_range = self.byte_range(start, end)
+        if byte_range is None:
+            return None
+        header_size, first_offset, end_offset = byte_range
+        with open(self.csv_path, "rb") as f:
+            header = f.read(header_size)
+            f.seek(first_offset)
+            return header + f.read(end_offset - first_offset)
+
+    def erase(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
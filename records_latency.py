@@ -0,0 +1,107 @@
+import os
+import csv
+import pandas as pd
+
+LATENCY_COLUMNS = [
+    "timestamp",
+    "wifi_physical_name",
+    "connected_vpn",
+    "server_id",
+    "server_host",
+    "probes",
+    "lost",
+    "rtt_min",
+    "rtt_p50",
+    "rtt_p95",
+    "rtt_p99",
+    "rtt_max",
+    "jitter",
+]
+
+
+def filter_latency(latency_df, start=None):
+    """
+    start is a utc isoformat timestamp string, compared as a string like record timestamps.
+    """
+    if start is None or len(latency_df) == 0:
+        return latency_df
+    return latency_df[latency_df["timestamp"] >= start].reset_index(drop=True)
+
+
+class CsvLatencyStore:
+    """
+    Latency monitor summaries in a csv file next to csv records, one line per summary.
+    """
+    def __init__(self, path: str = "records_latency.csv"):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path) and os.path.getsize(self.path) > 0
+
+    def append_many(self, rows, fsync: bool = False):
+        write_header = not self.exists()
+        with open(self.path, "a", newline="") as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(LATENCY_COLUMNS)
+            for row in rows:
+                writer.writerow([row.get(c) for c in LATENCY_COLUMNS])
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read(self, start=None):
+        if not self.exists():
+            return pd.DataFrame(columns=LATENCY_COLUMNS)
+        return filter_latency(pd.read_csv(self.path), start)
+
+    def compact(self, cutoff: str):
+        if not self.exists():
+            return 0
+        deleted = 0
+        tmp_path = f"{self.path}.tmp"
+        with open(self.path, "r", newline="") as src, open(tmp_path, "w", newline="") as dst:
+            reader = csv.reader(src)
+            writer = csv.writer(dst)
+            writer.writerow(next(reader))
+            for row in reader:
+                if row[0] and row[0] < cutoff:
+                    deleted += 1
+                    continue
+                writer.writerow(row)
+        os.replace(tmp_path, self.path)
+        return deleted
+
+    def erase(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SqliteLatencyStore:
+    """
+    Latency monitor summaries in a table of the records database, indexed by timestamp.
+    """
+    table = "latency"
+
+    def ensure_schema(self, conn):
+        columns_sql = ", ".join(f'"{c}"' for c in LATENCY_COLUMNS)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} ({columns_sql})")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table}_timestamp ON {self.table} (timestamp)")
+
+    def append_many(self, conn, rows):
+        placeholders = ", ".join("?" for _ in LATENCY_COLUMNS)
+        conn.executemany(
+            f"INSERT INTO {self.table} VALUES ({placeholders})",
+            [[row.get(c) for c in LATENCY_COLUMNS] for row in rows],
+        )
+
+    def read(self, conn, start=None):
+        columns_sql = ", ".join(f'"{c}"' for c in LATENCY_COLUMNS)
+        if start is None:
+            return pd.read_sql_query(f"SELECT {columns_sql} FROM {self.table} ORDER BY timestamp", conn)
+        return pd.read_sql_query(
+            f"SELECT {columns_sql} FROM {self.table} WHERE timestamp >= ? ORDER BY timestamp", conn, params=[start]
+        )
+
+    def compact(self, conn, cutoff: str):
+        return conn.execute(f"DELETE FROM {self.table} WHERE timestamp < ?", (cutoff,)).rowcount
@@ -0,0 +1,129 @@
+"""
+Merge records of many hosts into one records store.
+
+Usage:
+    python records_merge.py -o merged.sqlite3 macbook=records.csv imac=imac/records.sqlite3
+"""
+import os
+import heapq
+import argparse
+from logging import getLogger, config
+import json
+from records_store import RECORDS_COLUMNS, open_records_store
+
+with open('./log_config.json', 'r') as f:
+    log_conf = json.load(f)
+
+config.dictConfig(log_conf)
+logger = getLogger("records")
+
+MERGED_COLUMNS = RECORDS_COLUMNS + (["host_id"] if "host_id" not in RECORDS_COLUMNS else [])
+
+
+def normalize_key_value(value):
+    """
+    pid can be read as "123", 123 or "123.0" depending on the store.
+    """
+    if value is None or value == "":
+        return ""
+    try:
+        number = float(value)
+        if number.is_integer():
+            return str(int(number))
+    except (TypeError, ValueError):
+        pass
+    return str(value)
+
+
+def iter_host_rows(records_store, host_id: str):
+    """
+    Rows of a store as dicts tagged with host_id. Rows merged before keep their host_id.
+    """
+    columns = records_store.export_columns()
+    for row in records_store.iter_rows():
+        row = dict(zip(columns, row))
+        if not row.get("host_id"):
+            row["host_id"] = host_id
+        yield row
+
+
+def sort_within_window(rows, window: int = 256):
+    """
+    Records are appended when a measurement finishes, so they can be slightly out of timestamp order.
+    Sort them with a lookahead heap of `window` rows; memory stays bounded by the window.
+    """
+    heap = []
+    last_timestamp = None
+    for i, row in enumerate(rows):
+        heapq.heappush(heap, (row.get("timestamp") or "", i, row))
+        if len(heap) > window:
+            timestamp, _, row = heapq.heappop(heap)
+            if last_timestamp is not None and timestamp < last_timestamp:
+                raise ValueError(f"Records are out of timestamp order by more than {window} rows at {timestamp}")
+            last_timestamp = timestamp
+            yield row
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def merge_rows(sources, window: int = 256):
+    """
+    k-way merge of (host_id, records_store) sources by timestamp, dropping duplicates of (host_id, timestamp, pid).
+    Duplicates have the same timestamp, so only keys of the current timestamp are kept in memory.
+    """
+    streams = [sort_within_window(iter_host_rows(store, host_id), window) for host_id, store in sources]
+    current_timestamp = None
+    seen_keys = set()
+    for row in heapq.merge(*streams, key=lambda r: r.get("timestamp") or ""):
+        timestamp = row.get("timestamp") or ""
+        if timestamp != current_timestamp:
+            current_timestamp = timestamp
+            seen_keys = set()
+        key = (row["host_id"], timestamp, normalize_key_value(row.get("pid")))
+        if key in seen_keys:
+            continue
+        seen_keys.add(key)
+        yield row
+
+
+def merge_records(sources, output_path: str, batch_rows: int = 1000, window: int = 256):
+    """
+    sources is a list of (host_id, path). Returns the number of merged records.
+    """
+    if os.path.exists(output_path):
+        raise FileExistsError(f"Output already exists: {output_path}")
+    output_store = open_records_store(output_path, columns=MERGED_COLUMNS)
+    columns = output_store.columns
+    sources = [(host_id, open_records_store(path)) for host_id, path in sources]
+
+    merged = 0
+    batch = []
+    for row in merge_rows(sources, window):
+        batch.append({c: (row.get(c) if row.get(c) != "" else None) for c in columns if c in row})
+        if len(batch) >= batch_rows:
+            output_store.append_many(batch)
+            merged += len(batch)
+            batch = []
+    if batch:
+        output_store.append_many(batch)
+        merged += len(batch)
+    logger.info(f"Merged {merged} records from {len(sources)} hosts into {output_path}")
+    return merged
+
+
+def parse_source(text: str):
+    if "=" in text:
+        host_id, path = text.split("=", 1)
+    else:
+        path = text
+        host_id = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+    return host_id, path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge records of many hosts into one records store.")
+    parser.add_argument("sources", nargs="+", help="host_id=path of records (csv, sqlite3 or partition directory)")
+    parser.add_argument("-o", "--output", required=True, help="Output records path (csv, sqlite3 or directory/)")
+    parser.add_argument("--window", type=int, default=256, help="Lookahead rows to reorder each source by timestamp")
+    args = parser.parse_args()
+    merge_records([parse_source(s) for s in args.sources], args.output, window=args.window)
@@ -0,0 +1,235 @@
+import os
+import math
+import sqlite3
+from datetime import datetime, timezone
+import pandas as pd
+
+ROLLUP_METRICS = ["download", "upload", "ping"]
+ROLLUP_STATS = ["count", "sum", "sumsq", "min", "max"]
+ROLLUP_KEYS = ["network", "date", "hour"]
+ROLLUP_COLUMNS = ROLLUP_KEYS + ["records"] + [f"{m}_{s}" for m in ROLLUP_METRICS for s in ROLLUP_STATS]
+
+
+def is_null(value):
+    if value is None:
+        return True
+    if isinstance(value, float) and math.isnan(value):
+        return True
+    if isinstance(value, str) and value == "":
+        return True
+    return False
+
+
+def network_label(wifi_physical_name, connected_vpn):
+    """
+    Network name used in plots: "wifi(vpn)", or "wifi" when no vpn is connected.
+    """
+    if is_null(wifi_physical_name):
+        return None
+    if is_null(connected_vpn):
+        return str(wifi_physical_name)
+    return f"{wifi_physical_name}({connected_vpn})"
+
+
+def parse_timestamp(timestamp):
+    """
+    Parse utc isoformat timestamp of speedtest results (e.g. 2023-07-01T12:34:56.789012Z) to local datetime.
+    """
+    return datetime.fromisoformat(str(timestamp).rstrip("Z")).replace(tzinfo=timezone.utc).astimezone()
+
+
+def rollup_key(row: dict):
+    network = network_label(row.get("wifi_physical_name"), row.get("connected_vpn"))
+    if network is None or is_null(row.get("timestamp")):
+        return None
+    timestamp_local = parse_timestamp(row["timestamp"])
+    return (network, timestamp_local.strftime("%Y-%m-%d"), timestamp_local.hour)
+
+
+def empty_cell():
+    cell = {"records": 0}
+    for m in ROLLUP_METRICS:
+        cell.update({f"{m}_count": 0, f"{m}_sum": 0.0, f"{m}_sumsq": 0.0, f"{m}_min": None, f"{m}_max": None})
+    return cell
+
+
+def add_row_to_cell(cell: dict, row: dict):
+    cell["records"] += 1
+    for m in ROLLUP_METRICS:
+        value = row.get(m)
+        if is_null(value):
+            continue
+        value = float(value)
+        cell[f"{m}_count"] += 1
+        cell[f"{m}_sum"] += value
+        cell[f"{m}_sumsq"] += value * value
+        cell[f"{m}_min"] = value if cell[f"{m}_min"] is None else min(cell[f"{m}_min"], value)
+        cell[f"{m}_max"] = value if cell[f"{m}_max"] is None else max(cell[f"{m}_max"], value)
+    return cell
+
+
+def merge_cells(cell: dict, other: dict):
+    cell["records"] += other["records"]
+    for m in ROLLUP_METRICS:
+        for s in ["count", "sum", "sumsq"]:
+            cell[f"{m}_{s}"] += other[f"{m}_{s}"]
+        for s, f in [("min", min), ("max", max)]:
+            values = [v for v in [cell[f"{m}_{s}"], other[f"{m}_{s}"]] if v is not None]
+            cell[f"{m}_{s}"] = f(values) if values else None
+    return cell
+
+
+def build_cells(rows):
+    cells = {}
+    for row in rows:
+        key = rollup_key(row)
+        if key is None:
+            continue
+        add_row_to_cell(cells.setdefault(key, empty_cell()), row)
+    return cells
+
+
+def cells_to_dataframe(cells: dict):
+    rollup_df = pd.DataFrame(
+        [dict(zip(ROLLUP_KEYS, key), **cell) for key, cell in cells.items()],
+        columns=ROLLUP_COLUMNS,
+    )
+    return rollup_df
+
+
+def filter_rollup(rollup_df, start=None):
+    """
+    start is a utc datetime. Cells are kept from the local date of start.
+    """
+    if start is None or len(rollup_df) == 0:
+        return rollup_df
+    if isinstance(start, str):
+        start = datetime.fromisoformat(start.rstrip("Z"))
+    start_date = start.replace(tzinfo=timezone.utc).astimezone().strftime("%Y-%m-%d")
+    return rollup_df[rollup_df["date"] >= start_date].reset_index(drop=True)
+
+
+def summarize(rollup_df, by):
+    """
+    count/mean/std/min/max of each metric grouped by `by` columns, computed from rollup cells.
+    """
+    aggs = {"records": "sum"}
+    for m in ROLLUP_METRICS:
+        aggs.update({f"{m}_count": "sum", f"{m}_sum": "sum", f"{m}_sumsq": "sum", f"{m}_min": "min", f"{m}_max": "max"})
+    grouped_df = rollup_df.groupby(by).agg(aggs).reset_index()
+    summary_df = grouped_df[by + ["records"]].copy()
+    for m in ROLLUP_METRICS:
+        count = grouped_df[f"{m}_count"]
+        mean = grouped_df[f"{m}_sum"] / count.where(count > 0)
+        var = (grouped_df[f"{m}_sumsq"] - count * mean * mean) / (count - 1).where(count > 1)
+        summary_df[f"{m}_count"] = count
+        summary_df[f"{m}_mean"] = mean
+        summary_df[f"{m}_std"] = var.clip(lower=0) ** 0.5
+        summary_df[f"{m}_min"] = grouped_df[f"{m}_min"]
+        summary_df[f"{m}_max"] = grouped_df[f"{m}_max"]
+    return summary_df
+
+
+class SqliteFileRollupStore:
+    """
+    Rollup cells per (network, local date, hour) in a sqlite file next to csv records.
+    An insert reads and writes only the cells of its rows.
+    """
+    def __init__(self, path: str = "records_rollup.sqlite3", timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self.cells = SqliteRollupStore()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def connect(self, path: str = None):
+        conn = sqlite3.connect(path or self.path, timeout=self.timeout)
+        self.cells.ensure_schema(conn)
+        return conn
+
+    def save_cells(self, cells: dict):
+        """
+        Write all cells into a new file, so an interrupted rebuild never leaves a partial rollup.
+        """
+        tmp_path = f"{self.path}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = self.connect(tmp_path)
+        try:
+            with conn:
+                self.cells.save_cells(conn, cells)
+        finally:
+            conn.close()
+        os.replace(tmp_path, self.path)
+
+    def update(self, rows):
+        conn = self.connect()
+        try:
+            with conn:
+                self.cells.update(conn, rows)
+        finally:
+            conn.close()
+
+    def rebuild(self, rows):
+        self.save_cells(build_cells(rows))
+
+    def read(self, start=None):
+        if not self.exists():
+            return filter_rollup(cells_to_dataframe({}), start)
+        conn = self.connect()
+        try:
+            return self.cells.read(conn, start)
+        finally:
+            conn.close()
+
+    def erase(self):
+        if self.exists():
+            os.remove(self.path)
+
+
+class SqliteRollupStore:
+    """
+    Rollup cells per (network, local date, hour) in a table of the records database.
+    Updated in the same transaction as the inserted records.
+    """
+    table = "rollups"
+
+    def ensure_schema(self, conn):
+        stats_sql = ", ".join(f'"{c}"' for c in ROLLUP_COLUMNS[3:])
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} "
+            f"(network TEXT, date TEXT, hour INTEGER, {stats_sql}, PRIMARY KEY (network, date, hour))"
+        )
+
+    def load_cells(self, conn, keys=None):
+        columns_sql = ", ".join(f'"{c}"' for c in ROLLUP_COLUMNS)
+        query = f"SELECT {columns_sql} FROM {self.table}"
+        if keys is None:
+            results = conn.execute(query).fetchall()
+        else:
+            results = []
+            for key in keys:
+                results += conn.execute(f"{query} WHERE network = ? AND date = ? AND hour = ?", key).fetchall()
+        return {tuple(r[:3]): dict(zip(ROLLUP_COLUMNS[3:], r[3:])) for r in results}
+
+    def save_cells(self, conn, cells: dict):
+        placeholders = ", ".join("?" for _ in ROLLUP_COLUMNS)
+        conn.executemany(
+            f"INSERT OR REPLACE INTO {self.table} VALUES ({placeholders})",
+            [list(key) + [cell[c] for c in ROLLUP_COLUMNS[3:]] for key, cell in cells.items()],
+        )
+
+    def update(self, conn, rows):
+        new_cells = build_cells(rows)
+        cells = self.load_cells(conn, new_cells.keys())
+        for key, cell in new_cells.items():
+            merge_cells(cells.setdefault(key, empty_cell()), cell)
+        self.save_cells(conn, cells)
+
+    def rebuild(self, conn, rows):
+        conn.execute(f"DELETE FROM {self.table}")
+        self.save_cells(conn, build_cells(rows))
+
+    def read(self, conn, start=None):
+        return filter_rollup(cells_to_dataframe(self.load_cells(conn)), start)
@@ -0,0 +1,938 @@
+import os
+import io
+import csv
+import json
+import math
+import fcntl
+import hashlib
+import shutil
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
+from logging import getLogger
+import pandas as pd
+from records_index import TimeIndex
+from records_latency import LATENCY_COLUMNS, CsvLatencyStore, SqliteLatencyStore
+from records_rollup import (
+    ROLLUP_METRICS,
+    SqliteFileRollupStore,
+    SqliteRollupStore,
+    build_cells,
+    cells_to_dataframe,
+    filter_rollup,
+)
+
+logger = getLogger("records")
+
+
+class RecordsSchemaError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def load_records_columns(path="records_init.csv"):
+    """
+    records_init.csv holds the header of records.csv and is the source of the records schema.
+    """
+    with open(path, "r", newline="") as f:
+        return next(csv.reader(f))
+
+
+RECORDS_COLUMNS = load_records_columns()
+
+
+def to_record_value(value):
+    """
+    Convert pandas/numpy scalars into plain python values. Nulls become None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    try:
+        if pd.isnull(value):
+            return None
+    except (TypeError, ValueError):
+        pass
+    if isinstance(value, pd.Timestamp):
+        return str(value)
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+def to_timestamp_string(value):
+    """
+    Timestamps in records are utc isoformat strings (e.g. 2023-07-01T12:34:56.789012Z),
+    so range bounds are converted into the same format and compared as strings.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, pd.Timestamp):
+        value = value.to_pydatetime()
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat()
+
+
+def filter_records(records_df, start=None, end=None, wifi_physical_name=None, connected_vpn=None):
+    start = to_timestamp_string(start)
+    end = to_timestamp_string(end)
+    if start is not None:
+        records_df = records_df[records_df["timestamp"] >= start]
+    if end is not None:
+        records_df = records_df[records_df["timestamp"] <= end]
+    if wifi_physical_name is not None:
+        records_df = records_df[records_df["wifi_physical_name"] == wifi_physical_name]
+    if connected_vpn is not None:
+        records_df = records_df[records_df["connected_vpn"] == connected_vpn]
+    return records_df.reset_index(drop=True)
+
+
+def row_filter(header, start=None, end=None, wifi_physical_name=None, connected_vpn=None):
+    """
+    Predicate on csv rows (lists of strings) with the same conditions as filter_records.
+    """
+    start = to_timestamp_string(start)
+    end = to_timestamp_string(end)
+    timestamp_index = header.index("timestamp")
+    wifi_index = header.index("wifi_physical_name")
+    vpn_index = header.index("connected_vpn")
+
+    def match(row):
+        timestamp = row[timestamp_index]
+        if start is not None and not (timestamp and timestamp >= start):
+            return False
+        if end is not None and not (timestamp and timestamp <= end):
+            return False
+        if wifi_physical_name is not None and row[wifi_index] != wifi_physical_name:
+            return False
+        if connected_vpn is not None and row[vpn_index] != connected_vpn:
+            return False
+        return True
+    return match
+
+
+def read_lines_until(f, end_offset: int):
+    offset = f.tell()
+    for line in f:
+        if offset >= end_offset:
+            break
+        offset += len(line)
+        yield line
+
+
+def chunked(rows, chunk_rows: int):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Advisory lock shared by every process writing to the same records file.
+    """
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class CsvRecordsStore:
+    """
+    Append-only records.csv.
+    A measurement appends a single line, the header is written only when the file is created.
+    Latency monitor summaries are appended to a separate csv file (by default records_latency.csv).
+    """
+    def __init__(self, path: str = "records.csv", columns=None, rollup_path: str = None, latency_path: str = None):
+        self.path = path
+        self.columns = list(columns or RECORDS_COLUMNS)
+        self.rollup = SqliteFileRollupStore(rollup_path) if rollup_path else None
+        self.index = TimeIndex(path)
+        self.latency = CsvLatencyStore(latency_path or f"{os.path.splitext(path)[0]}_latency.csv")
+
+    def exists(self):
+        return os.path.exists(self.path) and os.path.getsize(self.path) > 0
+
+    def read_header(self):
+        if not self.exists():
+            return None
+        with open(self.path, "r", newline="") as f:
+            return next(csv.reader(f), None)
+
+    def ensure_header(self):
+        """
+        Write the header once, and migrate the file once if its header lacks columns of the schema.
+        Returns the column order of the file.
+        """
+        header = self.read_header()
+        if header is None:
+            with open(self.path, "w", newline="") as f:
+                csv.writer(f).writerow(self.columns)
+            return self.columns
+
+        missing_columns = [c for c in self.columns if c not in header]
+        if missing_columns:
+            logger.info(f"Migrating {self.path} header: adding {missing_columns}")
+            new_header = header + missing_columns
+            tmp_path = f"{self.path}.tmp"
+            with open(self.path, "r", newline="") as src, open(tmp_path, "w", newline="") as dst:
+                reader = csv.reader(src)
+                writer = csv.writer(dst)
+                next(reader)
+                writer.writerow(new_header)
+                for row in reader:
+                    writer.writerow(row + [""] * len(missing_columns))
+            os.replace(tmp_path, self.path)
+            header = new_header
+        return header
+
+    def validate_row(self, row: dict, header):
+        unknown_columns = [c for c in row.keys() if c not in header]
+        if unknown_columns:
+            raise RecordsSchemaError(f"Unknown columns for {self.path}: {unknown_columns}")
+
+    def append(self, row: dict):
+        self.append_many([row])
+
+    def append_many(self, rows, fsync: bool = False):
+        """
+        Append rows with one write. With fsync, the rows are flushed to disk before returning.
+        """
+        with file_lock(self.path):
+            header = self.ensure_header()
+            for row in rows:
+                self.validate_row(row, header)
+            with open(self.path, "a", newline="") as f:
+                writer = csv.writer(f)
+                for row in rows:
+                    writer.writerow([to_record_value(row.get(c)) for c in header])
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.index.update()
+            if self.rollup is not None:
+                if self.rollup.exists():
+                    self.rollup.update(rows)
+                else:
+                    self.rollup.rebuild(self.read().to_dict("records"))
+
+    def read(self, start=None, end=None, wifi_physical_name=None, connected_vpn=None):
+        """
+        With start/end, only the lines of the hour buckets overlapping the range are parsed (see TimeIndex).
+        """
+        if not self.exists():
+            return pd.DataFrame(columns=self.columns)
+        if start is None and end is None:
+            records_df = pd.read_csv(self.path)
+        else:
+            # Readers update the index like writers do, so the index is read under the lock of the records file.
+            with file_lock(self.path):
+                data = self.index.read_bytes(to_timestamp_string(start), to_timestamp_string(end))
+            if data is None:
+                return pd.DataFrame(columns=self.export_columns())
+            records_df = pd.read_csv(io.BytesIO(data))
+        missing_columns = [c for c in self.columns if c not in records_df.columns]
+        if missing_columns:
+            records_df = records_df.reindex(columns=list(records_df.columns) + missing_columns)
+        return filter_records(records_df, start, end, wifi_physical_name, connected_vpn)
+
+    def export_columns(self):
+        header = self.read_header() or []
+        return header + [c for c in self.columns if c not in header]
+
+    def iter_rows(self, start=None, end=None, wifi_physical_name=None, connected_vpn=None):
+        """
+        Stream rows (lists of strings, in export_columns order) matching the filters.
+        """
+        if not self.exists():
+            return
+        byte_range = None
+        # The index is updated and the file is opened under the lock, so the offsets match the opened file
+        # even if a compaction replaces it meanwhile.
+        with file_lock(self.path):
+            if start is not None or end is not None:
+                byte_range = self.index.byte_range(to_timestamp_string(start), to_timestamp_string(end))
+                if byte_range is None:
+                    return
+            f = open(self.path, "rb")
+        with f:
+            header = next(csv.reader([f.readline().decode()]))
+            if byte_range is None:
+                lines = f
+            else:
+                _, first_offset, end_offset = byte_range
+                f.seek(first_offset)
+                lines = read_lines_until(f, end_offset)
+            padding = [""] * len([c for c in self.columns if c not in header])
+            match = row_filter(header, start, end, wifi_physical_name, connected_vpn)
+            for row in csv.reader(line.decode() for line in lines):
+                if match(row):
+                    yield row + padding
+
+    def iter_chunks(self, start=None, end=None, wifi_physical_name=None, connected_vpn=None, chunk_rows: int = 1000):
+        return chunked(self.iter_rows(start, end, wifi_physical_name, connected_vpn), chunk_rows)
+
+    def append_latency(self, rows, fsync: bool = False):
+        with file_lock(self.latency.path):
+            self.latency.append_many(rows, fsync=fsync)
+
+    def read_latency(self, start=None):
+        return self.latency.read(to_timestamp_string(start))
+
+    def read_rollup(self, start=None):
+        """
+        Rollup cells per (network, local date, hour). Built from raw records when the rollup file is missing.
+        """
+        if self.rollup is None:
+            return filter_rollup(cells_to_dataframe(build_cells(self.read().to_dict("records"))), start)
+        if not self.rollup.exists() and self.exists():
+            with file_lock(self.path):
+                self.rollup.rebuild(self.read().to_dict("records"))
+        return self.rollup.read(start)
+
+    def compact(self, cutoff):
+        """
+        Delete raw records older than cutoff. They are already counted in the rollups.
+        Without a rollup file the raw records are the only copy, so nothing is deleted.
+        Returns the number of deleted records.
+        """
+        cutoff = to_timestamp_string(cutoff)
+        if self.latency.exists():
+            with file_lock(self.latency.path):
+                self.latency.compact(cutoff)
+        if not self.exists():
+            return 0
+        if self.rollup is None:
+            logger.warning(f"Not compacting {self.path}: records are not folded into rollups without rollup_path")
+            return 0
+        with file_lock(self.path):
+            if not self.rollup.exists():
+                self.rollup.rebuild(self.read().to_dict("records"))
+            return self.delete_before(cutoff)
+
+    def delete_before(self, cutoff: str):
+        """
+        Delete raw records older than cutoff, without folding them into rollups. The caller holds the lock.
+        """
+        deleted = 0
+        tmp_path = f"{self.path}.tmp"
+        with open(self.path, "r", newline="") as src, open(tmp_path, "w", newline="") as dst:
+            reader = csv.reader(src)
+            writer = csv.writer(dst)
+            header = next(reader)
+            writer.writerow(header)
+            timestamp_index = header.index("timestamp")
+            for row in reader:
+                if row[timestamp_index] and row[timestamp_index] < cutoff:
+                    deleted += 1
+                    continue
+                writer.writerow(row)
+        os.replace(tmp_path, self.path)
+        return deleted
+
+    def erase(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.index.erase()
+        if self.rollup is not None:
+            self.rollup.erase()
+        self.latency.erase()
+
+
+class PartitionedCsvRecordsStore:
+    """
+    Records split into monthly (or daily) csv partitions with a manifest of
+    min/max timestamp and row counts per partition.
+    Appends touch only the partition of the row, and reads only open the partitions overlapping the time range.
+    """
+    partition_formats = {
+        "monthly": "%Y-%m",
+        "daily": "%Y-%m-%d",
+    }
+
+    def __init__(self, directory: str = "records", granularity: str = "monthly", columns=None):
+        if granularity not in self.partition_formats:
+            raise ValueError(f"Unknown partition granularity: {granularity}")
+        self.directory = directory
+        self.granularity = granularity
+        self.columns = list(columns or RECORDS_COLUMNS)
+        self.manifest_path = os.path.join(self.directory, "manifest.json")
+        self.rollup = SqliteFileRollupStore(os.path.join(self.directory, "rollup.sqlite3"))
+        self.latency = CsvLatencyStore(os.path.join(self.directory, "latency.csv"))
+
+    def partition_key(self, timestamp: str):
+        # Partition keys are prefixes of the utc isoformat timestamp.
+        length = {"monthly": 7, "daily": 10}[self.granularity]
+        return timestamp[:length]
+
+    def partition_store(self, key: str):
+        return CsvRecordsStore(os.path.join(self.directory, f"records_{key}.csv"), columns=self.columns)
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def load_manifest(self):
+        if not self.exists():
+            return self.rebuild_manifest()
+        with open(self.manifest_path, "r") as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def rebuild_manifest(self):
+        """
+        Scan the partition files. Used when the manifest is missing.
+        """
+        manifest = {"granularity": self.granularity, "partitions": {}}
+        if not os.path.isdir(self.directory):
+            return manifest
+        for filename in sorted(os.listdir(self.directory)):
+            if not (filename.startswith("records_") and filename.endswith(".csv")):
+                continue
+            key = filename[len("records_"):-len(".csv")]
+            timestamps = self.partition_store(key).read()["timestamp"].dropna()
+            if len(timestamps) == 0:
+                continue
+            manifest["partitions"][key] = {
+                "min_timestamp": timestamps.min(),
+                "max_timestamp": timestamps.max(),
+                "rows": int(len(timestamps)),
+            }
+        os.makedirs(self.directory, exist_ok=True)
+        self.save_manifest(manifest)
+        logger.info(f"Rebuilt manifest of {self.directory}: {len(manifest['partitions'])} partitions")
+        return manifest
+
+    def append(self, row: dict):
+        self.append_many([row])
+
+    def append_many(self, rows, fsync: bool = False):
+        rows_by_partition = {}
+        for row in rows:
+            timestamp = to_record_value(row.get("timestamp"))
+            if not timestamp:
+                raise RecordsSchemaError("timestamp is required for partitioned records")
+            rows_by_partition.setdefault(self.partition_key(timestamp), []).append(row)
+
+        os.makedirs(self.directory, exist_ok=True)
+        with file_lock(self.manifest_path):
+            manifest = self.load_manifest()
+            for key, partition_rows in rows_by_partition.items():
+                self.partition_store(key).append_many(partition_rows, fsync=fsync)
+                timestamps = [to_record_value(row["timestamp"]) for row in partition_rows]
+                partition = manifest["partitions"].setdefault(
+                    key, {"min_timestamp": min(timestamps), "max_timestamp": max(timestamps), "rows": 0}
+                )
+                partition["min_timestamp"] = min([partition["min_timestamp"]] + timestamps)
+                partition["max_timestamp"] = max([partition["max_timestamp"]] + timestamps)
+                partition["rows"] += len(partition_rows)
+            self.save_manifest(manifest)
+            if self.rollup.exists():
+                self.rollup.update(rows)
+            else:
+                self.rollup.rebuild(self.read().to_dict("records"))
+
+    def select_partitions(self, start=None, end=None):
+        start = to_timestamp_string(start)
+        end = to_timestamp_string(end)
+        keys = []
+        for key, partition in sorted(self.load_manifest()["partitions"].items()):
+            if start is not None and partition["max_timestamp"] < start:
+                continue
+            if end is not None and partition["min_timestamp"] > end:
+                continue
+            keys.append(key)
+        return keys
+
+    def read(self, start=None, end=None, wifi_physical_name=None, connected_vpn=None):
+        keys = self.select_partitions(start, end)
+        if not keys:
+            return pd.DataFrame(columns=self.columns)
+        records_df = pd.concat([self.partition_store(key).read() for key in keys], axis=0)
+        return filter_records(records_df, start, end, wifi_physical_name, connected_vpn)
+
+    def export_columns(self):
+        columns = list(self.columns)
+        for key in self.load_manifest()["partitions"]:
+            columns += [c for c in self.partition_store(key).export_columns() if c not in columns]
+        return columns
+
+    def iter_rows(self, start=None, end=None, wifi_physical_name=None, connected_vpn=None):
+        columns = self.export_columns()
+        for key in self.select_partitions(start, end):
+            partition_store = self.partition_store(key)
+            partition_columns = partition_store.export_columns()
+            if partition_columns == columns:
+                yield from partition_store.iter_rows(start, end, wifi_physical_name, connected_vpn)
+                continue
+            indexes = [partition_columns.index(c) if c in partition_columns else None for c in columns]
+            for row in partition_store.iter_rows(start, end, wifi_physical_name, connected_vpn):
+                yield [row[i] if i is not None else "" for i in indexes]
+
+    def iter_chunks(self, start=None, end=None, wifi_physical_name=None, connected_vpn=None, chunk_rows: int = 1000):
+        return chunked(self.iter_rows(start, end, wifi_physical_name, connected_vpn), chunk_rows)
+
+    def append_latency(self, rows, fsync: bool = False):
+        os.makedirs(self.directory, exist_ok=True)
+        with file_lock(self.latency.path):
+            self.latency.append_many(rows, fsync=fsync)
+
+    def read_latency(self, start=None):
+        return self.latency.read(to_timestamp_string(start))
+
+    def read_rollup(self, start=None):
+        if not self.rollup.exists() and self.exists():
+            with file_lock(self.manifest_path):
+                self.rollup.rebuild(self.read().to_dict("records"))
+        return self.rollup.read(start)
+
+    def compact(self, cutoff):
+        """
+        Delete partitions older than cutoff, and raw records older than cutoff in the partition containing it.
+        """
+        cutoff = to_timestamp_string(cutoff)
+        if self.latency.exists():
+            with file_lock(self.latency.path):
+                self.latency.compact(cutoff)
+        if not self.exists():
+            return 0
+        deleted = 0
+        with file_lock(self.manifest_path):
+            if not self.rollup.exists():
+                self.rollup.rebuild(self.read().to_dict("records"))
+            manifest = self.load_manifest()
+            for key, partition in sorted(manifest["partitions"].items()):
+                if partition["min_timestamp"] >= cutoff:
+                    continue
+                partition_store = self.partition_store(key)
+                if partition["max_timestamp"] < cutoff:
+                    partition_store.erase()
+                    deleted += partition["rows"]
+                    del manifest["partitions"][key]
+                    continue
+                with file_lock(partition_store.path):
+                    partition_deleted = partition_store.delete_before(cutoff)
+                timestamps = partition_store.read()["timestamp"].dropna()
+                partition["min_timestamp"] = timestamps.min()
+                partition["rows"] -= partition_deleted
+                deleted += partition_deleted
+            self.save_manifest(manifest)
+        return deleted
+
+    def erase(self):
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+
+
+SERVER_MEASUREMENT_COLUMNS = ["server_d", "server_latency"]
+REAL_COLUMNS = ["download", "upload", "ping", "server_d", "server_latency", "elapsed_time"]
+INTEGER_COLUMNS = ["bytes_sent", "bytes_received", "pid"]
+
+
+def dimension_of(column: str):
+    """
+    server_* and client_* columns describe the server/client and are almost the same on every run,
+    so they are interned into dimension tables. server_d and server_latency are measured per run.
+    """
+    if column.startswith("server_") and column not in SERVER_MEASUREMENT_COLUMNS:
+        return "servers"
+    if column.startswith("client_"):
+        return "clients"
+    return None
+
+
+def column_type(column: str):
+    """
+    Declared type of a sqlite column. Measured values written as text (e.g. rows merged from csv records)
+    are stored as numbers; other columns keep values as written.
+    """
+    if column in INTEGER_COLUMNS:
+        return " INTEGER"
+    if column in REAL_COLUMNS or column.endswith(("_p50", "_p95")):
+        return " REAL"
+    return ""
+
+
+def dimension_key(values):
+    if all(v is None for v in values):
+        return None
+    return hashlib.sha1(json.dumps(values, default=str).encode()).hexdigest()[:16]
+
+
+class SqliteRecordsStore:
+    """
+    Records in a sqlite database.
+    Server and client descriptors are interned into the servers/clients dimension tables,
+    and measurements holds measured values with server_key/client_key.
+    The records view joins them back into the flat layout of records.csv.
+    timestamp, wifi_physical_name and connected_vpn are indexed for range and per-network queries,
+    and WAL mode lets the app read while a measurement is being written.
+    Latency monitor summaries are stored in the latency table.
+    """
+    table = "records"
+    fact_table = "measurements"
+    dimension_tables = {"servers": "server_key", "clients": "client_key"}
+    indexed_columns = ["timestamp", "wifi_physical_name", "connected_vpn"]
+
+    def __init__(self, path: str = "records.sqlite3", columns=None, wal: bool = True, timeout: float = 30.0):
+        self.path = path
+        self.columns = list(columns or RECORDS_COLUMNS)
+        self.wal = wal
+        self.timeout = timeout
+        self.rollup = SqliteRollupStore()
+        self.latency = SqliteLatencyStore()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        # Only takes effect on a new database, before any table is created.
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        if self.wal:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        self.ensure_schema(conn)
+        return conn
+
+    def object_type(self, conn, name):
+        result = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+        return result[0] if result else None
+
+    def columns_of(self, conn, table):
+        return [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+
+    def ensure_table(self, conn, table, key_sql, columns):
+        columns_sql = "".join(f', "{c}"{column_type(c)}' for c in columns)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({key_sql}{columns_sql})")
+        table_columns = self.columns_of(conn, table)
+        for c in columns:
+            if c not in table_columns:
+                logger.info(f"Migrating {self.path}: adding column {c} to {table}")
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN "{c}"{column_type(c)}')
+
+    def ensure_schema(self, conn):
+        self.ensure_tables(conn)
+        conn.execute("CREATE TABLE IF NOT EXISTS records_meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.rollup.ensure_schema(conn)
+        self.latency.ensure_schema(conn)
+        conn.commit()
+        if not self.rollup_built(conn):
+            with conn:
+                self.rebuild_rollup(conn)
+
+    def ensure_tables(self, conn):
+        for table, key in self.dimension_tables.items():
+            self.ensure_table(
+                conn, table, f"{key} TEXT PRIMARY KEY", [c for c in self.columns if dimension_of(c) == table]
+            )
+        self.ensure_table(
+            conn,
+            self.fact_table,
+            "record_id INTEGER PRIMARY KEY, server_key TEXT, client_key TEXT",
+            [c for c in self.columns if dimension_of(c) is None],
+        )
+        for c in self.indexed_columns:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{self.fact_table}_{c} ON {self.fact_table} ("{c}")')
+        self.ensure_view(conn)
+
+    def ensure_view(self, conn):
+        """
+        (Re)create the records view when the columns of the underlying tables changed.
+        """
+        sources = {self.fact_table: "m", "servers": "s", "clients": "c"}
+        available = {}
+        for table, alias in sources.items():
+            for c in self.columns_of(conn, table):
+                if c not in ["record_id", "server_key", "client_key"]:
+                    available.setdefault(c, alias)
+        view_columns = [c for c in self.columns if c in available] + [c for c in available if c not in self.columns]
+        if self.object_type(conn, self.table) == "view" and self.columns_of(conn, self.table) == ["record_id"] + view_columns:
+            return
+        select_sql = ", ".join(["m.record_id"] + [f'{available[c]}."{c}" AS "{c}"' for c in view_columns])
+        conn.execute(f"DROP VIEW IF EXISTS {self.table}")
+        conn.execute(
+            f"CREATE VIEW {self.table} AS SELECT {select_sql} FROM {self.fact_table} m "
+            f"LEFT JOIN servers s ON m.server_key = s.server_key "
+            f"LEFT JOIN clients c ON m.client_key = c.client_key"
+        )
+
+    def insert_rows(self, conn, rows):
+        dimension_columns = {
+            table: [c for c in self.columns_of(conn, table) if c != key] for table, key in self.dimension_tables.items()
+        }
+        for row in rows:
+            row = {k: to_record_value(v) for k, v in row.items()}
+            fact = {}
+            dimensions = {table: {} for table in self.dimension_tables}
+            for c, v in row.items():
+                table = dimension_of(c)
+                if table is None:
+                    fact[c] = v
+                else:
+                    dimensions[table][c] = v
+            for table, key in self.dimension_tables.items():
+                columns = dimension_columns[table]
+                values = [dimensions[table].get(c) for c in columns]
+                fact[key] = dimension_key(values)
+                if fact[key] is None:
+                    continue
+                columns_sql = ", ".join([key] + [f'"{c}"' for c in columns])
+                placeholders = ", ".join("?" for _ in range(len(columns) + 1))
+                conn.execute(
+                    f"INSERT OR IGNORE INTO {table} ({columns_sql}) VALUES ({placeholders})", [fact[key]] + values
+                )
+            keys = list(fact.keys())
+            columns_sql = ", ".join(f'"{c}"' for c in keys)
+            placeholders = ", ".join("?" for _ in keys)
+            conn.execute(
+                f"INSERT INTO {self.fact_table} ({columns_sql}) VALUES ({placeholders})", [fact[c] for c in keys]
+            )
+
+    def rollup_built(self, conn):
+        return conn.execute("SELECT value FROM records_meta WHERE key = 'rollup_built'").fetchone() is not None
+
+    def rebuild_rollup(self, conn):
+        columns = ["timestamp", "wifi_physical_name", "connected_vpn"] + ROLLUP_METRICS
+        columns_sql = ", ".join(f'"{c}"' for c in columns)
+        rows = (dict(zip(columns, r)) for r in conn.execute(f"SELECT {columns_sql} FROM {self.fact_table}"))
+        self.rollup.rebuild(conn, rows)
+        conn.execute("INSERT OR REPLACE INTO records_meta VALUES ('rollup_built', '1')")
+
+    def table_columns(self, conn):
+        return [c for c in self.columns_of(conn, self.table) if c != "record_id"]
+
+    def append(self, row: dict):
+        self.append_many([row])
+
+    def append_many(self, rows, fsync: bool = False):
+        """
+        Insert rows in one transaction. With fsync, the WAL is synced on commit (synchronous=FULL).
+        """
+        conn = self.connect()
+        try:
+            if fsync:
+                conn.execute("PRAGMA synchronous=FULL")
+            columns = self.table_columns(conn)
+            for row in rows:
+                unknown_columns = [c for c in row.keys() if c not in columns]
+                if unknown_columns:
+                    raise RecordsSchemaError(f"Unknown columns for {self.path}: {unknown_columns}")
+            with conn:
+                self.insert_rows(conn, rows)
+                self.rollup.update(conn, [{k: to_record_value(v) for k, v in row.items()} for row in rows])
+        finally:
+            conn.close()
+
+    def build_where(self, start=None, end=None, wifi_physical_name=None, connected_vpn=None):
+        conditions = []
+        params = []
+        start = to_timestamp_string(start)
+        end = to_timestamp_string(end)
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("timestamp <= ?")
+            params.append(end)
+        if wifi_physical_name is not None:
+            conditions.append("wifi_physical_name = ?")
+            params.append(wifi_physical_name)
+        if connected_vpn is not None:
+            conditions.append("connected_vpn = ?")
+            params.append(connected_vpn)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        return where, params
+
+    def read(self, start=None, end=None, wifi_physical_name=None, connected_vpn=None):
+        if not self.exists():
+            return pd.DataFrame(columns=self.columns)
+        conn = self.connect()
+        try:
+            columns_sql = ", ".join(f'"{c}"' for c in self.table_columns(conn))
+            where, params = self.build_where(start, end, wifi_physical_name, connected_vpn)
+            return pd.read_sql_query(
+                f"SELECT {columns_sql} FROM {self.table}{where} ORDER BY timestamp", conn, params=params
+            )
+        finally:
+            conn.close()
+
+    def export_columns(self):
+        if not self.exists():
+            return list(self.columns)
+        conn = self.connect()
+        try:
+            return self.table_columns(conn)
+        finally:
+            conn.close()
+
+    def iter_chunks(self, start=None, end=None, wifi_physical_name=None, connected_vpn=None, chunk_rows: int = 1000):
+        """
+        Stream rows matching the filters with fetchmany, chunk_rows rows at a time.
+        """
+        if not self.exists():
+            return
+        conn = self.connect()
+        try:
+            columns_sql = ", ".join(f'"{c}"' for c in self.table_columns(conn))
+            where, params = self.build_where(start, end, wifi_physical_name, connected_vpn)
+            cursor = conn.execute(f"SELECT {columns_sql} FROM {self.table}{where} ORDER BY timestamp", params)
+            while True:
+                chunk = cursor.fetchmany(chunk_rows)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            conn.close()
+
+    def iter_rows(self, start=None, end=None, wifi_physical_name=None, connected_vpn=None):
+        for chunk in self.iter_chunks(start, end, wifi_physical_name, connected_vpn):
+            yield from chunk
+
+    def append_latency(self, rows, fsync: bool = False):
+        conn = self.connect()
+        try:
+            if fsync:
+                conn.execute("PRAGMA synchronous=FULL")
+            with conn:
+                self.latency.append_many(conn, rows)
+        finally:
+            conn.close()
+
+    def read_latency(self, start=None):
+        if not self.exists():
+            return pd.DataFrame(columns=LATENCY_COLUMNS)
+        conn = self.connect()
+        try:
+            return self.latency.read(conn, to_timestamp_string(start))
+        finally:
+            conn.close()
+
+    def read_rollup(self, start=None):
+        if not self.exists():
+            return cells_to_dataframe({})
+        conn = self.connect()
+        try:
+            return self.rollup.read(conn, start)
+        finally:
+            conn.close()
+
+    def compact(self, cutoff):
+        """
+        Delete raw records older than cutoff. They are already counted in the rollups table.
+        The freed pages are returned to the file system, so the database file shrinks.
+        """
+        cutoff = to_timestamp_string(cutoff)
+        if not self.exists():
+            return 0
+        conn = self.connect()
+        try:
+            with conn:
+                deleted = conn.execute(f"DELETE FROM {self.fact_table} WHERE timestamp < ?", (cutoff,)).rowcount
+                self.latency.compact(conn, cutoff)
+                for table, key in self.dimension_tables.items():
+                    conn.execute(
+                        f"DELETE FROM {table} WHERE {key} NOT IN "
+                        f"(SELECT {key} FROM {self.fact_table} WHERE {key} IS NOT NULL)"
+                    )
+            if deleted > 0:
+                self.vacuum(conn)
+            return deleted
+        finally:
+            conn.close()
+
+    def vacuum(self, conn):
+        """
+        Release free pages and truncate the WAL. Databases created before incremental auto_vacuum
+        are converted by a full VACUUM once.
+        """
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            logger.info(f"Converting {self.path} to incremental auto_vacuum")
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        else:
+            # execute() steps the pragma once, which frees a single page. executescript runs it to completion.
+            conn.executescript("PRAGMA incremental_vacuum;")
+        if self.wal:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+    def erase(self):
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(f"{self.path}{suffix}"):
+                os.remove(f"{self.path}{suffix}")
+
+
+def compact_records(records_store, retention_days: int):
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    try:
+        deleted = records_store.compact(cutoff)
+        logger.info(f"Compacted records older than {retention_days} days: deleted {deleted} raw records")
+    except Exception as e:
+        logger.error(f"Caused error in records compaction: {e}")
+
+
+def start_compaction(records_store, retention_days: int):
+    """
+    Run compact_records in a background thread. Returns the thread.
+    """
+    thread = threading.Thread(target=compact_records, args=(records_store, retention_days), daemon=True)
+    thread.start()
+    return thread
+
+
+def load_records_config(path="./app_config.json"):
+    try:
+        with open(path, "r") as f:
+            return json.load(f).get("records", {})
+    except FileNotFoundError:
+        return {}
+
+
+def open_records_store(path: str, columns=None):
+    """
+    Open a records store by path: a directory is a partitioned store, *.sqlite3/*.db a sqlite store,
+    and any other file a csv store.
+    """
+    if os.path.isdir(path) or path.endswith(os.sep):
+        return PartitionedCsvRecordsStore(path, columns=columns)
+    if path.endswith(".sqlite3") or path.endswith(".db"):
+        return SqliteRecordsStore(path, columns=columns)
+    return CsvRecordsStore(path, columns=columns, rollup_path=f"{os.path.splitext(path)[0]}_rollup.sqlite3")
+
+
+def get_records_store(records_config=None):
+    if records_config is None:
+        records_config = load_records_config()
+    backend = records_config.get("backend", "csv")
+    if backend == "csv":
+        return CsvRecordsStore(
+            records_config.get("csv_path", "records.csv"),
+            rollup_path=records_config.get("rollup_path", "records_rollup.sqlite3"),
+            latency_path=records_config.get("latency_path", "records_latency.csv"),
+        )
+    elif backend == "partitioned":
+        return PartitionedCsvRecordsStore(
+            records_config.get("partitions_dir", "records"),
+            granularity=records_config.get("partition_granularity", "monthly"),
+        )
+    elif backend == "sqlite":
+        return SqliteRecordsStore(
+            records_config.get("sqlite_path", "records.sqlite3"),
+            wal=records_config.get("sqlite_wal", True),
+        )
+    else:
+        raise ValueError(f"Unknown records backend: {backend}")
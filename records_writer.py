@@ -0,0 +1,106 @@
+import time
+import queue
+import atexit
+import threading
+from logging import getLogger
+from records_store import get_records_store, load_records_config
+
+logger = getLogger("records")
+
+# Queue items tagged with LATENCY are latency monitor summaries, other items are records.
+LATENCY = "latency"
+
+
+class RecordsWriter(threading.Thread):
+    """
+    The only writer of the records store.
+    Measurement subprocesses put result rows on records_queue, and the writer commits them in groups:
+    a group is committed when batch_size rows are queued or batch_interval seconds passed since its first row,
+    so rows are written in order with one write (and one fsync) per group.
+    Latency monitor summaries are queued with append_latency and committed with the same groups,
+    in a write of their own. When a write fails, its rows are written one at a time,
+    so a row the store rejects (e.g. with an unknown column) does not lose the rest of the group.
+    """
+    def __init__(self, records_store, records_queue, batch_size: int = 16, batch_interval: float = 1.0, fsync: bool = True):
+        super(RecordsWriter, self).__init__(daemon=True)
+        self.records_store = records_store
+        self.records_queue = records_queue
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.fsync = fsync
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            row = self.records_queue.get()
+            if row is None:
+                break
+            batch = [row]
+            deadline = time.time() + self.batch_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    row = self.records_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if row is None:
+                    stopped = True
+                    break
+                batch.append(row)
+            self.commit(batch)
+
+    def commit(self, batch):
+        rows = [item for item in batch if not isinstance(item, tuple)]
+        latency_rows = [item[1] for item in batch if isinstance(item, tuple) and item[0] == LATENCY]
+        if rows:
+            self.write(self.records_store.append_many, rows, "records")
+        if latency_rows:
+            self.write(self.records_store.append_latency, latency_rows, "latency summaries")
+
+    def write(self, append, rows, name: str):
+        try:
+            append(rows, fsync=self.fsync)
+            logger.info(f"Committed {len(rows)} {name}")
+            return
+        except Exception as e:
+            if len(rows) == 1:
+                logger.error(f"Caused error in records writer, dropped {rows[0]}: {e}")
+                return
+            logger.warning(f"Caused error in records writer, committing {len(rows)} {name} one at a time: {e}")
+        committed = 0
+        for row in rows:
+            try:
+                append([row], fsync=self.fsync)
+                committed += 1
+            except Exception as e:
+                logger.error(f"Caused error in records writer, dropped {row}: {e}")
+        logger.info(f"Committed {committed} of {len(rows)} {name}")
+
+    def append_latency(self, rows):
+        for row in rows:
+            self.records_queue.put((LATENCY, row))
+
+    def stop(self):
+        """
+        Commit queued rows and stop.
+        """
+        if self.is_alive():
+            self.records_queue.put(None)
+            self.join()
+
+
+def start_records_writer(records_queue, records_config=None):
+    if records_config is None:
+        records_config = load_records_config()
+    records_writer = RecordsWriter(
+        get_records_store(records_config),
+        records_queue,
+        batch_size=records_config.get("writer_batch_size", 16),
+        batch_interval=records_config.get("writer_batch_interval", 1.0),
+        fsync=records_config.get("fsync", True),
+    )
+    records_writer.start()
+    atexit.register(records_writer.stop)
+    return records_writer
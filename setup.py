@@ -12,8 +12,17 @@ DATA_FILES = [
     "icon.png",
     "records_init.csv",
     "speedtester.py",
+    "records_store.py",
+    "records_rollup.py",
+    "records_index.py",
+    "records_writer.py",
+    "records_export.py",
     "log_config.json",
-    "speedtest_cli.py"
+    "app_config.json",
+    "speedtest_cli.py",
+    "speedtest_async.py",
+    "latency_monitor.py",
+    "records_latency.py"
 ]
 OPTIONS = {
     'iconfile':"app.icns",
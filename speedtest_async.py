@@ -0,0 +1,604 @@
+import ssl
+import gzip
+import socket
+import asyncio
+import timeit
+from array import array
+from collections import deque
+from logging import getLogger
+from urllib.parse import urlparse
+from speedtest_cli import (
+    CONFIG_URL,
+    SAMPLE_INTERVAL,
+    SERVERS_URLS,
+    ConfigRetrievalError,
+    ConnectionTimings,
+    FakeShutdownEvent,
+    InvalidServerIDType,
+    NoMatchedServers,
+    PROBE_FAILURE,
+    RESOLVER,
+    ServerHistory,
+    ServersRetrievalError,
+    SpeedtestBestServerFailure,
+    SpeedtestCache,
+    SpeedtestHTTPError,
+    SpeedtestResults,
+    build_opener,
+    build_request_path,
+    build_user_agent,
+    closest_servers,
+    event_is_set,
+    group_servers,
+    get_upload_payload,
+    parse_config,
+    parse_servers,
+    servers_cache_name,
+    steady_throughput,
+    throughput_converged,
+)
+
+logger = getLogger("speedtester")
+
+READ_SIZE = 65536
+WRITE_SIZE = 65536
+MAX_REDIRECTS = 5
+
+
+class AsyncHTTPError(SpeedtestHTTPError):
+    """Malformed or unexpected HTTP response"""
+
+
+ASYNC_HTTP_ERRORS = (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError, AsyncHTTPError)
+
+
+def absolute_url(url: str, secure: bool = False):
+    # Urls of speedtest.net without scheme (e.g. ://www.speedtest.net/...) use https only when secure
+    if url.startswith(":"):
+        return f"{'https' if secure else 'http'}{url}"
+    return url
+
+
+class AsyncHTTPConnection:
+    """
+    HTTP/1.1 keep-alive connection on non-blocking asyncio streams.
+    Only what speedtest servers need: GET/POST, Content-Length, chunked and read-until-close bodies.
+    Name resolution, TCP connect, TLS handshake and time to first byte are added to timings, like
+    speedtest_cli.SpeedtestHTTPConnection.
+    """
+    def __init__(self, url: str, timeout: float = 10, source_address: str = None,
+                 timings: ConnectionTimings = None):
+        urlparts = urlparse(url)
+        self.secure = urlparts.scheme == "https"
+        self.host = urlparts.hostname
+        self.port = urlparts.port or (443 if self.secure else 80)
+        self.netloc = urlparts.netloc
+        self.timeout = timeout
+        self.source_address = source_address
+        self.timings = timings
+        self.reader = None
+        self.writer = None
+        self.headers = {
+            "User-Agent": build_user_agent(),
+            "Cache-Control": "no-cache",
+        }
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    def add_timing(self, phase: str, start: float):
+        if self.timings is not None:
+            self.timings.add(phase, timeit.default_timer() - start)
+
+    async def open_socket(self, deadline: float):
+        """
+        Resolve the host through speedtest_cli.RESOLVER and connect a non-blocking socket
+        to the first address that accepts. Only cache misses are resolved in the executor, and timed as dns.
+        """
+        loop = asyncio.get_event_loop()
+        addresses = RESOLVER.cached(self.host, self.port)
+        if addresses is None:
+            addresses = await asyncio.wait_for(
+                loop.run_in_executor(
+                    None, RESOLVER.getaddrinfo, self.host, self.port, 0, socket.SOCK_STREAM, self.timings
+                ),
+                self.read_timeout(deadline),
+            )
+        error = OSError("getaddrinfo returns an empty list")
+        for family, socktype, proto, _, address in addresses:
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.setblocking(False)
+                if self.source_address:
+                    sock.bind((self.source_address, 0))
+                start = timeit.default_timer()
+                await asyncio.wait_for(loop.sock_connect(sock, address), self.read_timeout(deadline))
+                self.add_timing("connect", start)
+                return sock
+            except asyncio.TimeoutError:
+                sock.close()
+                raise
+            except OSError as e:
+                sock.close()
+                error = e
+        raise error
+
+    async def connect(self):
+        deadline = timeit.default_timer() + self.timeout
+        sock = await self.open_socket(deadline)
+        ssl_context = ssl.create_default_context() if self.secure else None
+        start = timeit.default_timer()
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                sock=sock, ssl=ssl_context, server_hostname=self.host if self.secure else None
+            ),
+            self.read_timeout(deadline),
+        )
+        if self.secure:
+            self.add_timing("tls", start)
+        sock = self.writer.get_extra_info("socket")
+        if sock is not None:
+            # Requests on a reused connection are written as separate small segments (headers, then body)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    def read_timeout(self, deadline=None):
+        if deadline is None:
+            return self.timeout
+        remaining = deadline - timeit.default_timer()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        return min(self.timeout, remaining)
+
+    async def read(self, n: int, deadline=None):
+        timeout = self.read_timeout(deadline)
+        return await asyncio.wait_for(self.reader.read(n), timeout)
+
+    async def readline(self, deadline=None):
+        timeout = self.read_timeout(deadline)
+        return await asyncio.wait_for(self.reader.readline(), timeout)
+
+    async def drain(self, deadline=None):
+        timeout = self.read_timeout(deadline)
+        await asyncio.wait_for(self.writer.drain(), timeout)
+
+    async def send_head(self, method: str, path: str, headers: dict = None):
+        if not self.connected:
+            await self.connect()
+        all_headers = {"Host": self.netloc, "Connection": "keep-alive"}
+        all_headers.update(self.headers)
+        all_headers.update(headers or {})
+        lines = [f"{method} {path} HTTP/1.1"] + [f"{k}: {v}" for k, v in all_headers.items()]
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def read_head(self, deadline=None):
+        """
+        Status code and lower-cased headers of the response.
+        """
+        status_line = await self.readline(deadline)
+        if not status_line:
+            raise EOFError("Connection closed by server")
+        try:
+            version, status = status_line.decode("latin-1").split(None, 2)[:2]
+            status = int(status)
+        except ValueError:
+            raise AsyncHTTPError(f"Bad status line: {status_line!r}")
+        headers = {}
+        while True:
+            line = await self.readline(deadline)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if version == "HTTP/1.0" or headers.get("connection", "").lower() == "close":
+            headers["connection"] = "close"
+        return status, headers
+
+    async def request(self, method: str, path: str, headers: dict = None, body: bytes = None, deadline=None):
+        headers = dict(headers or {})
+        if body is not None:
+            headers["Content-Length"] = str(len(body))
+        await self.send_head(method, path, headers)
+        if body is not None:
+            self.writer.write(body)
+        await self.drain(deadline)
+        sent = timeit.default_timer()
+        status, headers = await self.read_head(deadline)
+        self.add_timing("ttfb", sent)
+        return status, headers
+
+    async def iter_body(self, headers: dict, deadline=None):
+        """
+        Yield chunks of the response body. A read still pending at deadline raises asyncio.TimeoutError.
+        The connection is closed after a body that ends with the connection.
+        """
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await self.readline(deadline)
+                try:
+                    size = int(size_line.split(b";")[0], 16)
+                except ValueError:
+                    raise AsyncHTTPError(f"Bad chunk size: {size_line!r}")
+                if size == 0:
+                    # Trailers end with an empty line
+                    while await self.readline(deadline) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                while size > 0:
+                    chunk = await self.read(min(size, READ_SIZE), deadline)
+                    if not chunk:
+                        raise EOFError("Connection closed in chunked body")
+                    size -= len(chunk)
+                    yield chunk
+                await self.readline(deadline)
+        elif "content-length" in headers:
+            remaining = int(headers["content-length"])
+            while remaining > 0:
+                chunk = await self.read(min(remaining, READ_SIZE), deadline)
+                if not chunk:
+                    raise EOFError("Connection closed in body")
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            while True:
+                chunk = await self.read(READ_SIZE, deadline)
+                if not chunk:
+                    break
+                yield chunk
+            headers["connection"] = "close"
+        if headers.get("connection") == "close":
+            self.close()
+
+    async def read_body(self, headers: dict, deadline=None):
+        return b"".join([chunk async for chunk in self.iter_body(headers, deadline)])
+
+
+async def fetch(url: str, timeout: float = 10, source_address: str = None, headers: dict = None,
+                timings: ConnectionTimings = None):
+    """
+    GET url on a new connection, following redirects. Returns the status code, the headers and the decoded body.
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        connection = AsyncHTTPConnection(url, timeout, source_address, timings)
+        try:
+            status, response_headers = await connection.request("GET", build_request_path(url), headers)
+            body = await connection.read_body(response_headers)
+        finally:
+            connection.close()
+        if status in (301, 302, 303, 307, 308) and "location" in response_headers:
+            url = response_headers["location"]
+            logger.debug(f"Redirected to {url}")
+            continue
+        if response_headers.get("content-encoding") == "gzip":
+            body = gzip.decompress(body)
+        return status, response_headers, body
+    raise AsyncHTTPError(f"Too many redirects: {url}")
+
+
+class AsyncSpeedtest:
+    """
+    speedtest.net test on asyncio: config, server list, latency probing, download and upload
+    run on non-blocking sockets in a single thread.
+    Download and upload use a fixed number of keep-alive streams (the thread counts of the speedtest.net
+    config by default), connected before the timer starts. Results are a speedtest_cli.SpeedtestResults.
+    """
+    def __init__(self, config: dict = None, source_address: str = None, timeout: float = 10, secure: bool = False,
+                 streams: int = None, shutdown_event=None, adaptive: bool = False, cache: SpeedtestCache = None,
+                 history: ServerHistory = None):
+        self.config = {}
+        self._config_override = config
+        self._source_address = source_address
+        self._timeout = timeout
+        self._secure = secure
+        self._streams = streams
+        self._adaptive = adaptive
+        self._cache = cache
+        self._history = history
+        self._shutdown_event = shutdown_event or FakeShutdownEvent()
+        self.lat_lon = None
+        self.servers = {}
+        self.closest = []
+        self.best = {}
+        self.results = None
+        self.timings = ConnectionTimings()
+        self.transferred = 0
+        self.converged = False
+
+    def new_connection(self, url: str):
+        return AsyncHTTPConnection(url, self._timeout, self._source_address, self.timings)
+
+    async def fetch(self, url: str, cached: dict = None):
+        headers = SpeedtestCache.conditional_headers(cached)
+        headers["Accept-Encoding"] = "gzip"
+        return await fetch(absolute_url(url, self._secure), self._timeout, self._source_address, headers, self.timings)
+
+    async def get_config(self):
+        cached = self._cache.get("config") if self._cache is not None else None
+        if cached is not None and self._cache.is_fresh(cached):
+            configxml = cached["data"].encode()
+        else:
+            try:
+                status, headers, configxml = await self.fetch(CONFIG_URL, cached)
+                if status == 304 and cached is not None:
+                    self._cache.touch("config", cached)
+                    configxml = cached["data"].encode()
+                elif status != 200:
+                    raise ConfigRetrievalError(f"HTTP {status}")
+                elif self._cache is not None:
+                    self._cache.put("config", configxml.decode(), headers)
+            except ASYNC_HTTP_ERRORS + (ConfigRetrievalError,) as e:
+                if cached is None:
+                    raise ConfigRetrievalError(e)
+                logger.debug(f"Using expired cached configuration: {e!r}")
+                configxml = cached["data"].encode()
+
+        config, self.lat_lon = parse_config(configxml)
+        self.config.update(config)
+        if self._config_override is not None:
+            self.config.update(self._config_override)
+
+        self.results = SpeedtestResults(
+            client=self.config["client"],
+            opener=build_opener(self._source_address, self._timeout),
+            secure=self._secure,
+            timings=self.timings,
+        )
+        return self.config
+
+    async def get_servers(self, servers: list = None, exclude: list = None):
+        try:
+            servers = [int(s) for s in servers or []]
+            exclude = [int(s) for s in exclude or []]
+        except ValueError as e:
+            raise InvalidServerIDType(f"{e}, must be int")
+
+        self.servers.clear()
+        cache_name = servers_cache_name(self.config["client"], self.lat_lon, servers, exclude)
+        cached = self._cache.get(cache_name) if self._cache is not None else None
+        if cached is not None and self._cache.is_fresh(cached):
+            self.servers.update(group_servers(cached["data"]))
+            return self.servers
+
+        for url in SERVERS_URLS:
+            try:
+                status, headers, serversxml = await self.fetch(
+                    f"{url}?threads={self.config['threads']['download']}",
+                    cached if cached is not None and cached["url"] == url else None,
+                )
+                if status == 304 and cached is not None:
+                    self._cache.touch(cache_name, cached)
+                    self.servers.update(group_servers(cached["data"]))
+                    return self.servers
+                if status != 200:
+                    raise ServersRetrievalError()
+                self.servers.update(parse_servers(
+                    serversxml, self.lat_lon, self.config["ignore_servers"], servers=servers, exclude=exclude
+                ))
+                if self._cache is not None and self.servers:
+                    self._cache.put(cache_name, [s for d in self.servers.values() for s in d], headers, url)
+                break
+            except ASYNC_HTTP_ERRORS + (ServersRetrievalError,) as e:
+                logger.debug(f"Cannot retrieve {url}: {e!r}")
+                continue
+
+        if not self.servers and cached is not None:
+            logger.debug("Using expired cached server list")
+            self.servers.update(group_servers(cached["data"]))
+
+        if (servers or exclude) and not self.servers:
+            raise NoMatchedServers()
+        return self.servers
+
+    def get_closest_servers(self, limit: int = 5):
+        self.closest = closest_servers(self.servers, limit)
+        return self.closest
+
+    async def probe_latency(self, server: dict, probes: int = 3):
+        """
+        Latency (ms) of `probes` latency.txt requests on new connections, same as speedtest_cli.
+        Failed requests count as PROBE_FAILURE seconds.
+        """
+        latency_url = f"{server['url'].rsplit('/', 1)[0]}/latency.txt"
+        cum = []
+        for i in range(probes):
+            connection = self.new_connection(latency_url)
+            start = timeit.default_timer()
+            try:
+                status, headers = await connection.request("GET", build_request_path(latency_url, bump=i))
+                total = timeit.default_timer() - start
+                text = await connection.read_body(headers)
+                cum.append(total if status == 200 and text[:9] == b"test=test" else PROBE_FAILURE)
+            except ASYNC_HTTP_ERRORS as e:
+                logger.debug(f"Latency probe of {latency_url} failed: {e!r}")
+                cum.append(PROBE_FAILURE)
+            finally:
+                connection.close()
+        return round((sum(cum) / (2 * probes)) * 1000.0, 3)
+
+    async def get_best_server(self, servers: list = None):
+        """
+        Probe the closest servers concurrently and pick the one with the lowest latency.
+        """
+        selected = servers
+        if not servers:
+            servers = self.closest or self.get_closest_servers()
+        if not servers:
+            raise SpeedtestBestServerFailure("Unable to connect to servers to test latency.")
+        latencies = await asyncio.gather(*(self.probe_latency(server) for server in servers))
+        latency, best = min(zip(latencies, range(len(servers))))
+        best = dict(servers[best], latency=latency)
+
+        self.results.ping = latency
+        self.results.server = best
+        self.best = best
+        logger.debug(f"Best Server: {best!r}")
+        if self._history is not None and not selected:
+            self._history.select(best)
+        return best
+
+    async def get_sticky_server(self, servers: list = None, exclude: list = None):
+        """
+        Reuse the last best server of the history after a single latency probe.
+        None when a new selection is due or its latency drifted, see speedtest_cli.ServerHistory.
+        """
+        if self._history is None:
+            return None
+        server = self._history.sticky_server(servers, exclude)
+        if server is None:
+            return None
+        latency = await self.probe_latency(server, probes=1)
+        if self._history.drifted(server, latency):
+            logger.debug(f"Latency of server {server['id']} failed or drifted to {latency} ms")
+            return None
+        best = dict(server, latency=latency)
+
+        self.results.ping = latency
+        self.results.server = best
+        self.best = best
+        logger.debug(f"Sticky Server: {best!r}")
+        return best
+
+    def in_time(self, deadline):
+        return timeit.default_timer() < deadline and not self.converged and not event_is_set(self._shutdown_event)
+
+    async def sample_throughput(self, samples: array, start: float, interval: float = SAMPLE_INTERVAL):
+        next_time = start + interval
+        while True:
+            await asyncio.sleep(max(0, next_time - timeit.default_timer()))
+            samples.append(self.transferred)
+            next_time += interval
+            if self._adaptive and not self.converged and throughput_converged(samples, interval):
+                logger.debug(f"Throughput converged after {len(samples) * interval:.1f} s")
+                self.converged = True
+
+    async def run_streams(self, stream, jobs: list, streams: int, length: float):
+        """
+        Run jobs on `streams` keep-alive connections to the best server, connected before the timer starts.
+        Returns the total bytes transferred, the start and stop times and the cumulative bytes
+        sampled every SAMPLE_INTERVAL seconds.
+        """
+        jobs = deque(jobs)
+        connections = [self.new_connection(self.best["url"]) for _ in range(min(streams, len(jobs)))]
+        results = await asyncio.gather(*(c.connect() for c in connections), return_exceptions=True)
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
+                logger.debug(f"Cannot connect to {self.best['url']}: {result!r}")
+                connection.close()
+
+        self.transferred = 0
+        self.converged = False
+        samples = array("d")
+        start = timeit.default_timer()
+        sampler = asyncio.ensure_future(self.sample_throughput(samples, start))
+        await asyncio.gather(*(stream(c, jobs, start + length) for c in connections))
+        stop = timeit.default_timer()
+        sampler.cancel()
+        return self.transferred, start, stop, samples
+
+    async def download_stream(self, connection: AsyncHTTPConnection, jobs: deque, deadline: float):
+        try:
+            while jobs and self.in_time(deadline):
+                path = jobs.popleft()
+                try:
+                    status, headers = await connection.request("GET", path, deadline=deadline)
+                    async for chunk in connection.iter_body(headers, deadline):
+                        self.transferred += len(chunk)
+                        if not self.in_time(deadline):
+                            # The rest of the body is not read, so the connection can not be reused
+                            connection.close()
+                            break
+                except ASYNC_HTTP_ERRORS:
+                    # Cut off at the deadline or failed: the connection can not be reused
+                    connection.close()
+        finally:
+            connection.close()
+
+    async def upload_stream(self, connection: AsyncHTTPConnection, jobs: deque, deadline: float):
+        try:
+            while jobs and self.in_time(deadline):
+                path, payload = jobs.popleft()
+                try:
+                    await connection.send_head("POST", path, {
+                        "Content-Length": str(len(payload)),
+                        "Content-Type": "application/x-www-form-urlencoded",
+                    })
+                    for offset in range(0, len(payload), WRITE_SIZE):
+                        if not self.in_time(deadline):
+                            raise asyncio.TimeoutError()
+                        chunk = payload[offset:offset + WRITE_SIZE]
+                        connection.writer.write(chunk)
+                        await connection.drain(deadline)
+                        self.transferred += len(chunk)
+                    status, headers = await connection.read_head(deadline)
+                    await connection.read_body(headers, deadline)
+                except ASYNC_HTTP_ERRORS:
+                    connection.close()
+        finally:
+            connection.close()
+
+    async def download(self, streams: int = None):
+        url = self.best["url"].rsplit("/", 1)[0]
+        jobs = [
+            build_request_path(f"{url}/random{size}x{size}.jpg", bump=i)
+            for i, size in enumerate(
+                size for size in self.config["sizes"]["download"] for _ in range(self.config["counts"]["download"])
+            )
+        ]
+        streams = streams or self._streams or self.config["threads"]["download"]
+        self.results.bytes_received, start, stop, self.results.download_samples = await self.run_streams(
+            self.download_stream, jobs, streams, self.config["length"]["download"]
+        )
+        self.results.download = (self.results.bytes_received / (stop - start)) * 8.0
+        self.results.download_steady = steady_throughput(self.results.download_samples)
+        if self.results.download > 100000:
+            self.config["threads"]["upload"] = 8
+        return self.results.download
+
+    async def upload(self, streams: int = None):
+        sizes = [size for size in self.config["sizes"]["upload"] for _ in range(self.config["counts"]["upload"])]
+        get_upload_payload(max(sizes))
+        jobs = [
+            (build_request_path(self.best["url"], bump=i), get_upload_payload(size))
+            for i, size in enumerate(sizes[:self.config["upload_max"]])
+        ]
+        streams = streams or self._streams or self.config["threads"]["upload"]
+        self.results.bytes_sent, start, stop, self.results.upload_samples = await self.run_streams(
+            self.upload_stream, jobs, streams, self.config["length"]["upload"]
+        )
+        self.results.upload = (self.results.bytes_sent / (stop - start)) * 8.0
+        self.results.upload_steady = steady_throughput(self.results.upload_samples)
+        return self.results.upload
+
+    async def run(self, servers: list = None, exclude: list = None, download: bool = True, upload: bool = True):
+        await self.get_config()
+        if await self.get_sticky_server(servers, exclude) is None:
+            await self.get_servers(servers, exclude)
+            await self.get_best_server()
+        if download:
+            await self.download()
+        if upload:
+            await self.upload()
+        if self._history is not None:
+            self._history.record(self.results)
+        return self.results
+
+
+def run_speedtest(source_address: str = None, timeout: float = 10, secure: bool = False, streams: int = None,
+                  servers: list = None, exclude: list = None, adaptive: bool = False, cache: SpeedtestCache = None,
+                  history: ServerHistory = None):
+    """
+    Run the full test on a new event loop and return the results json, like speedtest_cli.shell().
+    """
+    speedtest = AsyncSpeedtest(
+        source_address=source_address, timeout=timeout, secure=secure, streams=streams, adaptive=adaptive,
+        cache=cache, history=history,
+    )
+    results = asyncio.run(speedtest.run(servers, exclude))
+    logger.info(results.json())
+    return results.json()
@@ -27,7 +27,9 @@ import socket
 import sys
 import threading
 import timeit
+import heapq
 import xml.parsers.expat
+from array import array
 
 try:
     import gzip
@@ -36,6 +38,16 @@ except ImportError:
     gzip = None
     GZIP_BASE = object
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 __version__ = '2.1.4b1'
 
 ##### NOTE: This code was added for this application, with some print statements rewritten for logger output
@@ -47,6 +59,54 @@ config.dictConfig(log_conf)
 logger = getLogger("speedtester")
 #####
 
+CONFIG_URL = '://www.speedtest.net/speedtest-config.php'
+
+SERVERS_URLS = [
+    '://www.speedtest.net/speedtest-servers-static.php',
+    'http://c.speedtest.net/speedtest-servers-static.php',
+    '://www.speedtest.net/speedtest-servers.php',
+    'http://c.speedtest.net/speedtest-servers.php',
+]
+
+UPLOAD_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+DOWNLOAD_CHUNK_SIZE = 65536
+
+# Throughput is sampled every SAMPLE_INTERVAL seconds. The steady state
+# throughput leaves out the first RAMP_UP_FRACTION of the samples (TCP slow
+# start, threads starting) and the last TAIL_FRACTION (last requests finishing)
+SAMPLE_INTERVAL = 0.1
+RAMP_UP_FRACTION = 0.2
+TAIL_FRACTION = 0.1
+
+# In adaptive mode a phase ends once it ran ADAPTIVE_MIN_DURATION seconds and
+# the 95% confidence interval of the throughput of the last ADAPTIVE_WINDOW
+# samples is within ADAPTIVE_THRESHOLD of its mean
+ADAPTIVE_MIN_DURATION = 3.0
+ADAPTIVE_WINDOW = 20
+ADAPTIVE_THRESHOLD = 0.05
+
+# The server list is read and parsed SERVERS_CHUNK_SIZE bytes at a time,
+# and distances are computed for DISTANCE_BATCH_SIZE servers at a time
+SERVERS_CHUNK_SIZE = 16384
+DISTANCE_BATCH_SIZE = 1024
+
+# The server history keeps the last HISTORY_SIZE results of each server. A
+# reused server is reselected when its latency is more than the drift
+# threshold above its median, and at least HISTORY_MIN_DRIFT ms above it
+HISTORY_SIZE = 20
+HISTORY_MIN_DRIFT = 5.0
+
+# A failed latency probe counts as PROBE_FAILURE seconds
+PROBE_FAILURE = 3600
+
+# Phases of the connections and requests timed by ConnectionTimings
+CONNECTION_PHASES = ('dns', 'connect', 'tls', 'ttfb')
+
+# Seconds name resolutions are reused by the ResolverCache
+DNS_CACHE_TTL = 300
+
+
 class FakeShutdownEvent(object):
     """Class to fake a threading.Event.isSet so that users of this module
     are not required to register their own threading.Event()
@@ -118,9 +178,9 @@ except ImportError:
     FakeSocket = None
 
 try:
-    from Queue import Queue
+    from Queue import Queue, Empty
 except ImportError:
-    from queue import Queue
+    from queue import Queue, Empty
 
 try:
     from urlparse import urlparse
@@ -381,8 +441,84 @@ class SpeedtestMissingBestServer(SpeedtestException):
     """get_best_server not called or not able to determine best server"""
 
 
+class ResolverCache(object):
+    """Process-level cache of ``socket.getaddrinfo`` results, shared by all
+    the connections of ``speedtest_cli``
+
+    Results are reused for ``ttl`` seconds, and concurrent lookups of the
+    same host wait for a single resolution. A host pinned to an address is
+    never resolved: connections go to that address, while TLS still
+    verifies the host name. Only actual resolutions are added as ``dns``
+    to ``timings``, not cache hits
+    """
+
+    def __init__(self, ttl=DNS_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._key_locks = {}
+        self._pinned = {}
+
+    def pin(self, host, address):
+        self._pinned[host.lower()] = address
+
+    def unpin(self, host):
+        self._pinned.pop(host.lower(), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def cached(self, host, port, family=0, socktype=socket.SOCK_STREAM):
+        """Return the cached addresses of ``host``, or ``None``"""
+        if host.lower() in self._pinned:
+            return self.getaddrinfo(host, port, family, socktype)
+        with self._lock:
+            entry = self._entries.get((host.lower(), port, family, socktype))
+        if entry is not None and entry[0] > timeit.default_timer():
+            return entry[1]
+        return None
+
+    def getaddrinfo(self, host, port, family=0, socktype=socket.SOCK_STREAM,
+                    timings=None):
+        pinned = self._pinned.get(host.lower())
+        if pinned is not None:
+            return socket.getaddrinfo(pinned, port, family, socktype, 0,
+                                      socket.AI_NUMERICHOST)
+
+        key = (host.lower(), port, family, socktype)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            addresses = self.cached(host, port, family, socktype)
+            if addresses is not None:
+                return addresses
+            start = timeit.default_timer()
+            addresses = socket.getaddrinfo(host, port, family, socktype)
+            if timings is not None:
+                timings.add('dns', timeit.default_timer() - start)
+            with self._lock:
+                self._entries[key] = (timeit.default_timer() + self.ttl,
+                                      addresses)
+            return addresses
+
+    def prefetch(self, url, timings=None):
+        """Resolve the host of ``url`` ahead of its connections"""
+        urlparts = urlparse(url)
+        port = urlparts.port or (443 if urlparts.scheme == 'https' else 80)
+        try:
+            self.getaddrinfo(urlparts.hostname, port, timings=timings)
+        except socket.error:
+            e = get_exception()
+            printer('Cannot resolve %s: %s' % (urlparts.hostname, e),
+                    debug=True)
+
+
+RESOLVER = ResolverCache()
+
+
 def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT,
-                      source_address=None):
+                      source_address=None, timings=None):
     """Connect to *address* and return the socket object.
 
     Convenience function.  Connect to *address* (a 2-tuple ``(host,
@@ -393,13 +529,18 @@ def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT,
     is used.  If *source_address* is set it must be a tuple of (host, port)
     for the socket to bind as a source address before making the connection.
     An host of '' or port 0 tells the OS to use the default.
+    The name resolution and the connect of the socket are added to
+    *timings* (a ``ConnectionTimings``) when it is set. Names are resolved
+    through the ``RESOLVER`` cache, so only cache misses add a resolution.
 
     Largely vendored from Python 2.7, modified to work with Python 2.4
     """
 
     host, port = address
     err = None
-    for res in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+    addresses = RESOLVER.getaddrinfo(host, port, 0, socket.SOCK_STREAM,
+                                     timings=timings)
+    for res in addresses:
         af, socktype, proto, canonname, sa = res
         sock = None
         try:
@@ -408,7 +549,10 @@ def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT,
                 sock.settimeout(float(timeout))
             if source_address:
                 sock.bind(source_address)
+            start = timeit.default_timer()
             sock.connect(sa)
+            if timings is not None:
+                timings.add('connect', timeit.default_timer() - start)
             return sock
 
         except socket.error:
@@ -422,13 +566,36 @@ def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT,
         raise socket.error("getaddrinfo returns an empty list")
 
 
-class SpeedtestHTTPConnection(HTTPConnection):
+class TimedConnection:
+    """Mixin of ``SpeedtestHTTPConnection`` and ``SpeedtestHTTPSConnection``
+    adding the time from the end of each request to its response status
+    line (time to first byte) to ``timings``
+    """
+    timings = None
+    _request_sent = None
+
+    def request(self, *args, **kwargs):
+        HTTPConnection.request(self, *args, **kwargs)
+        self._request_sent = timeit.default_timer()
+
+    def getresponse(self, *args, **kwargs):
+        response = HTTPConnection.getresponse(self, *args, **kwargs)
+        if self.timings is not None and self._request_sent is not None:
+            self.timings.add('ttfb',
+                             timeit.default_timer() - self._request_sent)
+        self._request_sent = None
+        return response
+
+
+class SpeedtestHTTPConnection(TimedConnection, HTTPConnection):
     """Custom HTTPConnection to support source_address across
-    Python 2.4 - Python 3
+    Python 2.4 - Python 3, timing the phases of the connection in
+    ``timings``
     """
     def __init__(self, *args, **kwargs):
         source_address = kwargs.pop('source_address', None)
         timeout = kwargs.pop('timeout', 10)
+        timings = kwargs.pop('timings', None)
 
         self._tunnel_host = None
 
@@ -436,36 +603,33 @@ class SpeedtestHTTPConnection(HTTPConnection):
 
         self.source_address = source_address
         self.timeout = timeout
+        self.timings = timings
 
     def connect(self):
         """Connect to the host and port specified in __init__."""
-        try:
-            self.sock = socket.create_connection(
-                (self.host, self.port),
-                self.timeout,
-                self.source_address
-            )
-        except (AttributeError, TypeError):
-            self.sock = create_connection(
-                (self.host, self.port),
-                self.timeout,
-                self.source_address
-            )
+        self.sock = create_connection(
+            (self.host, self.port),
+            self.timeout,
+            self.source_address,
+            timings=self.timings
+        )
 
         if self._tunnel_host:
             self._tunnel()
 
 
 if HTTPSConnection:
-    class SpeedtestHTTPSConnection(HTTPSConnection):
+    class SpeedtestHTTPSConnection(TimedConnection, HTTPSConnection):
         """Custom HTTPSConnection to support source_address across
-        Python 2.4 - Python 3
+        Python 2.4 - Python 3, timing the phases of the connection in
+        ``timings``
         """
         default_port = 443
 
         def __init__(self, *args, **kwargs):
             source_address = kwargs.pop('source_address', None)
             timeout = kwargs.pop('timeout', 10)
+            timings = kwargs.pop('timings', None)
 
             self._tunnel_host = None
 
@@ -473,25 +637,26 @@ if HTTPSConnection:
 
             self.timeout = timeout
             self.source_address = source_address
+            self.timings = timings
 
         def connect(self):
             "Connect to a host on a given (SSL) port."
-            try:
-                self.sock = socket.create_connection(
-                    (self.host, self.port),
-                    self.timeout,
-                    self.source_address
-                )
-            except (AttributeError, TypeError):
-                self.sock = create_connection(
-                    (self.host, self.port),
-                    self.timeout,
-                    self.source_address
-                )
+            self.sock = create_connection(
+                (self.host, self.port),
+                self.timeout,
+                self.source_address,
+                timings=self.timings
+            )
 
             if self._tunnel_host:
                 self._tunnel()
 
+            start = timeit.default_timer()
+            self._wrap_socket()
+            if self.timings is not None:
+                self.timings.add('tls', timeit.default_timer() - start)
+
+        def _wrap_socket(self):
             if ssl:
                 try:
                     kwargs = {}
@@ -523,7 +688,8 @@ if HTTPSConnection:
                 )
 
 
-def _build_connection(connection, source_address, timeout, context=None):
+def _build_connection(connection, source_address, timeout, context=None,
+                      timings=None):
     """Cross Python 2.4 - Python 3 callable to build an ``HTTPConnection`` or
     ``HTTPSConnection`` with the args we need
 
@@ -533,7 +699,8 @@ def _build_connection(connection, source_address, timeout, context=None):
     def inner(host, **kwargs):
         kwargs.update({
             'source_address': source_address,
-            'timeout': timeout
+            'timeout': timeout,
+            'timings': timings
         })
         if context:
             kwargs['context'] = context
@@ -545,10 +712,12 @@ class SpeedtestHTTPHandler(AbstractHTTPHandler):
     """Custom ``HTTPHandler`` that can build a ``HTTPConnection`` with the
     args we need for ``source_address`` and ``timeout``
     """
-    def __init__(self, debuglevel=0, source_address=None, timeout=10):
+    def __init__(self, debuglevel=0, source_address=None, timeout=10,
+                 timings=None):
         AbstractHTTPHandler.__init__(self, debuglevel)
         self.source_address = source_address
         self.timeout = timeout
+        self.timings = timings
 
     def http_open(self, req):
         
@@ -556,7 +725,8 @@ class SpeedtestHTTPHandler(AbstractHTTPHandler):
             _build_connection(
                 SpeedtestHTTPConnection,
                 self.source_address,
-                self.timeout
+                self.timeout,
+                timings=self.timings,
             ),
             req
         )
@@ -569,11 +739,12 @@ class SpeedtestHTTPSHandler(AbstractHTTPHandler):
     args we need for ``source_address`` and ``timeout``
     """
     def __init__(self, debuglevel=0, context=None, source_address=None,
-                 timeout=10):
+                 timeout=10, timings=None):
         AbstractHTTPHandler.__init__(self, debuglevel)
         self._context = context
         self.source_address = source_address
         self.timeout = timeout
+        self.timings = timings
 
     def https_open(self, req):
         
@@ -583,6 +754,7 @@ class SpeedtestHTTPSHandler(AbstractHTTPHandler):
                 self.source_address,
                 self.timeout,
                 context=self._context,
+                timings=self.timings,
             ),
             req
         )
@@ -590,11 +762,11 @@ class SpeedtestHTTPSHandler(AbstractHTTPHandler):
     https_request = AbstractHTTPHandler.do_request_
 
 
-def build_opener(source_address=None, timeout=10):
+def build_opener(source_address=None, timeout=10, timings=None):
     """Function similar to ``urllib2.build_opener`` that will build
     an ``OpenerDirector`` with the explicit handlers we want,
-    ``source_address`` for binding, ``timeout`` and our custom
-    `User-Agent`
+    ``source_address`` for binding, ``timeout``, ``timings`` of the
+    connections and our custom `User-Agent`
     """
 
     printer('Timeout set to %d' % timeout, debug=True)
@@ -609,9 +781,9 @@ def build_opener(source_address=None, timeout=10):
     handlers = [
         #ProxyHandler(), # XXX: This is the part that for some reason stops when executing a python file, so it is commented out. It works as expected even if it is commented out, but I don't know how it affects others.
         SpeedtestHTTPHandler(source_address=source_address_tuple,
-                             timeout=timeout),
+                             timeout=timeout, timings=timings),
         SpeedtestHTTPSHandler(source_address=source_address_tuple,
-                              timeout=timeout),
+                              timeout=timeout, timings=timings),
         HTTPDefaultErrorHandler(),
         HTTPRedirectHandler(),
         HTTPErrorProcessor()
@@ -682,6 +854,51 @@ def distance(origin, destination):
     return d
 
 
+def distances(origin, lats, lons):
+    """Determine distances in km between ``origin`` and each point of the
+    sequences ``lats`` and ``lons``, in one pass
+
+    Uses numpy when it is installed
+    """
+
+    lat1, lon1 = origin
+    radius = 6371  # km
+
+    if numpy is not None:
+        lat2 = numpy.radians(numpy.asarray(lats, dtype=float))
+        dlat = lat2 - math.radians(lat1)
+        dlon = numpy.radians(numpy.asarray(lons, dtype=float) - lon1)
+        a = (numpy.sin(dlat / 2) ** 2 +
+             math.cos(math.radians(lat1)) * numpy.cos(lat2) *
+             numpy.sin(dlon / 2) ** 2)
+        c = 2 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a))
+        return (radius * c).tolist()
+
+    cos_lat1 = math.cos(math.radians(lat1))
+    rad_lat1 = math.radians(lat1)
+    sin, cos, radians = math.sin, math.cos, math.radians
+    results = []
+    for lat2, lon2 in zip(lats, lons):
+        rad_lat2 = radians(lat2)
+        sin_dlat = sin((rad_lat2 - rad_lat1) / 2)
+        sin_dlon = sin(radians(lon2 - lon1) / 2)
+        a = (sin_dlat * sin_dlat +
+             cos_lat1 * cos(rad_lat2) * sin_dlon * sin_dlon)
+        results.append(radius * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a)))
+    return results
+
+
+def closest_servers(servers, limit=5):
+    """Return the ``limit`` closest servers of ``servers``, a dict of
+    servers keyed by distance, without sorting all of them
+    """
+    return [server for d, server in heapq.nsmallest(
+        limit,
+        ((d, server) for d, group in servers.items() for server in group),
+        key=lambda item: item[0]
+    )]
+
+
 def build_user_agent():
     """Build a Mozilla/5.0 compatible User-Agent string"""
 
@@ -783,6 +1000,252 @@ def get_attributes_by_tag_name(dom, tag_name):
     return dict(list(elem.attributes.items()))
 
 
+def parse_config(configxml):
+    """Parse the speedtest.net configuration XML and return the config
+    data we are interested in and the ``(lat, lon)`` of the client
+    """
+
+    try:
+        try:
+            root = ET.fromstring(configxml)
+        except ET.ParseError:
+            e = get_exception()
+            raise SpeedtestConfigError(
+                'Malformed speedtest.net configuration: %s' % e
+            )
+        server_config = root.find('server-config').attrib
+        download = root.find('download').attrib
+        upload = root.find('upload').attrib
+        # times = root.find('times').attrib
+        client = root.find('client').attrib
+
+    except AttributeError:
+        try:
+            root = DOM.parseString(configxml)
+        except ExpatError:
+            e = get_exception()
+            raise SpeedtestConfigError(
+                'Malformed speedtest.net configuration: %s' % e
+            )
+        server_config = get_attributes_by_tag_name(root, 'server-config')
+        download = get_attributes_by_tag_name(root, 'download')
+        upload = get_attributes_by_tag_name(root, 'upload')
+        # times = get_attributes_by_tag_name(root, 'times')
+        client = get_attributes_by_tag_name(root, 'client')
+
+    ignore_servers = [
+        int(i) for i in server_config['ignoreids'].split(',') if i
+    ]
+
+    ratio = int(upload['ratio'])
+    upload_max = int(upload['maxchunkcount'])
+    up_sizes = [32768, 65536, 131072, 262144, 524288, 1048576, 7340032]
+    sizes = {
+        'upload': up_sizes[ratio - 1:],
+        'download': [350, 500, 750, 1000, 1500, 2000, 2500,
+                     3000, 3500, 4000]
+    }
+
+    size_count = len(sizes['upload'])
+
+    upload_count = int(math.ceil(upload_max / size_count))
+
+    counts = {
+        'upload': upload_count,
+        'download': int(download['threadsperurl'])
+    }
+
+    threads = {
+        'upload': int(upload['threads']),
+        'download': int(server_config['threadcount']) * 2
+    }
+
+    length = {
+        'upload': int(upload['testlength']),
+        'download': int(download['testlength'])
+    }
+
+    config = {
+        'client': client,
+        'ignore_servers': ignore_servers,
+        'sizes': sizes,
+        'counts': counts,
+        'threads': threads,
+        'length': length,
+        'upload_max': upload_count * size_count
+    }
+
+    try:
+        lat_lon = (float(client['lat']), float(client['lon']))
+    except ValueError:
+        raise SpeedtestConfigError(
+            'Unknown location: lat=%r lon=%r' %
+            (client.get('lat'), client.get('lon'))
+        )
+
+    return config, lat_lon
+
+
+def parse_servers(serversxml, lat_lon, ignore_servers, servers=None,
+                  exclude=None):
+    """Parse the speedtest.net server list XML into a dict of servers keyed
+    by their distance from ``lat_lon``, optionally filtered to ``servers``
+    and without ``ignore_servers`` and ``exclude``
+    """
+    parser = ServerListParser(lat_lon, ignore_servers, servers=servers,
+                              exclude=exclude)
+    parser.feed(serversxml)
+    return parser.close()
+
+
+class ServerListParser(object):
+    """Incremental parser of the speedtest.net server list XML
+
+    Data is fed in chunks as it is read from the response. Each ``server``
+    element is filtered and located as soon as it is complete and removed
+    from the tree afterwards, so memory does not grow with the size of the
+    list. Distances are computed in batches of ``batch_size`` servers.
+
+    Without ``ET.XMLPullParser`` the chunks are joined and parsed as a whole
+    document in ``close``
+    """
+
+    def __init__(self, lat_lon, ignore_servers, servers=None, exclude=None,
+                 batch_size=DISTANCE_BATCH_SIZE):
+        self.lat_lon = lat_lon
+        self.ignore_servers = ignore_servers
+        self.servers = servers or []
+        self.exclude = exclude or []
+        self.batch_size = batch_size
+
+        self.results = {}
+        self.count = 0
+
+        self._located = []
+        self._lats = array('d')
+        self._lons = array('d')
+        self._stack = []
+        self._chunks = []
+
+        try:
+            self._parser = ET.XMLPullParser(events=('start', 'end'))
+        except AttributeError:
+            self._parser = None
+
+    def feed(self, data):
+        if self._parser is None:
+            self._chunks.append(data)
+            return
+
+        try:
+            self._parser.feed(data)
+        except ET.ParseError:
+            e = get_exception()
+            raise SpeedtestServersError(
+                'Malformed speedtest.net server list: %s' % e
+            )
+        self._read_events()
+
+    def close(self):
+        """Finish parsing and return the servers keyed by distance"""
+        if self._parser is None:
+            for attrib in self._parse_document(''.encode().join(self._chunks)):
+                self._add(attrib)
+        else:
+            try:
+                self._parser.close()
+            except ET.ParseError:
+                e = get_exception()
+                raise SpeedtestServersError(
+                    'Malformed speedtest.net server list: %s' % e
+                )
+            self._read_events()
+
+        self._flush()
+        return self.results
+
+    def _read_events(self):
+        for event, elem in self._parser.read_events():
+            if event == 'start':
+                self._stack.append(elem)
+                continue
+
+            self._stack.pop()
+            if elem.tag != 'server':
+                continue
+
+            self._add(dict(elem.attrib))
+            elem.clear()
+            if self._stack:
+                self._stack[-1].remove(elem)
+
+    def _parse_document(self, serversxml):
+        try:
+            try:
+                try:
+                    root = ET.fromstring(serversxml)
+                except ET.ParseError:
+                    e = get_exception()
+                    raise SpeedtestServersError(
+                        'Malformed speedtest.net server list: %s' % e
+                    )
+                elements = etree_iter(root, 'server')
+            except AttributeError:
+                try:
+                    root = DOM.parseString(serversxml)
+                except ExpatError:
+                    e = get_exception()
+                    raise SpeedtestServersError(
+                        'Malformed speedtest.net server list: %s' % e
+                    )
+                elements = root.getElementsByTagName('server')
+        except (SyntaxError, xml.parsers.expat.ExpatError):
+            raise ServersRetrievalError()
+
+        for server in elements:
+            try:
+                yield server.attrib
+            except AttributeError:
+                yield dict(list(server.attributes.items()))
+
+    def _add(self, attrib):
+        self.count += 1
+
+        if self.servers and int(attrib.get('id')) not in self.servers:
+            return
+
+        if (int(attrib.get('id')) in self.ignore_servers
+                or int(attrib.get('id')) in self.exclude):
+            return
+
+        try:
+            lat, lon = float(attrib.get('lat')), float(attrib.get('lon'))
+        except Exception:
+            return
+
+        self._located.append(attrib)
+        self._lats.append(lat)
+        self._lons.append(lon)
+
+        if len(self._located) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        located = self._located
+        for attrib, d in zip(located,
+                             distances(self.lat_lon, self._lats, self._lons)):
+            attrib['d'] = d
+
+            try:
+                self.results[d].append(attrib)
+            except KeyError:
+                self.results[d] = [attrib]
+
+        self._located = []
+        self._lats = array('d')
+        self._lons = array('d')
+
+
 def print_dots(shutdown_event):
     """Built in callback function used by Thread classes for printing
     status
@@ -802,17 +1265,29 @@ def do_nothing(*args, **kwargs):
     pass
 
 
+def read_into(response, buffer):
+    """Read the next chunk of ``response`` into ``buffer`` and return its
+    length, so no bytes object is allocated per chunk
+    """
+    if hasattr(response, 'readinto'):
+        return response.readinto(buffer)
+    return len(response.read(len(buffer)))
+
+
 class HTTPDownloader(threading.Thread):
     """Thread class for retrieving a URL"""
 
     def __init__(self, i, request, start, timeout, opener=None,
-                 shutdown_event=None):
+                 shutdown_event=None, finished=None,
+                 chunk_size=DOWNLOAD_CHUNK_SIZE):
         threading.Thread.__init__(self)
         self.request = request
-        self.result = [0]
+        self.result = 0
         self.starttime = start
         self.timeout = timeout
         self.i = i
+        self.chunk_size = chunk_size
+        self._finished = finished
         if opener:
             self._opener = opener.open
         else:
@@ -825,19 +1300,50 @@ class HTTPDownloader(threading.Thread):
 
     def run(self):
         try:
-            if (timeit.default_timer() - self.starttime) <= self.timeout:
+            if ((timeit.default_timer() - self.starttime) <= self.timeout and
+                    not event_is_set(self._shutdown_event)):
                 f = self._opener(self.request)
+                buffer = bytearray(self.chunk_size)
                 while (not event_is_set(self._shutdown_event) and
                         (timeit.default_timer() - self.starttime) <=
                         self.timeout):
-                    self.result.append(len(f.read(10240)))
-                    if self.result[-1] == 0:
+                    n = read_into(f, buffer)
+                    if n == 0:
                         break
+                    self.result += n
                 f.close()
         except IOError:
             pass
         except HTTP_ERRORS:
             pass
+        finally:
+            if self._finished is not None:
+                self._finished.put(self)
+
+
+def build_upload_payload(length):
+    """Return the ``length`` bytes form body POSTed by upload tests"""
+    multiplier = int(math.ceil(int(length) / 36.0))
+    return ('content1=%s' %
+            (UPLOAD_CHARS * multiplier)[0:int(length) - 9]).encode()
+
+
+_upload_payload = {'data': ''.encode()}
+_upload_payload_lock = threading.Lock()
+
+
+def get_upload_payload(length):
+    """Return a read-only ``memoryview`` of the first ``length`` bytes of
+    the upload body shared by all upload requests
+
+    Bodies of every size are prefixes of the same pattern, so one buffer of
+    the largest size is built and requests only hold slices of it
+    """
+    with _upload_payload_lock:
+        data = _upload_payload['data']
+        if len(data) < int(length):
+            data = _upload_payload['data'] = build_upload_payload(length)
+    return memoryview(data)[0:int(length)]
 
 
 class HTTPUploaderData(object):
@@ -856,19 +1362,13 @@ class HTTPUploaderData(object):
             self._shutdown_event = FakeShutdownEvent()
 
         self._data = None
+        self._offset = 0
 
-        self.total = [0]
+        self.total = 0
 
     def pre_allocate(self):
-        chars = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-        multiplier = int(round(int(self.length) / 36.0))
-        IO = BytesIO or StringIO
         try:
-            self._data = IO(
-                ('content1=%s' %
-                 (chars * multiplier)[0:int(self.length) - 9]
-                 ).encode()
-            )
+            self._data = get_upload_payload(self.length)
         except MemoryError:
             raise SpeedtestCLIError(
                 'Insufficient memory to pre-allocate upload data. Please '
@@ -877,15 +1377,17 @@ class HTTPUploaderData(object):
 
     @property
     def data(self):
-        if not self._data:
+        if self._data is None:
             self.pre_allocate()
         return self._data
 
     def read(self, n=10240):
         if ((timeit.default_timer() - self.start) <= self.timeout and
                 not event_is_set(self._shutdown_event)):
-            chunk = self.data.read(n)
-            self.total.append(len(chunk))
+            # Slices of the shared payload are sent without copying
+            chunk = self.data[self._offset:self._offset + n]
+            self._offset += len(chunk)
+            self.total += len(chunk)
             return chunk
         else:
             raise SpeedtestUploadTimeout()
@@ -898,7 +1400,7 @@ class HTTPUploader(threading.Thread):
     """Thread class for putting a URL"""
 
     def __init__(self, i, request, start, size, timeout, opener=None,
-                 shutdown_event=None):
+                 shutdown_event=None, finished=None):
         threading.Thread.__init__(self)
         self.request = request
         self.request.data.start = self.starttime = start
@@ -906,6 +1408,7 @@ class HTTPUploader(threading.Thread):
         self.result = 0
         self.timeout = timeout
         self.i = i
+        self._finished = finished
 
         if opener:
             self._opener = opener.open
@@ -933,13 +1436,398 @@ class HTTPUploader(threading.Thread):
                     f = self._opener(request)
                 f.read(11)
                 f.close()
-                self.result = sum(self.request.data.total)
+                self.result = self.request.data.total
             else:
                 self.result = 0
         except (IOError, SpeedtestUploadTimeout):
-            self.result = sum(self.request.data.total)
+            self.result = self.request.data.total
         except HTTP_ERRORS:
             self.result = 0
+        finally:
+            if self._finished is not None:
+                self._finished.put(self)
+
+
+def build_http_connection(url, source_address=None, timeout=10,
+                          timings=None):
+    """Build a ``SpeedtestHTTPConnection`` or ``SpeedtestHTTPSConnection``
+    to the host of ``url``. ``source_address`` is a ``(host, port)`` tuple
+    """
+    urlparts = urlparse(url)
+    if urlparts[0] == 'https':
+        return SpeedtestHTTPSConnection(urlparts[1],
+                                        source_address=source_address,
+                                        timeout=timeout, timings=timings)
+    return SpeedtestHTTPConnection(urlparts[1],
+                                   source_address=source_address,
+                                   timeout=timeout, timings=timings)
+
+
+def percentile(sorted_values, q):
+    """Return the ``q``-th percentile of ``sorted_values``, interpolated
+    between the closest ranks like ``numpy.percentile``, or ``None`` if
+    there are no values
+    """
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * q / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return (sorted_values[lower] +
+            (sorted_values[upper] - sorted_values[lower]) * (position - lower))
+
+
+class ConnectionTimings(object):
+    """Durations in seconds of the phases of the connections and requests
+    of a test, added from many threads: name resolution (``dns``), TCP
+    ``connect``, ``tls`` handshake, and time to first byte (``ttfb``) of
+    each response
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = dict((phase, array('d'))
+                            for phase in CONNECTION_PHASES)
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.samples[phase].append(seconds)
+
+    def summary(self):
+        """Return the count, min, p50, p95 and max in ms of each phase"""
+        summary = {}
+        for phase in CONNECTION_PHASES:
+            with self._lock:
+                values = sorted(v * 1000.0 for v in self.samples[phase])
+            stats = {'count': len(values)}
+            for name, value in (('min', values and values[0]),
+                                ('p50', percentile(values, 50)),
+                                ('p95', percentile(values, 95)),
+                                ('max', values and values[-1])):
+                stats[name] = round(value, 3) if values else None
+            summary[phase] = stats
+        return summary
+
+
+def build_request_path(url, bump='0'):
+    """Return the path and query of ``url`` for a request on an already
+    open connection, with the same cache buster as ``build_request``
+    """
+    urlparts = urlparse(url)
+    if urlparts[4]:
+        query = '%s&' % urlparts[4]
+    else:
+        query = ''
+    return '%s?%sx=%s.%s' % (urlparts[2] or '/', query,
+                             int(timeit.time.time() * 1000), bump)
+
+
+def steady_throughput(samples, interval=SAMPLE_INTERVAL,
+                      ramp_up=RAMP_UP_FRACTION, tail=TAIL_FRACTION):
+    """Return the throughput in bits/s between the ramp-up and the tail of
+    ``samples``, the cumulative bytes transferred every ``interval``
+    seconds, or ``None`` if there are too few samples
+    """
+    first = int(len(samples) * ramp_up)
+    last = len(samples) - int(len(samples) * tail) - 1
+    if last - first < 2:
+        return None
+    return ((samples[last] - samples[first]) /
+            ((last - first) * interval)) * 8.0
+
+
+def throughput_converged(samples, interval=SAMPLE_INTERVAL,
+                         min_duration=ADAPTIVE_MIN_DURATION,
+                         window=ADAPTIVE_WINDOW,
+                         threshold=ADAPTIVE_THRESHOLD):
+    """Return whether the throughput of ``samples``, the cumulative bytes
+    transferred every ``interval`` seconds, has converged
+    """
+    if len(samples) * interval < min_duration or len(samples) <= window:
+        return False
+    rates = [samples[i] - samples[i - 1]
+             for i in range(len(samples) - window, len(samples))]
+    mean = sum(rates) / float(window)
+    if mean <= 0:
+        return False
+    variance = sum((r - mean) ** 2 for r in rates) / (window - 1)
+    return 1.96 * math.sqrt(variance / window) <= threshold * mean
+
+
+class ThroughputSampler(threading.Thread):
+    """Thread recording ``counter()``, the cumulative bytes transferred
+    by a test, every ``interval`` seconds from ``start`` until stopped
+
+    With ``converged``, ``stop_event`` is set as soon as
+    ``converged(samples)`` is true or ``shutdown_event`` is set
+    """
+
+    def __init__(self, counter, start, interval=SAMPLE_INTERVAL,
+                 converged=None, stop_event=None, shutdown_event=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.counter = counter
+        self.starttime = start
+        self.interval = interval
+        self.samples = array('d')
+        self.converged = converged
+        self.stop_event = stop_event
+        self._stop_event = threading.Event()
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+    def run(self):
+        next_time = self.starttime + self.interval
+        while not self._stop_event.wait(
+                max(0, next_time - timeit.default_timer())):
+            self.samples.append(self.counter())
+            next_time += self.interval
+            if self.converged is None or event_is_set(self.stop_event):
+                continue
+            if (event_is_set(self._shutdown_event) or
+                    self.converged(self.samples)):
+                printer('Throughput converged after %0.1f s' %
+                        (len(self.samples) * self.interval), debug=True)
+                self.stop_event.set()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.samples
+
+
+class HTTPPoolWorker(threading.Thread):
+    """Thread holding a persistent HTTP/1.1 keep-alive connection to the
+    test server
+
+    The connection is opened before the test starts, then jobs are pulled
+    from ``jobs`` until the queue is empty or the test length is reached,
+    so connection setup and thread creation are not part of the timed
+    window. The connection is only re-opened after an error or when the
+    server closes it.
+
+    ``fetch(worker, job)`` runs a job on the connection of the worker, see
+    ``pool_download`` and ``pool_upload``. With ``chunk_size``, the worker
+    has a ``buffer`` of that size for reading responses
+    """
+
+    def __init__(self, url, jobs, start_event, timeout, request_count,
+                 fetch, source_address=None, http_timeout=10,
+                 callback=do_nothing, shutdown_event=None, timings=None,
+                 chunk_size=None):
+        threading.Thread.__init__(self)
+        self.url = url
+        self.jobs = jobs
+        self.fetch = fetch
+        self.start_event = start_event
+        self.timeout = timeout
+        self.request_count = request_count
+        self.source_address = source_address
+        self.http_timeout = http_timeout
+        self.callback = callback
+        self.starttime = None
+        self.result = 0
+        self.connected = threading.Event()
+        self.headers = {
+            'User-Agent': build_user_agent(),
+            'Cache-Control': 'no-cache',
+        }
+        self.timings = timings
+        self.buffer = bytearray(chunk_size) if chunk_size else None
+        self._connection = None
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+    def connect(self):
+        self._connection = build_http_connection(self.url,
+                                                 self.source_address,
+                                                 self.http_timeout,
+                                                 timings=self.timings)
+        self._connection.connect()
+        # Requests on a reused connection are written as separate small
+        # segments (headers, then body), which Nagle's algorithm would delay
+        try:
+            self._connection.sock.setsockopt(socket.IPPROTO_TCP,
+                                             socket.TCP_NODELAY, 1)
+        except (AttributeError, socket.error):
+            pass
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def in_time(self):
+        return ((timeit.default_timer() - self.starttime) <= self.timeout and
+                not event_is_set(self._shutdown_event))
+
+    def run(self):
+        try:
+            self.connect()
+        except HTTP_ERRORS:
+            self.close()
+        self.connected.set()
+        self.start_event.wait()
+        try:
+            while self.in_time():
+                try:
+                    job = self.jobs.get_nowait()
+                except Empty:
+                    break
+                self.callback(job[0], self.request_count, start=True)
+                try:
+                    if self._connection is None:
+                        self.connect()
+                    self.fetch(self, job)
+                except (IOError, SpeedtestUploadTimeout) + HTTP_ERRORS:
+                    self.close()
+                self.callback(job[0], self.request_count, end=True)
+        finally:
+            self.close()
+
+
+def pool_download(worker, job):
+    """Retrieve a ``(i, path)`` job of a ``HTTPPoolWorker``
+
+    The response is read into the buffer of the worker
+    """
+    i, path = job
+    worker._connection.request('GET', path, headers=worker.headers)
+    response = worker._connection.getresponse()
+    while worker.in_time():
+        n = read_into(response, worker.buffer)
+        if n == 0:
+            break
+        worker.result += n
+    else:
+        # The response was cut off, the connection can not be reused
+        worker.close()
+        return
+    if response.will_close:
+        worker.close()
+
+
+def pool_upload(worker, job):
+    """Put a ``(i, path, data)`` job of a ``HTTPPoolWorker``, where
+    ``data`` is a ``HTTPUploaderData``
+    """
+    i, path, data = job
+    data.start = worker.starttime
+    headers = dict(worker.headers)
+    headers.update({
+        'Content-length': '%d' % len(data),
+        'Content-type': 'application/x-www-form-urlencoded',
+    })
+    try:
+        worker._connection.request('POST', path, body=data, headers=headers)
+        response = worker._connection.getresponse()
+        response.read()
+        if response.will_close:
+            worker.close()
+    finally:
+        worker.result += data.total
+
+
+class LatencyProber(threading.Thread):
+    """Thread timing ``probes`` requests to the latency.txt of ``server``,
+    each on a new connection. Failed requests count as PROBE_FAILURE seconds
+
+    ``done`` is a ``threading.Condition`` notified after every probe
+    """
+
+    def __init__(self, server, done, source_address=None, timeout=10,
+                 probes=3, timings=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = server
+        self.done = done
+        self.source_address = source_address
+        self.timeout = timeout
+        self.probes = probes
+        self.timings = timings
+        self.cum = []
+        self.finished = False
+        self.probe_start = None
+        self._cancelled = False
+        self._connection = None
+
+    def latency(self):
+        """Latency in ms as reported by speedtest.net, half of the average
+        round trip time of the probes
+        """
+        cum = self.cum + [PROBE_FAILURE] * (self.probes - len(self.cum))
+        return round((sum(cum) / (2.0 * self.probes)) * 1000.0, 3)
+
+    def elapsed(self, now):
+        """Time of the finished probes and of the probe in flight"""
+        total = sum(self.cum)
+        if self.probe_start is not None:
+            total += now - self.probe_start
+        return total
+
+    def cancel(self):
+        self._cancelled = True
+        connection = self._connection
+        if connection is not None and connection.sock is not None:
+            # Unblocks a request in flight
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except (AttributeError, socket.error):
+                pass
+
+    def probe(self, latency_url, headers):
+        urlparts = urlparse(latency_url)
+        path = '%s?%s' % (urlparts[2], urlparts[4])
+        printer('%s %s' % ('GET', latency_url), debug=True)
+        h = self._connection
+        try:
+            try:
+                h.request("GET", path, headers=headers)
+                r = h.getresponse()
+                total = (timeit.default_timer() - self.probe_start)
+            except HTTP_ERRORS:
+                e = get_exception()
+                printer('ERROR: %r' % e, debug=True)
+                return PROBE_FAILURE
+
+            text = r.read(9)
+            if int(r.status) == 200 and text == 'test=test'.encode():
+                return total
+            return PROBE_FAILURE
+        finally:
+            h.close()
+
+    def run(self):
+        url = os.path.dirname(self.server['url'])
+        stamp = int(timeit.time.time() * 1000)
+        latency_url = '%s/latency.txt?x=%s' % (url, stamp)
+        headers = {'User-Agent': build_user_agent()}
+        try:
+            for i in range(0, self.probes):
+                if self._cancelled:
+                    break
+                with self.done:
+                    self._connection = build_http_connection(
+                        latency_url, self.source_address, self.timeout,
+                        timings=self.timings
+                    )
+                    self.probe_start = timeit.default_timer()
+                total = self.probe('%s.%s' % (latency_url, i), headers)
+                with self.done:
+                    self.cum.append(total)
+                    self.probe_start = None
+                    self._connection = None
+                    self.done.notify_all()
+        finally:
+            with self.done:
+                self.finished = True
+                self.done.notify_all()
 
 
 class SpeedtestResults(object):
@@ -956,7 +1844,7 @@ class SpeedtestResults(object):
     """
 
     def __init__(self, download=0, upload=0, ping=0, server=None, client=None,
-                 opener=None, secure=False):
+                 opener=None, secure=False, timings=None):
         self.download = download
         self.upload = upload
         self.ping = ping
@@ -971,6 +1859,21 @@ class SpeedtestResults(object):
         self.bytes_received = 0
         self.bytes_sent = 0
 
+        # Cumulative bytes every ``sample_interval`` seconds, and the
+        # throughput without ramp-up and tail computed from them. Only the
+        # steady throughput is part of dict(), which is logged on every run
+        self.sample_interval = SAMPLE_INTERVAL
+        self.download_samples = array('d')
+        self.upload_samples = array('d')
+        self.download_steady = None
+        self.upload_steady = None
+
+        # Durations of the connection phases of the test
+        if timings is not None:
+            self.timings = timings
+        else:
+            self.timings = ConnectionTimings()
+
         if opener:
             self._opener = opener
         else:
@@ -1055,6 +1958,9 @@ class SpeedtestResults(object):
             'bytes_received': self.bytes_received,
             'share': self._share,
             'client': self.client,
+            'download_steady': self.download_steady,
+            'upload_steady': self.upload_steady,
+            'timings': self.timings.summary(),
         }
 
     @staticmethod
@@ -1093,16 +1999,247 @@ class SpeedtestResults(object):
         return json.dumps(self.dict(), **kwargs)
 
 
+def load_json_file(path):
+    """Load a JSON object from ``path``, or an empty dict if it is missing
+    or invalid
+    """
+    try:
+        f = open(path)
+    except IOError:
+        return {}
+    try:
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+    finally:
+        f.close()
+
+
+def save_json_file(path, data):
+    """Write ``data`` as JSON to a temporary file, then rename it over
+    ``path``, so readers never see a partial file
+    """
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    f = open(tmp_path, 'w')
+    try:
+        json.dump(data, f)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+
+def update_json_file(path, update):
+    """Load the JSON object of ``path``, pass it to ``update`` and save it,
+    holding an exclusive lock on ``path``.lock like the records stores, so
+    concurrent measurements do not drop each other's changes
+    """
+    lock_file = open('%s.lock' % path, 'a')
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        data = load_json_file(path)
+        update(data)
+        save_json_file(path, data)
+        return data
+    finally:
+        # Closing the file releases the lock
+        lock_file.close()
+
+
+class SpeedtestCache(object):
+    """On-disk cache of the speedtest.net configuration and server list
+
+    Entries are stored in a JSON file under ``key`` (e.g. the name of the
+    network), and are used without any request for ``ttl`` seconds. An
+    expired entry is refreshed with a conditional request (``ETag`` and
+    ``Last-Modified`` of the cached response), and is still used when the
+    refresh fails
+    """
+
+    def __init__(self, path, ttl=3600, key=''):
+        self.path = path
+        self.ttl = ttl
+        self.key = key
+
+    def _load(self):
+        return load_json_file(self.path)
+
+    def _store(self, name, entry):
+        def update(entries):
+            entries['%s|%s' % (self.key, name)] = entry
+        update_json_file(self.path, update)
+
+    def get(self, name):
+        return self._load().get('%s|%s' % (self.key, name))
+
+    def is_fresh(self, entry):
+        return (entry is not None and
+                timeit.time.time() - entry['time'] < self.ttl)
+
+    def put(self, name, data, headers=None, url=None):
+        """Store ``data`` with the validators of the response ``headers``"""
+        entry = {'time': timeit.time.time(), 'data': data, 'url': url}
+        if headers is not None:
+            entry['etag'] = headers.get('etag')
+            entry['last_modified'] = headers.get('last-modified')
+        self._store(name, entry)
+        return entry
+
+    def touch(self, name, entry):
+        entry['time'] = timeit.time.time()
+        self._store(name, entry)
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+
+def servers_cache_name(client, lat_lon, servers=None, exclude=None):
+    """Name of the cache entry of a server list, which depends on the
+    location of the client and is cached after filtering
+    """
+    return 'servers|%s|%s,%s|%s|%s' % (client.get('ip'), lat_lon[0],
+                                       lat_lon[1], sorted(servers or []),
+                                       sorted(exclude or []))
+
+
+def latency_failed(latency, probes=3):
+    """Whether ``latency`` in ms, of at most ``probes`` probes, includes a
+    failed probe
+    """
+    return latency >= PROBE_FAILURE * 1000.0 / (2 * probes)
+
+
+def group_servers(server_list):
+    """Group a list of servers, as stored in the cache, by their distance
+    ``d``
+    """
+    servers = {}
+    for server in server_list:
+        try:
+            servers[server['d']].append(server)
+        except KeyError:
+            servers[server['d']] = [server]
+    return servers
+
+
+class ServerHistory(object):
+    """Persistent history of the latency and throughput of the servers
+    chosen by ``get_best_server``, stored in a JSON file under ``key``
+    (e.g. the name of the network)
+
+    The last chosen server is reused until ``reselect_after`` seconds after
+    it was selected, or until its latency is more than ``drift`` (a
+    fraction) above its median latency in the history
+    """
+
+    def __init__(self, path, key='', reselect_after=86400, drift=0.5,
+                 size=HISTORY_SIZE):
+        self.path = path
+        self.key = key
+        self.reselect_after = reselect_after
+        self.drift = drift
+        self.size = size
+
+    def _load(self):
+        return load_json_file(self.path)
+
+    def get(self):
+        return self._load().get(self.key, {})
+
+    def sticky_server(self, servers=None, exclude=None):
+        """The last selected server, unless a new selection is due or it is
+        filtered out by ``servers`` and ``exclude``
+        """
+        entry = self.get()
+        server = entry.get('server')
+        if server is None:
+            return None
+        if timeit.time.time() - entry['selected'] >= self.reselect_after:
+            return None
+        server_id = '%s' % server['id']
+        if servers and server_id not in ['%s' % s for s in servers]:
+            return None
+        if exclude and server_id in ['%s' % s for s in exclude]:
+            return None
+        return server
+
+    def baseline(self, server_id):
+        """Median latency of ``server_id`` in the history"""
+        latencies = sorted(self.get().get('servers', {})
+                           .get('%s' % server_id, {}).get('latency', []))
+        if not latencies:
+            return None
+        return latencies[len(latencies) // 2]
+
+    def drifted(self, server, latency):
+        """Whether ``server`` must be reselected: its latency probe failed,
+        or ``latency`` drifted above its baseline
+        """
+        if latency_failed(latency):
+            return True
+        baseline = self.baseline(server['id'])
+        if baseline is None:
+            return False
+        return latency > max(baseline * (1 + self.drift),
+                             baseline + HISTORY_MIN_DRIFT)
+
+    def select(self, server):
+        def update(entries):
+            entry = entries.setdefault(self.key, {})
+            entry['server'] = dict((k, v) for k, v in server.items()
+                                   if k != 'latency')
+            entry['selected'] = timeit.time.time()
+        update_json_file(self.path, update)
+
+    def record(self, results):
+        """Append the latency and throughput of ``results`` to the history
+        of its server. Failed latencies are left out of the baseline
+        """
+        def update(entries):
+            entry = entries.setdefault(self.key, {})
+            history = entry.setdefault('servers', {}).setdefault(
+                '%s' % results.server['id'], {}
+            )
+            for name, value in (('latency', results.ping),
+                                ('download', results.download),
+                                ('upload', results.upload)):
+                if name == 'latency' and latency_failed(value):
+                    continue
+                values = history.setdefault(name, [])
+                values.append(value)
+                del values[:-self.size]
+            history['time'] = timeit.time.time()
+        update_json_file(self.path, update)
+
+
 class Speedtest(object):
     """Class for performing standard speedtest.net testing operations"""
 
     def __init__(self, config=None, source_address=None, timeout=10,
-                 secure=False, shutdown_event=None):
+                 secure=False, shutdown_event=None, keep_alive=True,
+                 chunk_size=DOWNLOAD_CHUNK_SIZE, adaptive=False, cache=None,
+                 history=None):
         self.config = {}
 
         self._source_address = source_address
         self._timeout = timeout
-        self._opener = build_opener(source_address, timeout)
+        self.timings = ConnectionTimings()
+        self._opener = build_opener(source_address, timeout,
+                                    timings=self.timings)
+        self._keep_alive = keep_alive
+        self._chunk_size = chunk_size
+        self._adaptive = adaptive
+        self._cache = cache
+        self._history = history
 
         self._secure = secure
 
@@ -1123,6 +2260,7 @@ class Speedtest(object):
             client=self.config['client'],
             opener=self._opener,
             secure=secure,
+            timings=self.timings,
         )
 
     @property
@@ -1136,14 +2274,28 @@ class Speedtest(object):
         we are interested in
         """
 
-        headers = {}
+        cached = None
+        if self._cache is not None:
+            cached = self._cache.get('config')
+            if self._cache.is_fresh(cached):
+                printer('Using cached configuration', debug=True)
+                return self._set_config(cached['data'].encode())
+
+        headers = SpeedtestCache.conditional_headers(cached)
         if gzip:
             headers['Accept-Encoding'] = 'gzip'
-        request = build_request('://www.speedtest.net/speedtest-config.php',
-                                headers=headers, secure=self._secure)
+        request = build_request(CONFIG_URL, headers=headers,
+                                secure=self._secure)
         uh, e = catch_request(request, opener=self._opener)
         if e:
-            raise ConfigRetrievalError(e)
+            if cached is None:
+                raise ConfigRetrievalError(e)
+            if getattr(e, 'code', None) == 304:
+                self._cache.touch('config', cached)
+            else:
+                printer('Using expired cached configuration: %s' % e,
+                        debug=True)
+            return self._set_config(cached['data'].encode())
         configxml_list = []
 
         stream = get_response_stream(uh)
@@ -1165,83 +2317,15 @@ class Speedtest(object):
 
         printer('Config XML:\n%s' % configxml, debug=True)
 
-        try:
-            try:
-                root = ET.fromstring(configxml)
-            except ET.ParseError:
-                e = get_exception()
-                raise SpeedtestConfigError(
-                    'Malformed speedtest.net configuration: %s' % e
-                )
-            server_config = root.find('server-config').attrib
-            download = root.find('download').attrib
-            upload = root.find('upload').attrib
-            # times = root.find('times').attrib
-            client = root.find('client').attrib
-
-        except AttributeError:
-            try:
-                root = DOM.parseString(configxml)
-            except ExpatError:
-                e = get_exception()
-                raise SpeedtestConfigError(
-                    'Malformed speedtest.net configuration: %s' % e
-                )
-            server_config = get_attributes_by_tag_name(root, 'server-config')
-            download = get_attributes_by_tag_name(root, 'download')
-            upload = get_attributes_by_tag_name(root, 'upload')
-            # times = get_attributes_by_tag_name(root, 'times')
-            client = get_attributes_by_tag_name(root, 'client')
-
-        ignore_servers = [
-            int(i) for i in server_config['ignoreids'].split(',') if i
-        ]
-
-        ratio = int(upload['ratio'])
-        upload_max = int(upload['maxchunkcount'])
-        up_sizes = [32768, 65536, 131072, 262144, 524288, 1048576, 7340032]
-        sizes = {
-            'upload': up_sizes[ratio - 1:],
-            'download': [350, 500, 750, 1000, 1500, 2000, 2500,
-                         3000, 3500, 4000]
-        }
-
-        size_count = len(sizes['upload'])
-
-        upload_count = int(math.ceil(upload_max / size_count))
-
-        counts = {
-            'upload': upload_count,
-            'download': int(download['threadsperurl'])
-        }
-
-        threads = {
-            'upload': int(upload['threads']),
-            'download': int(server_config['threadcount']) * 2
-        }
-
-        length = {
-            'upload': int(upload['testlength']),
-            'download': int(download['testlength'])
-        }
+        self._set_config(configxml)
+        if self._cache is not None:
+            self._cache.put('config', configxml.decode(), uh.headers)
 
-        self.config.update({
-            'client': client,
-            'ignore_servers': ignore_servers,
-            'sizes': sizes,
-            'counts': counts,
-            'threads': threads,
-            'length': length,
-            'upload_max': upload_count * size_count
-        })
+        return self.config
 
-        try:
-            self.lat_lon = (float(client['lat']), float(client['lon']))
-        except ValueError:
-            raise SpeedtestConfigError(
-                'Unknown location: lat=%r lon=%r' %
-                (client.get('lat'), client.get('lon'))
-            )
+    def _set_config(self, configxml):
+        config, self.lat_lon = parse_config(configxml)
+        self.config.update(config)
 
         printer('Config:\n%r' % self.config, debug=True)
 
@@ -1268,19 +2352,22 @@ class Speedtest(object):
                         '%s is an invalid server type, must be int' % s
                     )
 
-        urls = [
-            '://www.speedtest.net/speedtest-servers-static.php',
-            'http://c.speedtest.net/speedtest-servers-static.php',
-            '://www.speedtest.net/speedtest-servers.php',
-            'http://c.speedtest.net/speedtest-servers.php',
-        ]
-
-        headers = {}
-        if gzip:
-            headers['Accept-Encoding'] = 'gzip'
+        cache_name = servers_cache_name(self.config['client'], self.lat_lon,
+                                        servers, exclude)
+        cached = None
+        if self._cache is not None:
+            cached = self._cache.get(cache_name)
+            if self._cache.is_fresh(cached):
+                printer('Using cached server list', debug=True)
+                return self._set_servers(cached['data'])
 
         errors = []
-        for url in urls:
+        for url in SERVERS_URLS:
+            headers = {}
+            if cached is not None and cached['url'] == url:
+                headers.update(SpeedtestCache.conditional_headers(cached))
+            if gzip:
+                headers['Accept-Encoding'] = 'gzip'
             try:
                 request = build_request(
                     '%s?threads=%s' % (url,
@@ -1289,90 +2376,69 @@ class Speedtest(object):
                     secure=self._secure
                 )
                 uh, e = catch_request(request, opener=self._opener)
+                if e and getattr(e, 'code', None) == 304:
+                    self._cache.touch(cache_name, cached)
+                    return self._set_servers(cached['data'])
                 if e:
                     errors.append('%s' % e)
                     raise ServersRetrievalError()
 
+                if int(uh.code) != 200:
+                    uh.close()
+                    raise ServersRetrievalError()
+
                 stream = get_response_stream(uh)
 
-                serversxml_list = []
+                parser = ServerListParser(
+                    self.lat_lon, self.config['ignore_servers'],
+                    servers=servers, exclude=exclude
+                )
                 while 1:
                     try:
-                        serversxml_list.append(stream.read(1024))
+                        chunk = stream.read(SERVERS_CHUNK_SIZE)
                     except (OSError, EOFError):
                         raise ServersRetrievalError(get_exception())
-                    if len(serversxml_list[-1]) == 0:
+                    if len(chunk) == 0:
                         break
+                    parser.feed(chunk)
 
                 stream.close()
                 uh.close()
 
-                if int(uh.code) != 200:
-                    raise ServersRetrievalError()
-
-                serversxml = ''.encode().join(serversxml_list)
-
-                printer('Servers XML:\n%s' % serversxml, debug=True)
+                self.servers.update(parser.close())
 
-                try:
-                    try:
-                        try:
-                            root = ET.fromstring(serversxml)
-                        except ET.ParseError:
-                            e = get_exception()
-                            raise SpeedtestServersError(
-                                'Malformed speedtest.net server list: %s' % e
-                            )
-                        elements = etree_iter(root, 'server')
-                    except AttributeError:
-                        try:
-                            root = DOM.parseString(serversxml)
-                        except ExpatError:
-                            e = get_exception()
-                            raise SpeedtestServersError(
-                                'Malformed speedtest.net server list: %s' % e
-                            )
-                        elements = root.getElementsByTagName('server')
-                except (SyntaxError, xml.parsers.expat.ExpatError):
-                    raise ServersRetrievalError()
-
-                for server in elements:
-                    try:
-                        attrib = server.attrib
-                    except AttributeError:
-                        attrib = dict(list(server.attributes.items()))
-
-                    if servers and int(attrib.get('id')) not in servers:
-                        continue
-
-                    if (int(attrib.get('id')) in self.config['ignore_servers']
-                            or int(attrib.get('id')) in exclude):
-                        continue
-
-                    try:
-                        d = distance(self.lat_lon,
-                                     (float(attrib.get('lat')),
-                                      float(attrib.get('lon'))))
-                    except Exception:
-                        continue
-
-                    attrib['d'] = d
+                printer('Parsed %d servers, %d located' %
+                        (parser.count,
+                         sum(len(d) for d in self.servers.values())),
+                        debug=True)
 
-                    try:
-                        self.servers[d].append(attrib)
-                    except KeyError:
-                        self.servers[d] = [attrib]
+                if self._cache is not None and self.servers:
+                    self._cache.put(
+                        cache_name,
+                        [s for d in self.servers.values() for s in d],
+                        uh.headers, url
+                    )
 
                 break
 
             except ServersRetrievalError:
                 continue
 
+        if not self.servers and cached is not None:
+            printer('Using expired cached server list: %s' %
+                    ', '.join(errors), debug=True)
+            return self._set_servers(cached['data'])
+
         if (servers or exclude) and not self.servers:
             raise NoMatchedServers()
 
         return self.servers
 
+    def _set_servers(self, server_list):
+        self.servers.clear()
+        self.servers.update(group_servers(server_list))
+        return self.servers
+
     def set_mini_server(self, server):
         """Instead of querying for a list of servers, set a link to a
         speedtest mini server
@@ -1435,23 +2501,23 @@ class Speedtest(object):
         if not self.servers:
             self.get_servers()
 
-        for d in sorted(self.servers.keys()):
-            for s in self.servers[d]:
-                self.closest.append(s)
-                if len(self.closest) == limit:
-                    break
-            else:
-                continue
-            break
+        self.closest.extend(
+            closest_servers(self.servers, limit - len(self.closest))
+        )
 
         printer('Closest Servers:\n%r' % self.closest, debug=True)
         return self.closest
 
-    def get_best_server(self, servers=None):
+    def get_best_server(self, servers=None, deadline=None):
         """Perform a speedtest.net "ping" to determine which speedtest.net
         server has the lowest latency
+
+        Servers still probed after ``deadline`` seconds (by default the
+        HTTP timeout) are left out. The best of the closest servers is
+        stored in the server history
         """
 
+        selected = servers
         if not servers:
             if not self.closest:
                 servers = self.get_closest_servers()
@@ -1462,51 +2528,43 @@ class Speedtest(object):
         else:
             source_address_tuple = None
 
-        user_agent = build_user_agent()
+        if deadline is None:
+            deadline = self._timeout
+
+        # Servers are probed at the same time. Once a server finished its
+        # probes, the others are cancelled as soon as their time so far
+        # exceeds its total, since they can not be faster any more
+        done = threading.Condition()
+        probers = [LatencyProber(server, done,
+                                 source_address=source_address_tuple,
+                                 timeout=self._timeout, timings=self.timings)
+                   for server in servers]
+        for prober in probers:
+            prober.start()
+
+        stop = timeit.default_timer() + deadline
+        with done:
+            while True:
+                now = timeit.default_timer()
+                running = [p for p in probers if not p.finished]
+                if not running or now >= stop:
+                    break
+                wait = stop - now
+                finished = [p for p in probers if p.finished]
+                if finished:
+                    best_total = min(sum(p.cum) for p in finished)
+                    remaining = [best_total - p.elapsed(now) for p in running]
+                    if max(remaining) <= 0:
+                        break
+                    wait = min([wait] + [r for r in remaining if r > 0])
+                done.wait(wait)
 
         results = {}
-        for server in servers:
-            cum = []
-            url = os.path.dirname(server['url'])
-            stamp = int(timeit.time.time() * 1000)
-            latency_url = '%s/latency.txt?x=%s' % (url, stamp)
-            for i in range(0, 3):
-                this_latency_url = '%s.%s' % (latency_url, i)
-                printer('%s %s' % ('GET', this_latency_url),
-                        debug=True)
-                urlparts = urlparse(latency_url)
-                try:
-                    if urlparts[0] == 'https':
-                        h = SpeedtestHTTPSConnection(
-                            urlparts[1],
-                            source_address=source_address_tuple
-                        )
-                    else:
-                        h = SpeedtestHTTPConnection(
-                            urlparts[1],
-                            source_address=source_address_tuple
-                        )
-                    headers = {'User-Agent': user_agent}
-                    path = '%s?%s' % (urlparts[2], urlparts[4])
-                    start = timeit.default_timer()
-                    h.request("GET", path, headers=headers)
-                    r = h.getresponse()
-                    total = (timeit.default_timer() - start)
-                except HTTP_ERRORS:
-                    e = get_exception()
-                    printer('ERROR: %r' % e, debug=True)
-                    cum.append(3600)
-                    continue
-
-                text = r.read(9)
-                if int(r.status) == 200 and text == 'test=test'.encode():
-                    cum.append(total)
-                else:
-                    cum.append(3600)
-                h.close()
-
-            avg = round((sum(cum) / 6) * 1000.0, 3)
-            results[avg] = server
+        for prober in probers:
+            if not prober.finished:
+                prober.cancel()
+            # Probes that did not finish count as failed
+            results[prober.latency()] = prober.server
 
         try:
             fastest = sorted(results.keys())[0]
@@ -1521,8 +2579,121 @@ class Speedtest(object):
 
         self._best.update(best)
         printer('Best Server:\n%r' % best, debug=True)
+
+        if self._history is not None and not selected:
+            self._history.select(best)
         return best
 
+    def get_sticky_server(self, servers=None, exclude=None):
+        """Reuse the last best server of the history after a single latency
+        probe. Returns None when a new selection is due or the latency of the
+        server drifted, in which case ``get_servers`` and ``get_best_server``
+        must be used
+        """
+        if self._history is None:
+            return None
+
+        server = self._history.sticky_server(servers, exclude)
+        if server is None:
+            return None
+
+        if self._source_address:
+            source_address_tuple = (self._source_address, 0)
+        else:
+            source_address_tuple = None
+
+        prober = LatencyProber(server, threading.Condition(),
+                               source_address=source_address_tuple,
+                               timeout=self._timeout, probes=1,
+                               timings=self.timings)
+        prober.run()
+        latency = prober.latency()
+        if self._history.drifted(server, latency):
+            printer('Latency of server %s failed or drifted to %s ms' %
+                    (server['id'], latency), debug=True)
+            return None
+
+        best = dict(server, latency=latency)
+
+        self.results.ping = latency
+        self.results.server = best
+
+        self._best.update(best)
+        printer('Sticky Server:\n%r' % best, debug=True)
+        return best
+
+    def _phase_stop_event(self):
+        """Return the event that stops the requests of a download/upload
+        phase: the shutdown event, or in adaptive mode a new event that the
+        sampler sets once the throughput converges
+        """
+        if self._adaptive:
+            return threading.Event()
+        return self._shutdown_event
+
+    def _start_sampler(self, counter, start, stop_event):
+        if self._adaptive:
+            sampler = ThroughputSampler(counter, start,
+                                        converged=throughput_converged,
+                                        stop_event=stop_event,
+                                        shutdown_event=self._shutdown_event)
+        else:
+            sampler = ThroughputSampler(counter, start)
+        sampler.start()
+        return sampler
+
+    def _run_pool(self, fetch, url, jobs, threads, length,
+                  callback=do_nothing, counter=None, **kwargs):
+        """Run ``jobs`` with ``fetch`` on a fixed pool of ``threads``
+        keep-alive workers
+
+        Workers connect before the timer starts. Returns the total bytes
+        transferred, the start and stop times of the test and the samples
+        of ``counter()`` (by default, the bytes counted by the workers).
+        ``kwargs`` are passed to ``HTTPPoolWorker``
+        """
+        if self._source_address:
+            source_address_tuple = (self._source_address, 0)
+        else:
+            source_address_tuple = None
+
+        job_queue = Queue()
+        for job in jobs:
+            job_queue.put(job)
+
+        start_event = threading.Event()
+        stop_event = self._phase_stop_event()
+        workers = []
+        for _ in range(min(threads, len(jobs))):
+            workers.append(
+                HTTPPoolWorker(url, job_queue, start_event, length,
+                               len(jobs), fetch,
+                               source_address=source_address_tuple,
+                               http_timeout=self._timeout, callback=callback,
+                               shutdown_event=stop_event,
+                               timings=self.timings, **kwargs)
+            )
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.connected.wait()
+
+        if counter is None:
+            def counter():
+                return sum(worker.result for worker in workers)
+
+        start = timeit.default_timer()
+        sampler = self._start_sampler(counter, start, stop_event)
+        for worker in workers:
+            worker.starttime = start
+        start_event.set()
+        for worker in workers:
+            worker.join()
+        stop = timeit.default_timer()
+        samples = sampler.stop()
+
+        return sum(worker.result for worker in workers), start, stop, samples
+
     def download(self, callback=do_nothing, threads=None):
         """Test download speed against speedtest.net
 
@@ -1530,6 +2701,9 @@ class Speedtest(object):
         by the speedtest.net configuration
         """
 
+        # Connections made in the timed window use the cached address
+        RESOLVER.prefetch(self.best['url'], timings=self.timings)
+
         urls = []
         for size in self.config['sizes']['download']:
             for _ in range(0, self.config['counts']['download']):
@@ -1537,16 +2711,41 @@ class Speedtest(object):
                             (os.path.dirname(self.best['url']), size, size))
 
         request_count = len(urls)
+        max_threads = threads or self.config['threads']['download']
+
+        if self._keep_alive:
+            jobs = [(i, build_request_path(url, bump=i))
+                    for i, url in enumerate(urls)]
+            (self.results.bytes_received, start, stop,
+             self.results.download_samples) = self._run_pool(
+                pool_download, self.best['url'], jobs, max_threads,
+                self.config['length']['download'], callback,
+                chunk_size=self._chunk_size
+            )
+            self.results.download = (
+                (self.results.bytes_received / (stop - start)) * 8.0
+            )
+            self.results.download_steady = steady_throughput(
+                self.results.download_samples
+            )
+            if self.results.download > 100000:
+                self.config['threads']['upload'] = 8
+            return self.results.download
+
         requests = []
         for i, url in enumerate(urls):
             requests.append(
                 build_request(url, bump=i, secure=self._secure)
             )
 
-        max_threads = threads or self.config['threads']['download']
-        in_flight = {'threads': 0}
+        # Free thread slots and finished threads are signalled with a
+        # semaphore and a queue, so waiting threads block without polling
+        slots = threading.BoundedSemaphore(max_threads)
+        finished_threads = Queue()
+        started = []
+        stop_event = self._phase_stop_event()
 
-        def producer(q, requests, request_count):
+        def producer(requests, request_count):
             for i, request in enumerate(requests):
                 thread = HTTPDownloader(
                     i,
@@ -1554,46 +2753,47 @@ class Speedtest(object):
                     start,
                     self.config['length']['download'],
                     opener=self._opener,
-                    shutdown_event=self._shutdown_event
+                    shutdown_event=stop_event,
+                    finished=finished_threads,
+                    chunk_size=self._chunk_size
                 )
-                while in_flight['threads'] >= max_threads:
-                    timeit.time.sleep(0.001)
+                slots.acquire()
+                started.append(thread)
                 thread.start()
-                q.put(thread, True)
-                in_flight['threads'] += 1
                 callback(i, request_count, start=True)
 
         finished = []
 
-        def consumer(q, request_count):
-            _is_alive = thread_is_alive
+        def consumer(request_count):
             while len(finished) < request_count:
-                thread = q.get(True)
-                while _is_alive(thread):
-                    thread.join(timeout=0.001)
-                in_flight['threads'] -= 1
-                finished.append(sum(thread.result))
+                thread = finished_threads.get(True)
+                slots.release()
+                finished.append(thread.result)
                 callback(thread.i, request_count, end=True)
 
-        q = Queue(max_threads)
+        def counter():
+            return sum(thread.result for thread in started[:])
+
         prod_thread = threading.Thread(target=producer,
-                                       args=(q, requests, request_count))
+                                       args=(requests, request_count))
         cons_thread = threading.Thread(target=consumer,
-                                       args=(q, request_count))
+                                       args=(request_count,))
         start = timeit.default_timer()
+        sampler = self._start_sampler(counter, start, stop_event)
         prod_thread.start()
         cons_thread.start()
-        _is_alive = thread_is_alive
-        while _is_alive(prod_thread):
-            prod_thread.join(timeout=0.001)
-        while _is_alive(cons_thread):
-            cons_thread.join(timeout=0.001)
+        prod_thread.join()
+        cons_thread.join()
 
         stop = timeit.default_timer()
+        self.results.download_samples = sampler.stop()
         self.results.bytes_received = sum(finished)
         self.results.download = (
             (self.results.bytes_received / (stop - start)) * 8.0
         )
+        self.results.download_steady = steady_throughput(
+            self.results.download_samples
+        )
         if self.results.download > 100000:
             self.config['threads']['upload'] = 8
         return self.results.download
@@ -1605,6 +2805,8 @@ class Speedtest(object):
         by the speedtest.net configuration
         """
 
+        RESOLVER.prefetch(self.best['url'], timings=self.timings)
+
         sizes = []
 
         for size in self.config['sizes']['upload']:
@@ -1614,6 +2816,12 @@ class Speedtest(object):
         # request_count = len(sizes)
         request_count = self.config['upload_max']
 
+        if pre_allocate and sizes:
+            # Build the shared payload once at the largest size
+            get_upload_payload(max(sizes))
+
+        stop_event = self._phase_stop_event()
+
         requests = []
         for i, size in enumerate(sizes):
             # We set ``0`` for ``start`` and handle setting the actual
@@ -1622,7 +2830,7 @@ class Speedtest(object):
                 size,
                 0,
                 self.config['length']['upload'],
-                shutdown_event=self._shutdown_event
+                shutdown_event=stop_event
             )
             if pre_allocate:
                 data.pre_allocate()
@@ -1637,9 +2845,33 @@ class Speedtest(object):
             )
 
         max_threads = threads or self.config['threads']['upload']
-        in_flight = {'threads': 0}
 
-        def producer(q, requests, request_count):
+        uploads = [request[0].data for request in requests[:request_count]]
+
+        def counter():
+            return sum(upload.total for upload in uploads)
+
+        if self._keep_alive:
+            jobs = [(i, build_request_path(self.best['url'], bump=i),
+                     request[0].data)
+                    for i, request in enumerate(requests[:request_count])]
+            (self.results.bytes_sent, start, stop,
+             self.results.upload_samples) = self._run_pool(
+                pool_upload, self.best['url'], jobs, max_threads,
+                self.config['length']['upload'], callback, counter=counter
+            )
+            self.results.upload = (
+                (self.results.bytes_sent / (stop - start)) * 8.0
+            )
+            self.results.upload_steady = steady_throughput(
+                self.results.upload_samples
+            )
+            return self.results.upload
+
+        slots = threading.BoundedSemaphore(max_threads)
+        finished_threads = Queue()
+
+        def producer(requests, request_count):
             for i, request in enumerate(requests[:request_count]):
                 thread = HTTPUploader(
                     i,
@@ -1648,46 +2880,42 @@ class Speedtest(object):
                     request[1],
                     self.config['length']['upload'],
                     opener=self._opener,
-                    shutdown_event=self._shutdown_event
+                    shutdown_event=stop_event,
+                    finished=finished_threads
                 )
-                while in_flight['threads'] >= max_threads:
-                    timeit.time.sleep(0.001)
+                slots.acquire()
                 thread.start()
-                q.put(thread, True)
-                in_flight['threads'] += 1
                 callback(i, request_count, start=True)
 
         finished = []
 
-        def consumer(q, request_count):
-            _is_alive = thread_is_alive
+        def consumer(request_count):
             while len(finished) < request_count:
-                thread = q.get(True)
-                while _is_alive(thread):
-                    thread.join(timeout=0.001)
-                in_flight['threads'] -= 1
+                thread = finished_threads.get(True)
+                slots.release()
                 finished.append(thread.result)
                 callback(thread.i, request_count, end=True)
 
-        q = Queue(threads or self.config['threads']['upload'])
         prod_thread = threading.Thread(target=producer,
-                                       args=(q, requests, request_count))
+                                       args=(requests, request_count))
         cons_thread = threading.Thread(target=consumer,
-                                       args=(q, request_count))
+                                       args=(request_count,))
         start = timeit.default_timer()
+        sampler = self._start_sampler(counter, start, stop_event)
         prod_thread.start()
         cons_thread.start()
-        _is_alive = thread_is_alive
-        while _is_alive(prod_thread):
-            prod_thread.join(timeout=0.1)
-        while _is_alive(cons_thread):
-            cons_thread.join(timeout=0.1)
+        prod_thread.join()
+        cons_thread.join()
 
         stop = timeit.default_timer()
+        self.results.upload_samples = sampler.stop()
         self.results.bytes_sent = sum(finished)
         self.results.upload = (
             (self.results.bytes_sent / (stop - start)) * 8.0
         )
+        self.results.upload_steady = steady_throughput(
+            self.results.upload_samples
+        )
         return self.results.upload
 
 
@@ -1717,7 +2945,7 @@ def csv_header(delimiter=','):
     sys.exit(0)
 
 
-def parse_args():
+def parse_args(argv=None):
     """Function to handle building and parsing of command line arguments"""
     description = (
         'Command line interface for testing internet bandwidth using '
@@ -1778,6 +3006,13 @@ def parse_args():
                              'supplied multiple times')
     parser.add_argument('--mini', help='URL of the Speedtest Mini server')
     parser.add_argument('--source', help='Source IP address to bind to')
+    parser.add_argument('--pin-host', action='append', default=[],
+                        help='HOST=ADDRESS. Connect to ADDRESS instead of '
+                             'resolving HOST. Can be supplied multiple times')
+    parser.add_argument('--dns-ttl', default=DNS_CACHE_TTL,
+                        type=PARSER_TYPE_FLOAT,
+                        help='Seconds name resolutions are cached. Default '
+                             '%s' % DNS_CACHE_TTL)
     parser.add_argument('--timeout', default=10, type=PARSER_TYPE_FLOAT,
                         help='HTTP timeout in seconds. Default 10')
     parser.add_argument('--secure', action='store_true',
@@ -1790,12 +3025,53 @@ def parse_args():
                              'performance. To support systems with '
                              'insufficient memory, use this option to avoid a '
                              'MemoryError')
+    parser.add_argument('--no-keep-alive', dest='keep_alive',
+                        action='store_const', default=True, const=False,
+                        help='Open a new connection and thread for every '
+                             'download/upload request instead of using a '
+                             'fixed pool of keep-alive connections')
+    parser.add_argument('--chunk-size', default=DOWNLOAD_CHUNK_SIZE,
+                        type=PARSER_TYPE_INT,
+                        help='Size in bytes of the buffer each download '
+                             'connection reads into. Default %s'
+                             % DOWNLOAD_CHUNK_SIZE)
+    parser.add_argument('--adaptive', action='store_true',
+                        help='End the download and upload tests early once '
+                             'the measured speed is stable. The test length '
+                             'of the speedtest.net configuration is still '
+                             'the maximum')
+    parser.add_argument('--cache-file',
+                        help='Cache the speedtest.net configuration and '
+                             'server list in this file')
+    parser.add_argument('--cache-ttl', default=3600, type=PARSER_TYPE_INT,
+                        help='Seconds the cached configuration and server '
+                             'list are used before they are refreshed. '
+                             'Default 3600')
+    parser.add_argument('--cache-key', default='',
+                        help='Key of the cache entries, e.g. the name of the '
+                             'network')
+    parser.add_argument('--history-file',
+                        help='Reuse the last best server, stored with the '
+                             'latency and throughput of the servers in this '
+                             'file under --history-key')
+    parser.add_argument('--history-key', default='',
+                        help='Key of the server history, e.g. the name of '
+                             'the network')
+    parser.add_argument('--history-reselect', default=86400,
+                        type=PARSER_TYPE_INT,
+                        help='Seconds a best server is reused before a new '
+                             'selection. Default 86400')
+    parser.add_argument('--history-drift', default=0.5,
+                        type=PARSER_TYPE_FLOAT,
+                        help='Select a new best server when the latency of '
+                             'the last one is more than this fraction above '
+                             'its median. Default 0.5')
     parser.add_argument('--version', action='store_true',
                         help='Show the version number and exit')
     parser.add_argument('--debug', action='store_true',
                         help=ARG_SUPPRESS, default=ARG_SUPPRESS)
 
-    options = parser.parse_args()
+    options = parser.parse_args(argv)
     if isinstance(options, tuple):
         args = options[0]
     else:
@@ -1843,15 +3119,17 @@ def printer(string, quiet=False, debug=False, error=False, **kwargs):
         logger.info(out) # NOTE: 
 
 
-def shell():
-    """Run the full speedtest.net test"""
+def shell(argv=None):
+    """Run the full speedtest.net test. ``argv`` defaults to the command
+    line arguments
+    """
 
     global DEBUG
     shutdown_event = threading.Event()
 
     signal.signal(signal.SIGINT, ctrl_c(shutdown_event))
 
-    args = parse_args()
+    args = parse_args(argv)
     args.json = True # NOTE: 
 
     # Print the version and exit
@@ -1892,12 +3170,38 @@ def shell():
     else:
         callback = print_dots(shutdown_event)
 
+    RESOLVER.ttl = args.dns_ttl
+    for pin in args.pin_host:
+        host, sep, address = pin.partition('=')
+        if not sep or not host or not address:
+            raise SpeedtestCLIError('--pin-host must be HOST=ADDRESS: %s' %
+                                    pin)
+        RESOLVER.pin(host, address)
+
+    if args.cache_file:
+        cache = SpeedtestCache(args.cache_file, ttl=args.cache_ttl,
+                               key=args.cache_key)
+    else:
+        cache = None
+
+    if args.history_file:
+        history = ServerHistory(args.history_file, key=args.history_key,
+                                reselect_after=args.history_reselect,
+                                drift=args.history_drift)
+    else:
+        history = None
+
     printer('Retrieving speedtest.net configuration...', quiet)
     try:
         speedtest = Speedtest(
             source_address=args.source,
             timeout=args.timeout,
-            secure=args.secure
+            secure=args.secure,
+            keep_alive=args.keep_alive,
+            chunk_size=args.chunk_size,
+            adaptive=args.adaptive,
+            cache=cache,
+            history=history
         )
     except (ConfigRetrievalError,) + HTTP_ERRORS:
         printer('Cannot retrieve speedtest configuration', error=True)
@@ -1926,6 +3230,14 @@ def shell():
             quiet)
 
     if not args.mini:
+        sticky = speedtest.get_sticky_server(servers=args.server,
+                                             exclude=args.exclude)
+    else:
+        sticky = None
+
+    if sticky is not None:
+        printer('Reusing the last best server...', quiet)
+    elif not args.mini:
         printer('Retrieving speedtest.net server list...', quiet)
         try:
             speedtest.get_servers(servers=args.server, exclude=args.exclude)
@@ -1985,6 +3297,9 @@ def shell():
     else:
         printer('Skipping upload test', quiet)
 
+    if history is not None and not args.mini:
+        history.record(results)
+
     printer('Results:\n%r' % results.dict(), debug=True)
 
     if not args.simple and args.share:
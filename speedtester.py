@@ -8,7 +8,12 @@ import json
 import logging
 from logging import getLogger, config
 import speedtest_cli
+import speedtest_async
 from dateutil import tz
+from records_store import get_records_store, to_record_value
+from records_rollup import network_label
+from records_writer import start_records_writer
+from latency_monitor import LatencyMonitor
 
 with open('./log_config.json', 'r') as f:
     log_conf = json.load(f)
@@ -25,14 +30,82 @@ class SpeedtestError(Exception):
         super().__init__(message)
 
 
-def exec_speedtest():
+def load_speedtest_config(path="./app_config.json"):
+    try:
+        with open(path, "r") as f:
+            return json.load(f).get("speedtest", {})
+    except FileNotFoundError:
+        return {}
+
+
+def speedtest_cli_args(speedtest_config: dict, network: str = None):
+    args = []
+    if speedtest_config.get("adaptive", False):
+        args.append("--adaptive")
+    if speedtest_config.get("cache_path"):
+        args += [
+            "--cache-file", speedtest_config["cache_path"],
+            "--cache-ttl", str(speedtest_config.get("cache_ttl", 3600)),
+            "--cache-key", network or "",
+        ]
+    if speedtest_config.get("dns_ttl") is not None:
+        args += ["--dns-ttl", str(speedtest_config["dns_ttl"])]
+    for host, address in speedtest_config.get("pinned_hosts", {}).items():
+        args += ["--pin-host", f"{host}={address}"]
+    if speedtest_config.get("history_path"):
+        args += [
+            "--history-file", speedtest_config["history_path"],
+            "--history-reselect", str(speedtest_config.get("reselect_interval", 86400)),
+            "--history-drift", str(speedtest_config.get("latency_drift", 0.5)),
+            "--history-key", network or "",
+        ]
+    return args
+
+
+def configure_resolver(speedtest_config: dict):
+    """
+    Apply "dns_ttl" and "pinned_hosts" to the name resolution cache of this process.
+    """
+    if speedtest_config.get("dns_ttl") is not None:
+        speedtest_cli.RESOLVER.ttl = speedtest_config["dns_ttl"]
+    for host, address in speedtest_config.get("pinned_hosts", {}).items():
+        speedtest_cli.RESOLVER.pin(host, address)
+
+
+def exec_speedtest(speedtest_config: dict = None, network: str = None):
     """
     Ref: https://github.com/sivel/speedtest-cli/wiki
+    The "asyncio" engine runs the same test on non-blocking sockets in one thread (speedtest_async).
+    With "adaptive", download and upload end once their throughput is stable.
+    The speedtest.net configuration and server list are cached per network in "cache_path".
+    The best server of each network is reused from "history_path" until it is due for reselection or drifted.
+    Name resolutions are cached for "dns_ttl" seconds, and "pinned_hosts" maps host names to fixed addresses.
     """
+    if speedtest_config is None:
+        speedtest_config = load_speedtest_config()
     start_time = time.time()
     results_dict = {}
     try:
-        results_dict = speedtest_cli.shell()
+        if speedtest_config.get("engine", "threads") == "asyncio":
+            configure_resolver(speedtest_config)
+            cache = None
+            if speedtest_config.get("cache_path"):
+                cache = speedtest_cli.SpeedtestCache(
+                    speedtest_config["cache_path"], ttl=speedtest_config.get("cache_ttl", 3600), key=network or ""
+                )
+            history = None
+            if speedtest_config.get("history_path"):
+                history = speedtest_cli.ServerHistory(
+                    speedtest_config["history_path"], key=network or "",
+                    reselect_after=speedtest_config.get("reselect_interval", 86400),
+                    drift=speedtest_config.get("latency_drift", 0.5),
+                )
+            results_dict = speedtest_async.run_speedtest(
+                streams=speedtest_config.get("streams"), adaptive=speedtest_config.get("adaptive", False), cache=cache,
+                history=history,
+            )
+        else:
+            results_dict = speedtest_cli.shell(speedtest_cli_args(speedtest_config, network))
     except Exception as e:
         logger.error(f'ERROR Exception: {e}')
     end_time = time.time()
@@ -64,7 +137,18 @@ def convert_format_to_dataframe(results_dict):
     client_results_df = (
         pd.DataFrame.from_dict(client_results_dict, orient="index").T.add_prefix("client_").reset_index(drop=True)
     )
-    df = pd.concat([base_results_df, server_results_df, client_results_df], axis=1).reset_index(drop=True)
+    # p50/p95 (ms) of the connection phases, see speedtest_cli.ConnectionTimings
+    timings_dict = results_dict.get("timings", {})
+    timing_results_df = pd.DataFrame(
+        [{
+            f"{phase}_{stat}": timings_dict.get(phase, {}).get(stat)
+            for phase in speedtest_cli.CONNECTION_PHASES
+            for stat in ["p50", "p95"]
+        }]
+    )
+    df = pd.concat(
+        [base_results_df, server_results_df, client_results_df, timing_results_df], axis=1
+    ).reset_index(drop=True)
     return df
 
 
@@ -153,6 +237,20 @@ class SpeedTester:
         self.active = False
         self.start_time = None
         self.elapsed_iterations_at_pause = 0
+        self.speedtest_config = load_speedtest_config()
+        self.records_queue = multiprocessing.Queue()
+        self.records_writer = None
+        self.latency_monitor = None
+        self.processes = []
+
+    def __getstate__(self):
+        # records_writer, latency_monitor and processes belong to the main process
+        # and are not sent to measurement subprocesses.
+        state = self.__dict__.copy()
+        state["records_writer"] = None
+        state["latency_monitor"] = None
+        state["processes"] = []
+        return state
 
     def get_status_string(self):
         status_string = ""
@@ -172,26 +270,26 @@ class SpeedTester:
         self.pause = False
         self.done = False
         self.start_time = time.time()
+        self.start_latency_monitor()
         logger.info("SpeedTester started")
 
     def restart(self):
         self.active = True
         self.pause = False
         self.done = False
+        self.start_latency_monitor()
         logger.info("SpeedTester restarted")
 
     def pause_iterations(self):
         self.active = False
         self.pause = True
         self.elapsed_iterations_at_pause = self.elapsed_iterations
+        self.stop_latency_monitor()
         logger.info("SpeedTester paused")
 
-    def measure_subprocess(self, log_queue: multiprocessing.Queue):
+    def measure_subprocess(self, log_queue: multiprocessing.Queue, records_queue: multiprocessing.Queue = None):
         logger.info(f"Start measuring in subprocess")
-        try:
-            records_df = pd.read_csv("records.csv")
-        except:
-            records_df = pd.read_csv("records_init.csv")
+        new_records_df = None
 
         wifi_physical_name = None
         connected_vpn = None
@@ -200,7 +298,7 @@ class SpeedTester:
             logger.info(f"wifi_physical_name: {wifi_physical_name}")
         except Exception as e:
             logger.error(f"Caused {type(e).__name__}: {e}")
-            return records_df
+            return new_records_df
 
         try:
             vpn_list = get_vpn_list()
@@ -208,24 +306,26 @@ class SpeedTester:
                 connected_vpn = get_connected_vpn(vpn_list)
         except Exception as e:
             logger.error(f"Caused {type(e).__name__}: {e}")
-            return records_df
+            return new_records_df
 
         try:
-            results_dict, elapsed_time = exec_speedtest()
+            results_dict, elapsed_time = exec_speedtest(
+                self.speedtest_config, network_label(wifi_physical_name, connected_vpn)
+            )
         except Exception as e:
             logger.error(f"Caused {type(e).__name__}: {e}")
-            return records_df
+            return new_records_df
         
         try:
             after_wifi_physical_name = get_current_wifi_physical_name()
         except Exception as e:
             logger.error(f"Caused {type(e).__name__}: {e}")
-            return records_df
+            return new_records_df
         
         if wifi_physical_name != after_wifi_physical_name:
             message = "wifi_physical_name changed during measuring. (before={wifi_physical_name}, after={after_wifi_physical_name})"
             logger.error(f"Caused error: {message}")
-            return records_df
+            return new_records_df
         else:
             try:
                 new_records_df = convert_format_to_dataframe(results_dict)
@@ -233,13 +333,16 @@ class SpeedTester:
                 new_records_df["connected_vpn"] = connected_vpn
                 new_records_df["pid"] = multiprocessing.current_process().pid
                 new_records_df["elapsed_time"] = elapsed_time
-                records_df = pd.concat([records_df, new_records_df], axis=0).reset_index(drop=True)
-                records_df.to_csv("records.csv", index=False)
+                row = {k: to_record_value(v) for k, v in new_records_df.iloc[0].to_dict().items()}
+                if records_queue is not None:
+                    records_queue.put(row)
+                else:
+                    get_records_store().append(row)
                 logger.info(f"Completed subprocess successfully")
             except Exception as e:
                 logger.error(f"Caused error in subprocess: {e}")
 
-        return records_df
+        return new_records_df
 
     def measure(self):
         log_queue = multiprocessing.Queue()
@@ -251,10 +354,14 @@ class SpeedTester:
             self.remained_iterations = 0
             self.done = True
             self.active = False
+            self.stop_latency_monitor()
         elif self.active and not self.done:
             logger.info(f"Start measuring: {self.get_status_string()}")
-            process = Process(target=self.measure_subprocess, args=(log_queue,))
+            self.start_writer()
+            self.join_finished_processes()
+            process = Process(target=self.measure_subprocess, args=(log_queue, self.records_queue))
             process.start()
+            self.processes.append(process)
             time.sleep(0.5)
             self.elapsed_iterations += 1
             self.remained_iterations = self.iterations - self.elapsed_iterations
@@ -262,6 +369,67 @@ class SpeedTester:
 
         return flg
 
+    def start_writer(self):
+        if self.records_writer is None or not self.records_writer.is_alive():
+            self.records_writer = start_records_writer(self.records_queue)
+
+    def latency_target(self):
+        """
+        The last best server of the current network in the server history, and the network.
+        """
+        wifi_physical_name = get_current_wifi_physical_name()
+        vpn_list = get_vpn_list()
+        connected_vpn = get_connected_vpn(vpn_list) if len(vpn_list) > 0 else None
+        history = speedtest_cli.ServerHistory(
+            self.speedtest_config["history_path"], key=network_label(wifi_physical_name, connected_vpn) or ""
+        )
+        return history.get().get("server"), wifi_physical_name, connected_vpn
+
+    def start_latency_monitor(self):
+        """
+        With "latency_monitor", probe the latency of the last best server between measurements.
+        The server comes from "history_path", so the monitor starts probing after the first measurement.
+        Summaries go through the records writer, and hosts resolve as in the measurements.
+        """
+        if not self.speedtest_config.get("latency_monitor") or not self.speedtest_config.get("history_path"):
+            return
+        if self.latency_monitor is not None and self.latency_monitor.is_alive():
+            return
+        configure_resolver(self.speedtest_config)
+        self.start_writer()
+        self.latency_monitor = LatencyMonitor(
+            self.latency_target,
+            self.records_writer,
+            interval=self.speedtest_config.get("latency_interval", 1.0),
+            window=self.speedtest_config.get("latency_window", 60),
+            summary_interval=self.speedtest_config.get("latency_summary_interval", 60),
+            paused=lambda: any(p.is_alive() for p in self.processes),
+        )
+        self.latency_monitor.start()
+
+    def stop_latency_monitor(self):
+        if self.latency_monitor is not None:
+            self.latency_monitor.stop()
+            self.latency_monitor = None
+
+    def join_finished_processes(self):
+        for process in self.processes:
+            if not process.is_alive():
+                process.join()
+        self.processes = [p for p in self.processes if p.is_alive()]
+
+    def close(self):
+        """
+        Wait for running measurements and commit their records.
+        """
+        self.stop_latency_monitor()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        if self.records_writer is not None:
+            self.records_writer.stop()
+            self.records_writer = None
+
     def set_params(self, frequency, iterations):
         self.frequency = frequency
         self.iterations = iterations
@@ -269,6 +437,7 @@ class SpeedTester:
         logger.info(f"Set new parameters: frequency={self.frequency}, iterations={self.iterations}")
 
     def reset(self):
+        self.stop_latency_monitor()
         self.done = False
         self.active = False
         self.pause = False
@@ -287,3 +456,4 @@ if __name__ == "__main__":
     while not speedtester.done:
         speedtester.measure()
         time.sleep(frequency)
+    speedtester.close()
@@ -0,0 +1,171 @@
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The app modules read records_init.csv and log_config.json relative to the working directory on import,
+# and log into logs.log there. Tests run in a temporary copy of them, so the logs of the repo are left alone.
+WORKDIR = tempfile.mkdtemp(prefix="speedtest-logger-tests-")
+for filename in ["records_init.csv", "log_config.json", "app_config.json"]:
+    shutil.copy(os.path.join(ROOT, filename), WORKDIR)
+os.chdir(WORKDIR)
+sys.path.insert(0, ROOT)
+
+CONFIG_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<settings>
+<client ip="127.0.0.1" lat="35.68" lon="139.69" isp="Test ISP" isprating="3.7" rating="0" ispdlavg="0" ispulavg="0"
+ loggedin="0" country="JP" />
+<server-config threadcount="2" ignoreids="" notonmap="" forcepingid="" preferredserverid="" />
+<download testlength="1" initialtest="250K" mintestsize="250K" threadsperurl="2" />
+<upload testlength="1" ratio="5" initialtest="0" mintestsize="32K" threads="2" maxchunksize="512K"
+ maxchunkcount="10" threadsperurl="4" />
+</settings>
+"""
+
+
+def pytest_unconfigure(config):
+    os.chdir(ROOT)
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+@pytest.fixture
+def make_row():
+    """
+    Factory of records rows on the home network. Other columns are given as keyword arguments.
+    """
+    def make_row(timestamp, wifi_physical_name="home", connected_vpn=None, **values):
+        row = {
+            "timestamp": timestamp,
+            "wifi_physical_name": wifi_physical_name,
+            "connected_vpn": connected_vpn,
+            "download": 100.0,
+            "upload": 50.0,
+            "ping": 10.0,
+        }
+        row.update(values)
+        return row
+    return make_row
+
+
+class SpeedtestHandler(BaseHTTPRequestHandler):
+    """
+    Minimal speedtest.net server: latency.txt, random{size}x{size}.jpg downloads and uploads, on keep-alive connections.
+    latency.txt is answered after server.latency_delay seconds, and bodies are throttled to 64 KiB every
+    server.write_delay seconds.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body: bytes):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not self.server.write_delay:
+            self.wfile.write(body)
+            return
+        try:
+            for i in range(0, len(body), 65536):
+                time.sleep(self.server.write_delay)
+                self.wfile.write(body[i:i + 65536])
+        except ConnectionError:
+            # The client stopped reading at the end of the test
+            self.close_connection = True
+
+    def do_GET(self):
+        self.server.requests += 1
+        path = self.path.split("?")[0]
+        if path.endswith("/latency.txt"):
+            time.sleep(self.server.latency_delay)
+            self.send_body(b"test=test")
+        elif "/random" in path:
+            size = int(path.split("random")[1].split("x")[0])
+            self.send_body(b"x" * (size * size // 8))
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def do_POST(self):
+        self.server.requests += 1
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining > 0:
+            chunk = self.rfile.read(min(65536, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+        self.send_body(b"size=%d" % int(self.headers.get("Content-Length", 0)))
+
+
+@pytest.fixture
+def start_speedtest_server():
+    """
+    Start SpeedtestHandler servers, stopped at the end of the test.
+    """
+    servers = []
+
+    def start_speedtest_server():
+        server = ThreadingHTTPServer(("127.0.0.1", 0), SpeedtestHandler)
+        server.daemon_threads = True
+        server.requests = 0
+        server.latency_delay = 0
+        server.write_delay = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start_speedtest_server
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def speedtest_server(start_speedtest_server):
+    return start_speedtest_server()
+
+
+@pytest.fixture
+def server_entry():
+    """
+    Entry of the server list for a server listening on port.
+    """
+    def server_entry(port: int, server_id: str = "1"):
+        return {
+            "url": f"http://127.0.0.1:{port}/speedtest/upload.php",
+            "lat": "35.68", "lon": "139.69", "name": "Tokyo", "country": "Japan", "cc": "JP",
+            "sponsor": "Test", "id": server_id, "host": f"127.0.0.1:{port}", "d": 0.5,
+        }
+    return server_entry
+
+
+@pytest.fixture
+def unused_port():
+    """
+    A local port nothing listens on, so connections are refused.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def speedtest_cache(tmp_path, speedtest_server, server_entry):
+    """
+    A fresh cache of the configuration and of a server list pointing to speedtest_server,
+    so tests never reach speedtest.net.
+    """
+    import speedtest_cli
+    cache = speedtest_cli.SpeedtestCache(str(tmp_path / "speedtest_cache.json"))
+    cache.put("config", CONFIG_XML)
+    config, lat_lon = speedtest_cli.parse_config(CONFIG_XML.encode())
+    servers = [server_entry(speedtest_server.server_address[1])]
+    cache.put(speedtest_cli.servers_cache_name(config["client"], lat_lon, [], []), servers)
+    return cache
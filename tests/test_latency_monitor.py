@@ -0,0 +1,119 @@
+import csv
+import time
+import pytest
+from latency_monitor import LatencyMonitor, LatencyProbe, RingBuffer
+from records_export import export_latency
+from records_store import CsvRecordsStore, SqliteRecordsStore
+
+
+class SummaryStore:
+    def __init__(self):
+        self.summaries = []
+
+    def append_latency(self, rows):
+        self.summaries += rows
+
+
+def wait_until(condition, timeout: float = 5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_ring_buffer_keeps_the_last_values():
+    ring = RingBuffer(3)
+    for value in [5.0, 1.0, 4.0, 2.0, 3.0]:
+        ring.append(value)
+
+    assert len(ring) == 3
+    assert ring.sorted() == [2.0, 3.0, 4.0]
+    ring.clear()
+    assert len(ring) == 0
+    assert ring.sorted() == []
+
+
+def test_summary_statistics_and_lost_probes():
+    server = {"id": "1", "host": "speedtest.example.net:8080"}
+    monitor = LatencyMonitor(lambda: (server, "home", None), SummaryStore(), window=100)
+    monitor.target = (server, "home", None)
+    for rtt in [0.010, 0.030, None, 0.020, 0.040]:
+        monitor.record(rtt)
+
+    summary = monitor.summary()
+    assert (summary["probes"], summary["lost"]) == (5, 1)
+    assert (summary["rtt_min"], summary["rtt_max"]) == pytest.approx((10.0, 40.0))
+    assert summary["rtt_p50"] == pytest.approx(25.0)
+    assert summary["rtt_p95"] == pytest.approx(38.5)
+    assert summary["rtt_p99"] == pytest.approx(39.7)
+    # Deltas are 20 and 20 ms, the lost probe breaks the sequence
+    assert summary["jitter"] == pytest.approx(20.0)
+    assert (summary["server_id"], summary["wifi_physical_name"]) == ("1", "home")
+
+
+def test_summary_covers_the_last_window():
+    monitor = LatencyMonitor(lambda: (None, None, None), SummaryStore(), window=2)
+    for rtt in [0.100, 0.010, 0.020, 0.030]:
+        monitor.record(rtt)
+
+    summary = monitor.summary()
+    assert summary["probes"] == 4
+    assert (summary["rtt_min"], summary["rtt_max"]) == pytest.approx((20.0, 30.0))
+    assert summary["jitter"] == pytest.approx(10.0)
+
+
+def test_probe_reuses_its_connection(speedtest_server, server_entry):
+    probe = LatencyProbe(server_entry(speedtest_server.server_address[1]))
+    assert probe.probe() > 0
+    connection = probe.connection
+    assert probe.probe() > 0
+    assert probe.connection is connection
+    probe.close()
+    assert speedtest_server.requests == 2
+
+
+def test_probe_of_a_dead_server_is_lost(server_entry, unused_port):
+    probe = LatencyProbe(server_entry(unused_port), timeout=1)
+    assert probe.probe() is None
+    assert probe.connection is None
+
+
+def test_monitor_writes_summaries_and_pauses(speedtest_server, server_entry):
+    server = server_entry(speedtest_server.server_address[1])
+    store = SummaryStore()
+    paused = [False]
+    monitor = LatencyMonitor(
+        lambda: (server, "home", None), store, interval=0.01, summary_interval=0.2, paused=lambda: paused[0]
+    )
+    monitor.start()
+    assert wait_until(lambda: len(store.summaries) >= 1)
+
+    paused[0] = True
+    time.sleep(0.05)
+    requests = speedtest_server.requests
+    time.sleep(0.3)
+    assert speedtest_server.requests == requests
+    paused[0] = False
+    assert wait_until(lambda: speedtest_server.requests > requests)
+    monitor.stop()
+
+    assert all(summary["server_id"] == "1" and summary["lost"] == 0 for summary in store.summaries)
+    # Summaries written while paused have no probes, and are skipped
+    assert sum(summary["probes"] for summary in store.summaries) == speedtest_server.requests
+
+
+@pytest.mark.parametrize(
+    "store_class, filename", [(CsvRecordsStore, "records.csv"), (SqliteRecordsStore, "records.sqlite3")]
+)
+def test_latency_summaries_are_exported(tmp_path, store_class, filename):
+    store = store_class(str(tmp_path / filename))
+    assert export_latency(store, str(tmp_path / "latency.csv")) is None
+    store.append_latency([
+        {"timestamp": f"2024-01-0{day}T10:00:00.000000Z", "server_id": "1", "probes": 60, "lost": day}
+        for day in [1, 2, 3]
+    ])
+
+    filepath = export_latency(store, str(tmp_path / "latency.csv"), start="2024-01-02T00:00:00")
+    with open(filepath, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["lost"] for row in rows] == ["2", "3"]
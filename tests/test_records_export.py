@@ -0,0 +1,28 @@
+import csv
+import gzip
+import pytest
+from records_export import export_records
+from records_store import CsvRecordsStore, SqliteRecordsStore
+
+
+@pytest.mark.parametrize(
+    "store_class, filename", [(CsvRecordsStore, "records.csv"), (SqliteRecordsStore, "records.sqlite3")]
+)
+def test_export_round_trip(tmp_path, store_class, filename, make_row):
+    store = store_class(str(tmp_path / filename))
+    store.append_many([
+        make_row(f"2024-01-0{day}T10:00:00.000000Z", "home" if day % 2 else "office") for day in range(1, 6)
+    ])
+
+    filepath = export_records(store, str(tmp_path / "export.csv"), compression="gzip", chunk_rows=2)
+
+    assert filepath.endswith("export.csv.gz")
+    with gzip.open(filepath, "rt", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["timestamp"][:10] for row in rows] == [f"2024-01-0{day}" for day in range(1, 6)]
+
+    filepath = export_records(store, str(tmp_path / "office.csv"), wifi_physical_name="office", chunk_rows=1)
+    with open(filepath, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["timestamp"][:10] for row in rows] == ["2024-01-02", "2024-01-04"]
+    assert list(rows[0].keys()) == store.export_columns()
@@ -0,0 +1,77 @@
+import io
+import os
+import csv
+import threading
+import pytest
+from records_index import TimeIndex
+from records_store import CsvRecordsStore, file_lock
+
+
+def test_index_reads_only_overlapping_hours(tmp_path, make_row):
+    store = CsvRecordsStore(str(tmp_path / "records.csv"))
+    store.append_many([make_row(f"2024-01-01T{hour:02d}:00:00.000000Z") for hour in range(10)])
+
+    data = store.index.read_bytes("2024-01-01T03:30:00", "2024-01-01T04:10:00")
+    rows = list(csv.DictReader(io.StringIO(data.decode())))
+    assert [row["timestamp"][:13] for row in rows] == ["2024-01-01T03", "2024-01-01T04"]
+    assert store.read(start="2024-01-01T03:30:00", end="2024-01-01T04:10:00")["timestamp"].tolist() == [
+        "2024-01-01T04:00:00.000000Z"
+    ]
+    assert store.index.byte_range("2024-02-01T00:00:00") is None
+
+
+def test_index_indexes_appended_lines_incrementally(tmp_path, make_row):
+    store = CsvRecordsStore(str(tmp_path / "records.csv"))
+    store.append(make_row("2024-01-01T00:00:00.000000Z"))
+    size = store.index.load()["size"]
+
+    store.append(make_row("2024-01-01T05:00:00.000000Z"))
+
+    index = store.index.load()
+    assert index["size"] == os.path.getsize(store.path) > size
+    assert index["buckets"]["2024-01-01T05"][0] == size
+
+
+def test_index_is_rebuilt_when_the_file_was_rewritten(tmp_path, make_row):
+    store = CsvRecordsStore(str(tmp_path / "records.csv"), rollup_path=str(tmp_path / "rollup.sqlite3"))
+    store.append_many([make_row(f"2024-01-0{day}T10:00:00.000000Z") for day in [1, 2, 3]])
+    stale_index = store.index.load()
+
+    store.compact("2024-01-02T00:00:00")
+
+    stat = os.stat(store.path)
+    assert TimeIndex(store.path).is_stale(stale_index, stat)
+    assert sorted(store.index.update()["buckets"]) == ["2024-01-02T10", "2024-01-03T10"]
+    assert store.read(start="2024-01-03T00:00:00")["timestamp"].tolist() == ["2024-01-03T10:00:00.000000Z"]
+
+
+def test_partial_last_line_is_not_indexed(tmp_path, make_row):
+    store = CsvRecordsStore(str(tmp_path / "records.csv"))
+    store.append(make_row("2024-01-01T10:00:00.000000Z"))
+    with open(store.path, "a") as f:
+        f.write("2024-01-01T11:00:00.000000Z,par")
+
+    index = store.index.update()
+    assert list(index["buckets"]) == ["2024-01-01T10"]
+    assert index["size"] < os.path.getsize(store.path)
+
+
+@pytest.mark.parametrize("read", [
+    lambda store: store.read(start="2024-01-01T00:00:00"),
+    lambda store: list(store.iter_rows(start="2024-01-01T00:00:00")),
+])
+def test_readers_update_the_index_under_the_records_lock(tmp_path, read, make_row):
+    store = CsvRecordsStore(str(tmp_path / "records.csv"))
+    store.append(make_row("2024-01-01T00:00:00.000000Z"))
+    store.index.erase()
+    reader = threading.Thread(target=read, args=(store,))
+
+    with file_lock(store.path):
+        reader.start()
+        reader.join(0.2)
+        # The reader waits for the writer before updating the index
+        assert reader.is_alive()
+        assert store.index.load() is None
+    reader.join()
+
+    assert store.index.load()["size"] == os.path.getsize(store.path)
@@ -0,0 +1,69 @@
+import pytest
+from records_store import CsvRecordsStore, SqliteRecordsStore
+from records_merge import merge_records, sort_within_window
+
+
+def test_merge_drops_duplicates_and_orders_by_timestamp(tmp_path, make_row):
+    macbook = CsvRecordsStore(str(tmp_path / "macbook.csv"))
+    macbook.append_many([
+        make_row("2024-01-01T10:00:00.000000Z", pid=1),
+        make_row("2024-01-03T10:00:00.000000Z", pid=3),
+        make_row("2024-01-02T10:00:00.000000Z", pid=2),
+    ])
+    imac = SqliteRecordsStore(str(tmp_path / "imac.sqlite3"))
+    imac.append_many([
+        make_row("2024-01-01T10:00:00.000000Z", pid=1),
+        make_row("2024-01-02T12:00:00.000000Z", pid=7),
+    ])
+    output_path = str(tmp_path / "merged.sqlite3")
+
+    merged = merge_records(
+        [("macbook", macbook.path), ("imac", imac.path), ("macbook", macbook.path)], output_path
+    )
+
+    assert merged == 5
+    merged_df = SqliteRecordsStore(output_path).read()
+    assert list(zip(merged_df["host_id"], merged_df["timestamp"])) == [
+        ("macbook", "2024-01-01T10:00:00.000000Z"),
+        ("imac", "2024-01-01T10:00:00.000000Z"),
+        ("macbook", "2024-01-02T10:00:00.000000Z"),
+        ("imac", "2024-01-02T12:00:00.000000Z"),
+        ("macbook", "2024-01-03T10:00:00.000000Z"),
+    ]
+
+
+def test_merge_stores_csv_numbers_as_numbers(tmp_path, make_row):
+    source = CsvRecordsStore(str(tmp_path / "macbook.csv"))
+    source.append_many([
+        make_row("2024-01-01T10:00:00.000000Z", pid=1, download=123.5, upload=45.25, bytes_sent=1000),
+        make_row("2024-01-01T11:00:00.000000Z", pid=2),
+    ])
+    output_path = str(tmp_path / "merged.sqlite3")
+    merge_records([("macbook", source.path)], output_path)
+
+    merged_df = SqliteRecordsStore(output_path).read()
+    assert merged_df["download"].tolist() == [123.5, 100.0]
+    assert merged_df["pid"].tolist() == [1, 2]
+    assert merged_df["upload"].dtype.kind == "f"
+    assert merged_df["bytes_sent"].tolist()[0] == 1000
+    assert merged_df["wifi_physical_name"].tolist() == ["home", "home"]
+
+
+def test_merge_keeps_host_id_of_merged_stores(tmp_path, make_row):
+    source = CsvRecordsStore(str(tmp_path / "macbook.csv"))
+    source.append(make_row("2024-01-01T10:00:00.000000Z", pid=1))
+    first_path = str(tmp_path / "first.csv")
+    merge_records([("macbook", source.path)], first_path)
+
+    second_path = str(tmp_path / "second.csv")
+    assert merge_records([("other", first_path), ("macbook", source.path)], second_path) == 1
+    assert CsvRecordsStore(second_path).read()["host_id"].tolist() == ["macbook"]
+
+
+def test_sort_within_window_rejects_rows_out_of_order_beyond_the_window():
+    rows = [{"timestamp": t} for t in ["b", "a", "d", "c"]]
+    assert [r["timestamp"] for r in sort_within_window(iter(rows), window=1)] == ["a", "b", "c", "d"]
+
+    rows = [{"timestamp": t} for t in ["c", "d", "e", "a"]]
+    with pytest.raises(ValueError):
+        list(sort_within_window(iter(rows), window=1))
@@ -0,0 +1,34 @@
+import pytest
+from records_rollup import SqliteFileRollupStore, build_cells, cells_to_dataframe, summarize
+
+
+def test_summarize_matches_raw_statistics(make_row):
+    rows = [
+        make_row(f"2024-01-01T10:{m:02d}:00.000000Z", download=d, upload=None)
+        for m, d in [(0, 10.0), (20, 20.0), (40, 60.0)]
+    ]
+    rows.append(make_row("2024-01-01T10:50:00.000000Z", connected_vpn="work", download=5.0, upload=None))
+    summary_df = summarize(cells_to_dataframe(build_cells(rows)), ["network"]).set_index("network")
+
+    home = summary_df.loc["home"]
+    assert home["records"] == 3
+    assert home["download_mean"] == pytest.approx(30.0)
+    assert home["download_std"] == pytest.approx(26.4575131)
+    assert home["download_min"] == 10.0
+    assert home["download_max"] == 60.0
+    assert home["upload_count"] == 0
+    assert summary_df.loc["home(work)"]["records"] == 1
+
+
+def test_file_rollup_updates_cells_incrementally(tmp_path, make_row):
+    rollup = SqliteFileRollupStore(str(tmp_path / "rollup.sqlite3"))
+    rollup.rebuild([make_row("2024-01-01T10:00:00.000000Z", download=10.0)])
+    rollup.update([
+        make_row("2024-01-01T10:10:00.000000Z", download=30.0), make_row("2024-02-01T10:00:00.000000Z", download=5.0)
+    ])
+
+    rollup_df = rollup.read()
+    assert len(rollup_df) == 2
+    assert rollup_df["records"].sum() == 3
+    assert sorted(rollup_df["download_sum"].tolist()) == [5.0, 40.0]
+
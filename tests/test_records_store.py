@@ -0,0 +1,168 @@
+import os
+import csv
+import sqlite3
+import pytest
+from records_store import (
+    RECORDS_COLUMNS,
+    CsvRecordsStore,
+    PartitionedCsvRecordsStore,
+    RecordsSchemaError,
+    SqliteRecordsStore,
+)
+
+
+def test_csv_append_read_round_trip(tmp_path, make_row):
+    store = CsvRecordsStore(str(tmp_path / "records.csv"))
+    store.append(make_row("2024-01-01T10:00:00.000000Z", download=1.5))
+    store.append_many([make_row("2024-01-02T10:00:00.000000Z"), make_row("2024-01-03T10:00:00.000000Z", "office")])
+
+    records_df = store.read()
+    assert list(records_df.columns) == RECORDS_COLUMNS
+    assert records_df["timestamp"].tolist() == [
+        "2024-01-01T10:00:00.000000Z",
+        "2024-01-02T10:00:00.000000Z",
+        "2024-01-03T10:00:00.000000Z",
+    ]
+    assert records_df["download"].tolist()[0] == 1.5
+    assert len(store.read(wifi_physical_name="office")) == 1
+    assert len(store.read(start="2024-01-02T00:00:00Z")) == 2
+
+    with open(store.path, newline="") as f:
+        lines = list(csv.reader(f))
+    assert lines[0] == RECORDS_COLUMNS
+    assert len(lines) == 4
+
+
+def test_csv_header_migration_adds_missing_columns(tmp_path, make_row):
+    path = tmp_path / "records.csv"
+    old_columns = [c for c in RECORDS_COLUMNS if c not in ["pid", "dns_p50"]]
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(old_columns)
+        writer.writerow(["2024-01-01T10:00:00.000000Z" if c == "timestamp" else "" for c in old_columns])
+
+    store = CsvRecordsStore(str(path))
+    store.append(make_row("2024-01-02T10:00:00.000000Z", pid=42, dns_p50=1.25))
+
+    header = store.read_header()
+    assert header == old_columns + ["pid", "dns_p50"]
+    records_df = store.read()
+    assert len(records_df) == 2
+    assert records_df["pid"].isnull().tolist() == [True, False]
+    assert records_df["dns_p50"].tolist()[1] == 1.25
+
+
+def test_sqlite_append_read_round_trip(tmp_path, make_row):
+    store = SqliteRecordsStore(str(tmp_path / "records.sqlite3"))
+    store.append_many([
+        make_row("2024-01-02T10:00:00.000000Z", server_name="Tokyo", client_ip="192.0.2.1"),
+        make_row("2024-01-01T10:00:00.000000Z", "office", server_name="Osaka", client_ip="192.0.2.2"),
+        make_row("2024-01-03T10:00:00.000000Z", server_name="Tokyo", client_ip="192.0.2.1"),
+    ])
+
+    records_df = store.read()
+    assert list(records_df.columns) == RECORDS_COLUMNS
+    assert records_df["timestamp"].str[:10].tolist() == ["2024-01-01", "2024-01-02", "2024-01-03"]
+    assert records_df["server_name"].tolist() == ["Osaka", "Tokyo", "Tokyo"]
+    assert records_df["client_ip"].tolist() == ["192.0.2.2", "192.0.2.1", "192.0.2.1"]
+    assert store.read(wifi_physical_name="home")["server_name"].tolist() == ["Tokyo", "Tokyo"]
+    assert [len(chunk) for chunk in store.iter_chunks(chunk_rows=2)] == [2, 1]
+    # Servers and clients are interned
+    conn = sqlite3.connect(store.path)
+    assert conn.execute("SELECT COUNT(*) FROM servers").fetchone()[0] == 2
+    assert conn.execute("SELECT COUNT(*) FROM clients").fetchone()[0] == 2
+    conn.close()
+
+
+def test_sqlite_rejects_unknown_columns(tmp_path, make_row):
+    store = SqliteRecordsStore(str(tmp_path / "records.sqlite3"))
+    with pytest.raises(RecordsSchemaError):
+        store.append(make_row("2024-01-01T10:00:00.000000Z", unknown_column=1))
+    assert len(store.read()) == 0
+
+
+def test_partitioned_append_read_round_trip(tmp_path, make_row):
+    store = PartitionedCsvRecordsStore(str(tmp_path / "records"))
+    store.append_many([
+        make_row("2024-01-31T10:00:00.000000Z"),
+        make_row("2024-02-01T10:00:00.000000Z"),
+        make_row("2024-02-02T10:00:00.000000Z"),
+    ])
+
+    manifest = store.load_manifest()
+    assert sorted(manifest["partitions"]) == ["2024-01", "2024-02"]
+    assert manifest["partitions"]["2024-02"]["rows"] == 2
+    assert manifest["partitions"]["2024-02"]["min_timestamp"] == "2024-02-01T10:00:00.000000Z"
+    assert len(store.read()) == 3
+    assert store.select_partitions(start="2024-02-01T00:00:00Z") == ["2024-02"]
+    assert store.read(start="2024-02-01T00:00:00Z")["timestamp"].tolist() == [
+        "2024-02-01T10:00:00.000000Z",
+        "2024-02-02T10:00:00.000000Z",
+    ]
+
+
+def test_partitioned_manifest_is_rebuilt_when_missing(tmp_path, make_row):
+    store = PartitionedCsvRecordsStore(str(tmp_path / "records"), granularity="daily")
+    store.append_many([make_row("2024-01-01T10:00:00.000000Z"), make_row("2024-01-02T10:00:00.000000Z")])
+    manifest = store.load_manifest()
+    (tmp_path / "records" / "manifest.json").unlink()
+
+    assert store.load_manifest() == manifest
+
+
+def test_csv_compact_keeps_compacted_records_in_rollups(tmp_path, make_row):
+    store = CsvRecordsStore(str(tmp_path / "records.csv"), rollup_path=str(tmp_path / "records_rollup.sqlite3"))
+    store.append_many([make_row(f"2024-0{month}-01T10:00:00.000000Z") for month in [1, 2, 3]])
+
+    assert store.compact("2024-02-15T00:00:00") == 2
+    assert store.read()["timestamp"].tolist() == ["2024-03-01T10:00:00.000000Z"]
+    assert store.read(start="2024-03-01T00:00:00Z")["timestamp"].tolist() == ["2024-03-01T10:00:00.000000Z"]
+    assert store.read_rollup()["records"].sum() == 3
+
+
+def test_csv_compact_without_rollup_keeps_records(tmp_path, make_row):
+    store = CsvRecordsStore(str(tmp_path / "records.csv"), rollup_path=None)
+    store.append_many([make_row(f"2024-0{month}-01T10:00:00.000000Z") for month in [1, 2, 3]])
+
+    assert store.compact("2024-02-15T00:00:00") == 0
+    assert len(store.read()) == 3
+
+
+def test_partitioned_compact_drops_old_partitions(tmp_path, make_row):
+    store = PartitionedCsvRecordsStore(str(tmp_path / "records"))
+    store.append_many([
+        make_row("2024-01-01T10:00:00.000000Z"),
+        make_row("2024-02-01T10:00:00.000000Z"),
+        make_row("2024-02-20T10:00:00.000000Z"),
+    ])
+
+    assert store.compact("2024-02-15T00:00:00") == 2
+    manifest = store.load_manifest()
+    assert sorted(manifest["partitions"]) == ["2024-02"]
+    assert manifest["partitions"]["2024-02"] == {
+        "min_timestamp": "2024-02-20T10:00:00.000000Z",
+        "max_timestamp": "2024-02-20T10:00:00.000000Z",
+        "rows": 1,
+    }
+    assert not (tmp_path / "records" / "records_2024-01.csv").exists()
+    assert store.read_rollup()["records"].sum() == 3
+
+
+def database_size(path):
+    return sum(os.path.getsize(f"{path}{suffix}") for suffix in ["", "-wal"] if os.path.exists(f"{path}{suffix}"))
+
+
+def test_sqlite_compact_shrinks_the_database(tmp_path, make_row):
+    store = SqliteRecordsStore(str(tmp_path / "records.sqlite3"))
+    rows = [
+        make_row(f"2024-01-{day:02d}T10:00:00.000000Z", server_name=f"server {i}", client_ip=f"192.0.2.{i % 250}")
+        for i, day in enumerate([1] * 2000 + [31] * 10)
+    ]
+    store.append_many(rows)
+    size = database_size(store.path)
+
+    assert store.compact("2024-01-15T00:00:00") == 2000
+    assert len(store.read()) == 10
+    assert store.read_rollup()["records"].sum() == 2010
+    assert database_size(store.path) < size / 2
+
@@ -0,0 +1,69 @@
+import time
+import queue
+from records_store import CsvRecordsStore
+from records_writer import RecordsWriter
+
+
+class RecordingStore:
+    """
+    Records store that remembers the size of every write.
+    """
+    def __init__(self, records_store):
+        self.records_store = records_store
+        self.writes = []
+
+    def append_many(self, rows, fsync: bool = False):
+        self.writes.append(len(rows))
+        self.records_store.append_many(rows, fsync=fsync)
+
+    def append_latency(self, rows, fsync: bool = False):
+        self.records_store.append_latency(rows, fsync=fsync)
+
+
+def timestamps(n):
+    return [f"2024-01-01T{hour:02d}:00:00.000000Z" for hour in range(n)]
+
+
+def test_writer_commits_groups_in_order_and_flushes_on_stop(tmp_path, make_row):
+    store = RecordingStore(CsvRecordsStore(str(tmp_path / "records.csv")))
+    records_queue = queue.Queue()
+    for timestamp in timestamps(5):
+        records_queue.put(make_row(timestamp))
+    writer = RecordsWriter(store, records_queue, batch_size=2, batch_interval=10)
+    writer.start()
+
+    # The last row waits for the end of its group, stop() commits it
+    writer.stop()
+    assert store.writes == [2, 2, 1]
+    assert store.records_store.read()["timestamp"].tolist() == timestamps(5)
+
+
+def test_writer_commits_a_group_after_the_interval(tmp_path, make_row):
+    store = RecordingStore(CsvRecordsStore(str(tmp_path / "records.csv")))
+    records_queue = queue.Queue()
+    writer = RecordsWriter(store, records_queue, batch_size=16, batch_interval=0.1)
+    writer.start()
+    for timestamp in timestamps(3):
+        records_queue.put(make_row(timestamp))
+
+    deadline = time.time() + 5
+    while not store.writes and time.time() < deadline:
+        time.sleep(0.05)
+    assert store.writes == [3]
+    writer.stop()
+    assert not writer.is_alive()
+
+
+def test_writer_keeps_the_group_of_a_rejected_row(tmp_path, make_row):
+    store = CsvRecordsStore(str(tmp_path / "records.csv"))
+    records_queue = queue.Queue()
+    writer = RecordsWriter(store, records_queue, batch_size=16, batch_interval=10)
+    records_queue.put(make_row("2024-01-01T10:00:00.000000Z"))
+    records_queue.put(make_row("2024-01-01T11:00:00.000000Z", client_unknown="new"))
+    writer.append_latency([{"timestamp": "2024-01-01T10:00:00.000000Z", "probes": 10, "lost": 0}])
+    records_queue.put(make_row("2024-01-01T12:00:00.000000Z"))
+    writer.start()
+    writer.stop()
+
+    assert store.read()["timestamp"].tolist() == ["2024-01-01T10:00:00.000000Z", "2024-01-01T12:00:00.000000Z"]
+    assert store.read_latency()["probes"].tolist() == [10]
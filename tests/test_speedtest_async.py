@@ -0,0 +1,41 @@
+import asyncio
+import json
+import speedtest_async
+import speedtest_cli
+
+
+def test_async_engine_runs_a_full_test(speedtest_cache, speedtest_server):
+    speedtest = speedtest_async.AsyncSpeedtest(cache=speedtest_cache)
+    results = asyncio.run(speedtest.run())
+
+    assert results.server["id"] == "1"
+    assert results.ping > 0
+    assert results.download > 0
+    assert results.upload > 0
+    assert results.bytes_received > 0
+    assert results.bytes_sent > 0
+    # Streams are connected once before the timer starts
+    connections = speedtest.timings.summary()["connect"]["count"]
+    probes = 3
+    assert connections <= probes + speedtest.config["threads"]["download"] + speedtest.config["threads"]["upload"]
+
+
+def test_run_speedtest_returns_results_json(speedtest_cache, speedtest_server):
+    results = json.loads(speedtest_async.run_speedtest(streams=2, cache=speedtest_cache))
+
+    assert results["server"]["id"] == "1"
+    assert results["download"] > 0
+    assert results["upload"] > 0
+    assert results["client"]["isp"] == "Test ISP"
+
+
+def test_async_engine_reselects_a_dead_sticky_server(speedtest_cache, server_entry, unused_port, tmp_path):
+    history = speedtest_cli.ServerHistory(str(tmp_path / "history.json"), key="home")
+    history.select(server_entry(unused_port, server_id="2"))
+    speedtest = speedtest_async.AsyncSpeedtest(cache=speedtest_cache, history=history)
+    results = asyncio.run(speedtest.run(download=False, upload=False))
+
+    assert results.server["id"] == "1"
+    assert history.sticky_server()["id"] == "1"
+    assert history.baseline("2") is None
+    assert history.baseline("1") == results.ping
@@ -0,0 +1,375 @@
+import time
+import socket
+import threading
+from types import SimpleNamespace
+import pytest
+import speedtest_cli
+
+SERVERS_XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<settings>
+<servers>
+<server url="http://tokyo.example.net:8080/speedtest/upload.php" lat="35.68" lon="139.69" name="Tokyo" country="Japan"
+ cc="JP" sponsor="A" id="1" host="tokyo.example.net:8080" />
+<server url="http://osaka.example.net:8080/speedtest/upload.php" lat="34.69" lon="135.50" name="Osaka" country="Japan"
+ cc="JP" sponsor="B" id="2" host="osaka.example.net:8080" />
+<server url="http://sapporo.example.net:8080/speedtest/upload.php" lat="43.06" lon="141.35" name="Sapporo" country="Japan"
+ cc="JP" sponsor="C" id="3" host="sapporo.example.net:8080" />
+<server url="http://nowhere.example.net:8080/speedtest/upload.php" lat="" lon="" name="Nowhere" country="Japan"
+ cc="JP" sponsor="D" id="4" host="nowhere.example.net:8080" />
+<server url="http://seoul.example.net:8080/speedtest/upload.php" lat="37.57" lon="126.98" name="Seoul" country="Korea"
+ cc="KR" sponsor="E" id="5" host="seoul.example.net:8080" />
+</servers>
+</settings>
+"""
+
+TOKYO = (35.68, 139.69)
+
+
+def parse_in_chunks(chunk_size, *args, **kwargs):
+    parser = speedtest_cli.ServerListParser(TOKYO, *args, **kwargs)
+    for i in range(0, len(SERVERS_XML), chunk_size):
+        parser.feed(SERVERS_XML[i:i + chunk_size])
+    return parser, parser.close()
+
+
+def server_ids(servers):
+    return [server["id"] for d in sorted(servers) for server in servers[d]]
+
+
+def connections(speedtest):
+    return speedtest.timings.summary()["connect"]["count"]
+
+
+def test_keep_alive_pool_connects_once_per_worker(speedtest_cache, speedtest_server):
+    speedtest = speedtest_cli.Speedtest(cache=speedtest_cache)
+    assert speedtest.get_best_server()["id"] == "1"
+
+    before = connections(speedtest)
+    assert speedtest.download() > 0
+    assert connections(speedtest) - before <= speedtest.config["threads"]["download"]
+
+    # download() raises the upload threads on fast connections, as in speedtest-cli
+    before = connections(speedtest)
+    assert speedtest.upload() > 0
+    assert connections(speedtest) - before <= speedtest.config["threads"]["upload"]
+
+    results = speedtest.results.dict()
+    assert results["bytes_received"] > 0
+    assert results["bytes_sent"] > 0
+
+
+def test_legacy_threads_connect_per_request(speedtest_cache, speedtest_server):
+    speedtest = speedtest_cli.Speedtest(cache=speedtest_cache, keep_alive=False)
+    speedtest.get_best_server()
+
+    before = connections(speedtest)
+    assert speedtest.download() > 0
+    assert connections(speedtest) - before > speedtest.config["threads"]["download"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, len(SERVERS_XML)])
+def test_server_list_parser_locates_servers_in_any_chunks(chunk_size):
+    parser, servers = parse_in_chunks(chunk_size, [], batch_size=2)
+
+    assert parser.count == 5
+    # Servers without a location are left out, the others are keyed by distance
+    assert server_ids(servers) == ["1", "2", "3", "5"]
+    osaka = [server for d in servers for server in servers[d] if server["id"] == "2"][0]
+    assert osaka["d"] == pytest.approx(speedtest_cli.distance(TOKYO, (34.69, 135.50)))
+    assert servers == speedtest_cli.parse_servers(SERVERS_XML, TOKYO, [])
+
+
+def test_server_list_parser_filters_servers():
+    assert server_ids(parse_in_chunks(16, [], servers=[2, 3])[1]) == ["2", "3"]
+    assert server_ids(parse_in_chunks(16, [], exclude=[1])[1]) == ["2", "3", "5"]
+    assert server_ids(parse_in_chunks(16, [3, 5])[1]) == ["1", "2"]
+    assert server_ids(parse_in_chunks(16, [5], servers=[1, 5], exclude=[1])[1]) == []
+
+
+def test_server_list_parser_rejects_malformed_xml():
+    parser = speedtest_cli.ServerListParser(TOKYO, [])
+    parser.feed(SERVERS_XML[:200])
+    with pytest.raises(speedtest_cli.SpeedtestServersError):
+        parser.close()
+
+
+def test_closest_servers():
+    servers = speedtest_cli.parse_servers(SERVERS_XML, TOKYO, [])
+    assert [server["id"] for server in speedtest_cli.closest_servers(servers, limit=2)] == ["1", "2"]
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    """
+    Hosts passed to socket.getaddrinfo. Names resolve to 127.0.0.1 without a DNS server.
+    """
+    hosts = []
+    getaddrinfo = socket.getaddrinfo
+
+    def fake_getaddrinfo(host, port, family=0, socktype=0, proto=0, flags=0):
+        hosts.append(host)
+        if not flags & socket.AI_NUMERICHOST:
+            time.sleep(0.05)
+            host = "127.0.0.1"
+        return getaddrinfo(host, port, family, socktype, proto, flags)
+    monkeypatch.setattr(socket, "getaddrinfo", fake_getaddrinfo)
+    return hosts
+
+
+def test_resolver_cache_reuses_results_until_ttl(lookups):
+    resolver = speedtest_cli.ResolverCache(ttl=0.2)
+    timings = speedtest_cli.ConnectionTimings()
+
+    addresses = resolver.getaddrinfo("speedtest.example.net", 8080, timings=timings)
+    assert resolver.getaddrinfo("speedtest.example.net", 8080, timings=timings) == addresses
+    assert resolver.cached("speedtest.example.net", 8080) == addresses
+    assert resolver.cached("speedtest.example.net", 443) is None
+    assert lookups == ["speedtest.example.net"]
+    # Cache hits are not name resolutions
+    assert timings.summary()["dns"]["count"] == 1
+
+    time.sleep(0.25)
+    assert resolver.cached("speedtest.example.net", 8080) is None
+    resolver.getaddrinfo("speedtest.example.net", 8080)
+    assert lookups == ["speedtest.example.net"] * 2
+
+
+def test_resolver_cache_resolves_concurrent_lookups_once(lookups):
+    resolver = speedtest_cli.ResolverCache()
+    threads = [
+        threading.Thread(target=resolver.getaddrinfo, args=("speedtest.example.net", 8080)) for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert lookups == ["speedtest.example.net"]
+
+
+def test_pinned_host_is_never_resolved(lookups):
+    resolver = speedtest_cli.ResolverCache()
+    resolver.pin("Speedtest.Example.NET", "192.0.2.10")
+
+    addresses = resolver.getaddrinfo("speedtest.example.net", 8080)
+    assert [address[4] for address in addresses] == [("192.0.2.10", 8080)]
+    assert resolver.cached("speedtest.example.net", 8080) == addresses
+    assert set(lookups) == {"192.0.2.10"}
+
+    resolver.unpin("speedtest.example.net")
+    resolver.getaddrinfo("speedtest.example.net", 8080)
+    assert lookups[-1] == "speedtest.example.net"
+
+
+def test_connections_time_only_resolutions_as_dns(lookups, speedtest_server, monkeypatch):
+    monkeypatch.setattr(speedtest_cli, "RESOLVER", speedtest_cli.ResolverCache())
+    timings = speedtest_cli.ConnectionTimings()
+    url = f"http://speedtest.example.net:{speedtest_server.server_address[1]}/speedtest/latency.txt"
+
+    for _ in range(3):
+        connection = speedtest_cli.build_http_connection(url, timings=timings)
+        connection.request("GET", "/speedtest/latency.txt")
+        assert connection.getresponse().read() == b"test=test"
+        connection.close()
+
+    summary = timings.summary()
+    assert summary["connect"]["count"] == 3
+    assert summary["dns"]["count"] == 1
+    assert summary["dns"]["min"] >= 50
+
+
+@pytest.fixture
+def history(tmp_path):
+    return speedtest_cli.ServerHistory(str(tmp_path / "history.json"), key="home")
+
+
+def record_latency(history, server, *latencies):
+    for latency in latencies:
+        history.record(SimpleNamespace(server=server, ping=latency, download=1e8, upload=1e7))
+
+
+def test_sticky_server_is_reused(speedtest_cache, speedtest_server, server_entry, history):
+    server = server_entry(speedtest_server.server_address[1])
+    history.select(server)
+    record_latency(history, server, 1.0, 2.0, 3.0)
+    speedtest = speedtest_cli.Speedtest(cache=speedtest_cache, history=history)
+
+    best = speedtest.get_sticky_server()
+    assert best["id"] == "1"
+    assert 0 < best["latency"] < 5
+    assert speedtest.results.ping == best["latency"]
+
+
+def test_sticky_server_is_reselected_when_due(speedtest_cache, speedtest_server, server_entry, tmp_path):
+    history = speedtest_cli.ServerHistory(str(tmp_path / "history.json"), key="home", reselect_after=0)
+    history.select(server_entry(speedtest_server.server_address[1]))
+    speedtest = speedtest_cli.Speedtest(cache=speedtest_cache, history=history)
+
+    assert speedtest.get_sticky_server() is None
+    assert speedtest_server.requests == 0
+
+
+def test_sticky_server_is_reselected_when_latency_drifts(speedtest_cache, speedtest_server, server_entry, history):
+    server = server_entry(speedtest_server.server_address[1])
+    history.select(server)
+    record_latency(history, server, 1.0, 2.0, 3.0)
+    # Half of the round trip of a probe
+    speedtest_server.latency_delay = 0.1
+    speedtest = speedtest_cli.Speedtest(cache=speedtest_cache, history=history)
+
+    assert speedtest.get_sticky_server() is None
+
+
+def test_drift_threshold(history, server_entry):
+    server = server_entry(8080)
+    assert not history.drifted(server, 100.0)
+    record_latency(history, server, 10.0, 20.0, 30.0)
+
+    assert history.baseline("1") == 20.0
+    assert not history.drifted(server, 30.0)
+    assert history.drifted(server, 30.1)
+    record_latency(history, server, *[1.0] * 20)
+    # At least HISTORY_MIN_DRIFT ms above the baseline
+    assert not history.drifted(server, 1.0 + speedtest_cli.HISTORY_MIN_DRIFT)
+    assert history.drifted(server, 1.1 + speedtest_cli.HISTORY_MIN_DRIFT)
+
+
+def test_dead_sticky_server_is_reselected(speedtest_cache, server_entry, unused_port, history):
+    server = server_entry(unused_port, server_id="2")
+    # The last run was selected but never recorded, so the server has no baseline
+    history.select(server)
+    speedtest = speedtest_cli.Speedtest(cache=speedtest_cache, history=history)
+
+    assert speedtest.get_sticky_server() is None
+    assert speedtest.get_best_server()["id"] == "1"
+    assert history.sticky_server()["id"] == "1"
+
+
+def test_failed_latency_is_left_out_of_history(history, server_entry):
+    server = server_entry(8080)
+    record_latency(history, server, 2.0, speedtest_cli.PROBE_FAILURE * 1000.0 / 2, 4.0)
+
+    entry = history.get()["servers"]["1"]
+    assert entry["latency"] == [2.0, 4.0]
+    assert len(entry["download"]) == 3
+    assert history.drifted(server, speedtest_cli.PROBE_FAILURE * 1000.0 / 6)
+
+
+def test_steady_throughput_leaves_out_ramp_up_and_tail():
+    # 2 ramp-up samples, 7 samples at 1000 bytes per interval, and a last request finishing slowly
+    samples = [10, 20, 1020, 2020, 3020, 4020, 5020, 6020, 7020, 7030]
+    assert speedtest_cli.steady_throughput(samples) == pytest.approx(6000 / (6 * 0.1) * 8)
+    assert speedtest_cli.steady_throughput(samples, interval=0.5) == pytest.approx(6000 / (6 * 0.5) * 8)
+
+
+def test_steady_throughput_needs_enough_samples():
+    assert speedtest_cli.steady_throughput([]) is None
+    assert speedtest_cli.steady_throughput([100, 200]) is None
+    assert speedtest_cli.steady_throughput([100, 200, 300]) == pytest.approx(200 / 0.2 * 8)
+
+
+def test_throughput_converges_on_a_steady_rate():
+    steady = [1000 * i for i in range(1, 32)]
+    assert speedtest_cli.throughput_converged(steady)
+    # Not before ADAPTIVE_MIN_DURATION seconds
+    assert not speedtest_cli.throughput_converged(steady[:29])
+
+    noisy = [0]
+    for i in range(30):
+        noisy.append(noisy[-1] + (500 if i % 2 else 1500))
+    assert not speedtest_cli.throughput_converged(noisy)
+    assert not speedtest_cli.throughput_converged([0] * 40)
+
+
+def test_throughput_sampler_sets_the_stop_event_once_converged():
+    stop_event = threading.Event()
+    sampler = speedtest_cli.ThroughputSampler(
+        lambda: 1000, time.perf_counter(), interval=0.01, converged=lambda samples: len(samples) >= 3,
+        stop_event=stop_event,
+    )
+    sampler.start()
+    assert stop_event.wait(2)
+    samples = sampler.stop()
+    assert len(samples) >= 3
+
+
+def timed_download(speedtest):
+    start = time.perf_counter()
+    speedtest.download()
+    return time.perf_counter() - start
+
+
+def test_adaptive_download_ends_once_converged(speedtest_cache, speedtest_server, monkeypatch):
+    speedtest_server.write_delay = 0.05
+    monkeypatch.setattr(speedtest_cli, "throughput_converged", lambda samples: len(samples) >= 3)
+    speedtest = speedtest_cli.Speedtest(cache=speedtest_cache, adaptive=True)
+    speedtest.get_best_server()
+    speedtest.config["length"]["download"] = 30
+
+    assert timed_download(speedtest) < 3
+    assert speedtest.results.download > 0
+
+
+def test_adaptive_download_ends_at_the_test_length(speedtest_cache, speedtest_server):
+    # Converging takes ADAPTIVE_MIN_DURATION seconds, more than the test length
+    speedtest_server.write_delay = 0.05
+    speedtest = speedtest_cli.Speedtest(cache=speedtest_cache, adaptive=True)
+    speedtest.get_best_server()
+    speedtest.config["length"]["download"] = 1
+
+    assert 0.9 < timed_download(speedtest) < speedtest_cli.ADAPTIVE_MIN_DURATION
+    assert len(speedtest.results.download_samples) >= 9
+
+
+def test_results_dict_leaves_out_samples(speedtest_cache, speedtest_server):
+    speedtest_server.write_delay = 0.05
+    speedtest = speedtest_cli.Speedtest(cache=speedtest_cache)
+    speedtest.get_best_server()
+    speedtest.download()
+
+    results = speedtest.results.dict()
+    assert "samples" not in results
+    assert results["download_steady"] > 0
+    assert len(speedtest.results.download_samples) > 0
+
+
+def test_failed_probes_count_as_probe_failure(server_entry, unused_port):
+    prober = speedtest_cli.LatencyProber(server_entry(unused_port), threading.Condition(), timeout=1)
+    prober.run()
+
+    assert prober.cum == [speedtest_cli.PROBE_FAILURE] * 3
+    assert prober.latency() == speedtest_cli.PROBE_FAILURE * 1000.0 / 2
+    assert speedtest_cli.latency_failed(prober.latency())
+
+
+def test_best_server_cancels_slower_probers(speedtest_cache, speedtest_server, start_speedtest_server,
+                                            server_entry, unused_port):
+    slow_server = start_speedtest_server()
+    slow_server.latency_delay = 2
+    servers = [
+        server_entry(slow_server.server_address[1], server_id="2"),
+        server_entry(unused_port, server_id="3"),
+        server_entry(speedtest_server.server_address[1]),
+    ]
+    speedtest = speedtest_cli.Speedtest(cache=speedtest_cache)
+
+    start = time.perf_counter()
+    best = speedtest.get_best_server(servers)
+    # The slow server is cancelled once it took longer than the fastest one, instead of probing 3 times 2 s
+    assert time.perf_counter() - start < 1.5
+    assert best["id"] == "1"
+    assert best["latency"] < 100
+    assert slow_server.requests == 1
+
+
+def test_best_server_leaves_out_probers_after_the_deadline(speedtest_cache, start_speedtest_server, server_entry):
+    slow_server = start_speedtest_server()
+    slow_server.latency_delay = 2
+    speedtest = speedtest_cli.Speedtest(cache=speedtest_cache)
+
+    start = time.perf_counter()
+    best = speedtest.get_best_server([server_entry(slow_server.server_address[1], server_id="2")], deadline=0.5)
+    assert time.perf_counter() - start < 1.5
+    # Probes that did not finish count as failed
+    assert best["id"] == "2"
+    assert speedtest_cli.latency_failed(best["latency"])